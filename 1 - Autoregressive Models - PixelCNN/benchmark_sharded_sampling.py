@@ -0,0 +1,62 @@
+"""Benchmark of the sharded sampling on CPU.
+
+The same job runs with one worker process and with pools of workers that share the cores,
+and all the runs must generate the same images. The time includes starting the workers and
+loading their models. The sampling speed does not depend on the trained weights, so the
+workers load the weights of an untrained model.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import numpy as np
+import tensorflow as tf
+
+from pixelCNN import build_pixelcnn
+from sharded_sampling import sharded_sample
+
+
+def main():
+    random_seed = 42
+    height = 28
+    width = 28
+    n_channel = 1
+    q_levels = 2
+    n_images = 40
+    shard_size = 5
+
+    n_cores = os.cpu_count()
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        tf.random.set_seed(random_seed)
+        weights = os.path.join(directory, 'pixelcnn.h5')
+        build_pixelcnn(height, width, n_channel, q_levels).save_weights(weights)
+
+        for n_workers in sorted({1, 2, 4, n_cores}):
+            n_threads = max(n_cores // n_workers, 1)
+            path = os.path.join(directory, '{:}_workers.npy'.format(n_workers))
+
+            start = time.time()
+            samples = sharded_sample(path, n_images, (height, width, n_channel), q_levels, random_seed,
+                                     n_workers=n_workers, shard_size=shard_size, n_threads=n_threads,
+                                     weights=weights)
+            elapsed = time.time() - start
+
+            results[n_workers] = np.array(samples)
+            print('{:2} workers x {:2} threads: {:.2f} s, {:.3f} images/second, '
+                  '{:} of {:} pixels differ from 1 worker'.format(n_workers,
+                                                                  n_threads,
+                                                                  elapsed,
+                                                                  n_images / elapsed,
+                                                                  np.sum(results[1] != results[n_workers]),
+                                                                  results[n_workers].size))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Script to train a multiscale PixelCNN on the MNIST dataset.
+
+The image at full resolution is split into the 4 slices x[a::2, b::2] (a, b in {0, 1}).
+The first slice is the image at half the resolution, which is split again, down to a base
+resolution that is generated in raster order by the PixelCNN of `pixelCNN.py`. The other 3
+slices of every level are generated one after the other conditioned on the slices before
+them, as in the Parallel Multiscale PixelCNN [1] and the Subscale Pixel Network [2]. All
+the pixels of a slice are sampled in parallel, so with n levels the sampling takes
+(H / 2^n) * (W / 2^n) + 3n sequential evaluations instead of H * W.
+
+Refs:
+[1] - Reed, S., Oord, A. V. D., Kalchbrenner, N., Colmenarejo, S. G., Wang, Z., Chen, Y.,
+... & de Freitas, N. (2017). Parallel multiscale autoregressive density estimation.
+arXiv preprint arXiv:1703.03664.
+[2] - Menick, J., & Kalchbrenner, N. (2018). Generating high fidelity images with subscale
+pixel networks and multidimensional upscaling. arXiv preprint arXiv:1812.01608.
+"""
+import random as rn
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow import nn
+from tensorflow.keras.utils import Progbar
+
+from pixelCNN import build_pixelcnn, cached_sample, quantise
+
+N_SLICES = 4
+
+
+class UnmaskedResidualBlock(keras.Model):
+    """Residual block of the slice networks.
+
+    Same as the `ResidualBlock` of `pixelCNN.py` without the mask, since all the slices
+    a slice network looks at are already known.
+    """
+
+    def __init__(self, h):
+        super(UnmaskedResidualBlock, self).__init__(name='')
+
+        self.conv2a = keras.layers.Conv2D(filters=h, kernel_size=1, strides=1)
+        self.conv2b = keras.layers.Conv2D(filters=h, kernel_size=3, strides=1, padding='same')
+        self.conv2c = keras.layers.Conv2D(filters=2 * h, kernel_size=1, strides=1)
+
+    def call(self, input_tensor):
+        x = nn.relu(input_tensor)
+        x = self.conv2a(x)
+
+        x = nn.relu(x)
+        x = self.conv2b(x)
+
+        x = nn.relu(x)
+        x = self.conv2c(x)
+
+        x += input_tensor
+        return x
+
+
+def build_slice_network(height, width, n_channel, q_levels, n_blocks=4):
+    """Create the network that predicts a slice from the slices before it.
+
+    Arguments:
+    height, width: resolution of the slices.
+    n_channel: number of channels of the image.
+    q_levels: number of quantisation levels.
+    n_blocks: number of residual blocks.
+
+    The input is the output of `slice_input`, and the output holds the logits of every
+    slice with shape [N, height, width, 4 * n_channel, q_levels].
+    """
+    inputs = keras.layers.Input(shape=(height, width, N_SLICES * (n_channel + 1)))
+    x = keras.layers.Conv2D(filters=128, kernel_size=3, strides=1, padding='same')(inputs)
+
+    for i in range(n_blocks):
+        x = UnmaskedResidualBlock(h=64)(x)
+
+    x = keras.layers.Activation(activation='relu')(x)
+    x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
+    x = keras.layers.Activation(activation='relu')(x)
+    x = keras.layers.Conv2D(filters=N_SLICES * n_channel * q_levels, kernel_size=1, strides=1)(x)
+    x = keras.layers.Reshape((height, width, N_SLICES * n_channel, q_levels))(x)
+
+    return keras.Model(inputs=inputs, outputs=x)
+
+
+def build_multiscale_pixelcnn(height, width, n_channel, q_levels, n_levels=2):
+    """Create the base PixelCNN and the slice network of every level.
+
+    The slice network of level l splits the image downsampled by 2^l, so the base PixelCNN
+    works at (height / 2^n_levels, width / 2^n_levels). With `n_levels=0` the model is the
+    raster PixelCNN of `pixelCNN.py`.
+    """
+    assert height % 2 ** n_levels == 0 and width % 2 ** n_levels == 0
+
+    base = build_pixelcnn(height // 2 ** n_levels, width // 2 ** n_levels, n_channel, q_levels)
+    slice_networks = [build_slice_network(height // 2 ** (level + 1),
+                                          width // 2 ** (level + 1),
+                                          n_channel,
+                                          q_levels)
+                      for level in range(n_levels)]
+    return base, slice_networks
+
+
+def to_slices(images):
+    """Stack the 4 slices x[a::2, b::2] of the images along the channels, slice 2a + b first."""
+    return tf.nn.space_to_depth(images, 2)
+
+
+def from_slices(slices):
+    """Inverse of `to_slices`."""
+    return tf.nn.depth_to_space(slices, 2)
+
+
+def slice_input(slices, k):
+    """Input of a slice network predicting slice k: slices 0 to k - 1 and which are known."""
+    n_channel = slices.shape[-1] // N_SLICES
+
+    known = tf.cast(tf.range(N_SLICES) < k, slices.dtype)
+    known_slices = slices * tf.repeat(known, n_channel)
+    indicator = tf.ones_like(slices[:, :, :, :N_SLICES]) * known
+    return tf.concat([known_slices, indicator], axis=-1)
+
+
+def multiscale_loss(base, slice_networks, batch_x, batch_y):
+    """Negative log-likelihood of the images in nats per dimension.
+
+    The likelihood of the image is the likelihood of its base resolution under the base
+    PixelCNN times the likelihood of slices 1 to 3 of every level under the slice networks.
+
+    Arguments:
+    batch_x: images scaled to [0, 1], with shape [N, H, W, C].
+    batch_y: quantised images, with shape [N, H, W, C].
+    """
+    n_levels = len(slice_networks)
+    total = 0.
+
+    for level, slice_network in enumerate(slice_networks):
+        slices_x = to_slices(batch_x[:, ::2 ** level, ::2 ** level])
+        slices_y = to_slices(batch_y[:, ::2 ** level, ::2 ** level])
+        n_channel = slices_x.shape[-1] // N_SLICES
+
+        # Slices 1 to 3 are predicted in a single call stacking them along the batch
+        inputs = tf.concat([slice_input(slices_x, k) for k in range(1, N_SLICES)], axis=0)
+        all_logits = tf.split(slice_network(inputs), N_SLICES - 1, axis=0)
+
+        for k, logits in enumerate(all_logits, start=1):
+            logits = logits[:, :, :, k * n_channel:(k + 1) * n_channel]
+            labels = slices_y[:, :, :, k * n_channel:(k + 1) * n_channel]
+            total += tf.reduce_sum(nn.sparse_softmax_cross_entropy_with_logits(labels, logits))
+
+    logits = base(batch_x[:, ::2 ** n_levels, ::2 ** n_levels])
+    labels = batch_y[:, ::2 ** n_levels, ::2 ** n_levels, 0]
+    total += tf.reduce_sum(nn.sparse_softmax_cross_entropy_with_logits(labels, logits))
+
+    return total / tf.cast(tf.size(batch_y), tf.float32)
+
+
+def train(base, slice_networks, train_dataset, n_epochs, learning_rate=1e-3, n_iter=None):
+    """Train the base PixelCNN and the slice networks jointly with `multiscale_loss`.
+
+    Arguments:
+    train_dataset: tf.data.Dataset of batches (batch_x, batch_y) as in `multiscale_loss`.
+    n_epochs: number of passes over `train_dataset`.
+    learning_rate: learning rate of the Adam optimizer.
+    n_iter: number of batches per epoch shown in the progress bar.
+    """
+    variables = base.trainable_variables
+    for slice_network in slice_networks:
+        variables = variables + slice_network.trainable_variables
+
+    optimizer = keras.optimizers.Adam(learning_rate=learning_rate)
+
+    @tf.function
+    def train_step(batch_x, batch_y):
+        with tf.GradientTape() as tape:
+            loss = multiscale_loss(base, slice_networks, batch_x, batch_y)
+
+        gradients = tape.gradient(loss, variables)
+        gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
+        optimizer.apply_gradients(zip(gradients, variables))
+
+        return loss
+
+    for epoch in range(n_epochs):
+        progbar = Progbar(n_iter)
+        print('Epoch {:}/{:}'.format(epoch + 1, n_epochs))
+
+        for batch_x, batch_y in train_dataset:
+            loss = train_step(batch_x, batch_y)
+
+            progbar.add(1, values=[('loss', loss)])
+
+
+def multiscale_sample(base, slice_networks, samples, q_levels):
+    """Generate images from the base resolution up, sampling each slice in parallel.
+
+    The base resolution is generated in raster order with `cached_sample`, then at every
+    level from the coarsest the slices 1 to 3 are sampled one after the other, all their
+    pixels at once.
+
+    Arguments:
+    samples: array with shape [N, H, W, C] that receives the images.
+    q_levels: number of quantisation levels.
+
+    Returns:
+    The images, scaled to [0, 1] as in `pixelCNN.sample`, and the number of sequential
+    evaluations of the networks.
+    """
+    n_levels = len(slice_networks)
+    n_samples, height, width, n_channel = samples.shape
+
+    images = np.zeros((n_samples, height // 2 ** n_levels, width // 2 ** n_levels, n_channel), dtype='float32')
+    images = cached_sample(base, images, q_levels)
+    n_evaluations = images.shape[1] * images.shape[2]
+
+    for slice_network in reversed(slice_networks):
+        slices = tf.concat([images, tf.zeros(images.shape[:3] + (3 * n_channel,))], axis=-1)
+        for k in range(1, N_SLICES):
+            logits = slice_network(slice_input(slices, k))
+            logits = logits[:, :, :, k * n_channel:(k + 1) * n_channel]
+
+            next_slice = tf.random.categorical(tf.reshape(logits, (-1, q_levels)), 1)
+            next_slice = tf.reshape(tf.cast(next_slice, tf.float32) / (q_levels - 1), logits.shape[:4])
+            slices = tf.concat([slices[..., :k * n_channel], next_slice, slices[..., (k + 1) * n_channel:]],
+                               axis=-1)
+            n_evaluations += 1
+
+        images = from_slices(slices).numpy()
+
+    samples[:] = images
+    return samples, n_evaluations
+
+
+def main():
+    # ------------------------------------------------------------------------------------
+    # Defining random seeds
+    random_seed = 42
+    tf.random.set_seed(random_seed)
+    np.random.seed(random_seed)
+    rn.seed(random_seed)
+
+    # ------------------------------------------------------------------------------------
+    # Loading data
+    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
+
+    height = 28
+    width = 28
+    n_channel = 1
+
+    x_train = x_train.astype('float32') / 255.
+    x_test = x_test.astype('float32') / 255.
+
+    x_train = x_train.reshape(x_train.shape[0], height, width, n_channel)
+    x_test = x_test.reshape(x_test.shape[0], height, width, n_channel)
+
+    # ------------------------------------------------------------------------------------
+    # Quantise the input data in q levels
+    q_levels = 2
+    x_train_quantised = quantise(x_train, q_levels)
+    x_test_quantised = quantise(x_test, q_levels)
+
+    # ------------------------------------------------------------------------------------
+    # Creating input stream using tf.data API
+    batch_size = 128
+    train_buf = 60000
+
+    train_dataset = tf.data.Dataset.from_tensor_slices(
+        (x_train_quantised / (q_levels - 1),
+         x_train_quantised.astype('int32')))
+    train_dataset = train_dataset.shuffle(buffer_size=train_buf)
+    train_dataset = train_dataset.batch(batch_size)
+
+    test_dataset = tf.data.Dataset.from_tensor_slices((x_test_quantised / (q_levels - 1),
+                                                       x_test_quantised.astype('int32')))
+    test_dataset = test_dataset.batch(batch_size)
+
+    # ------------------------------------------------------------------------------------
+    # Create the multiscale PixelCNN with a 7x7 base resolution
+    n_levels = 2
+    base, slice_networks = build_multiscale_pixelcnn(height, width, n_channel, q_levels, n_levels)
+
+    # ------------------------------------------------------------------------------------
+    # Training loop
+    n_epochs = 50
+    n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
+    train(base, slice_networks, train_dataset, n_epochs, n_iter=n_iter)
+
+    # ------------------------------------------------------------------------------------
+    # Test set performance
+    test_loss = []
+    for batch_x, batch_y in test_dataset:
+        test_loss.append(multiscale_loss(base, slice_networks, batch_x, batch_y))
+    print('nll : {:} nats'.format(np.array(test_loss).mean()))
+    print('bits/dim : {:}'.format(np.array(test_loss).mean() / np.log(2)))
+
+    # ------------------------------------------------------------------------------------
+    # Generating new images
+    samples = np.zeros((100, height, width, n_channel), dtype='float32')
+    samples, n_evaluations = multiscale_sample(base, slice_networks, samples, q_levels)
+    print('{:} sequential steps instead of {:}'.format(n_evaluations, height * width))
+
+    fig = plt.figure(figsize=(10, 10))
+    for i in range(100):
+        ax = fig.add_subplot(10, 10, i + 1)
+        ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
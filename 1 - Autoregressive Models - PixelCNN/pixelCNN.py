@@ -15,7 +15,8 @@ class MaskedConv2D(keras.layers.Layer):
     """Convolutional layers with masks.
 
     Convolutional layers with simple implementation of masks type A and B for
-    autoregressive models.
+    autoregressive models. Under a mixed precision policy the mask is stored and applied
+    in the compute dtype of the layer, while the kernel and the bias stay in float32.
 
     Arguments:
     mask_type: one of `"A"` or `"B".`
@@ -32,6 +33,8 @@ class MaskedConv2D(keras.layers.Layer):
         Specifying any stride value != 1 is incompatible with specifying
         any `dilation_rate` value != 1.
     padding: one of `"valid"` or `"same"` (case-insensitive).
+    dilation_rate: An integer, the spacing between the kernel taps along the height
+        and width.
     kernel_initializer: Initializer for the `kernel` weights matrix.
     bias_initializer: Initializer for the bias vector.
     """
@@ -42,6 +45,7 @@ class MaskedConv2D(keras.layers.Layer):
                  kernel_size,
                  strides=1,
                  padding='same',
+                 dilation_rate=1,
                  kernel_initializer='glorot_uniform',
                  bias_initializer='zeros'):
         super(MaskedConv2D, self).__init__()
@@ -49,10 +53,12 @@ class MaskedConv2D(keras.layers.Layer):
         assert mask_type in {'A', 'B'}
         self.mask_type = mask_type
 
+        assert strides == 1 or dilation_rate == 1
         self.filters = filters
         self.kernel_size = kernel_size
         self.strides = strides
         self.padding = padding.upper()
+        self.dilation_rate = dilation_rate
         self.kernel_initializer = initializers.get(kernel_initializer)
         self.bias_initializer = initializers.get(bias_initializer)
 
@@ -76,34 +82,103 @@ class MaskedConv2D(keras.layers.Layer):
         mask[center, center + (self.mask_type == 'B'):, :, :] = 0.
         mask[center + 1:, :, :, :] = 0.
 
-        self.mask = tf.constant(mask, dtype=tf.float32, name='mask')
+        self.mask = tf.constant(mask, dtype=self.compute_dtype, name='mask')
+
+    def masked_kernel(self):
+        # Keras only casts the variables to the compute dtype inside __call__, so the
+        # incremental `call_at` and `call_queue` cast them here
+        return tf.math.multiply(self.mask, tf.cast(self.kernel, self.compute_dtype))
 
     def call(self, input):
-        masked_kernel = tf.math.multiply(self.mask, self.kernel)
+        masked_kernel = self.masked_kernel()
         x = nn.conv2d(input,
                       masked_kernel,
                       strides=[1, self.strides, self.strides, 1],
-                      padding=self.padding)
+                      padding=self.padding,
+                      dilations=self.dilation_rate)
         x = nn.bias_add(x, self.bias)
         return x
 
+    def reach(self):
+        """Number of pixels between the centre of the window and its edges."""
+        return self.dilation_rate * (self.kernel_size // 2)
+
+    def call_at(self, padded_input, i, j):
+        """Compute the output of the layer at the single position (i, j).
+
+        Arguments:
+        padded_input: input of the layer zero padded with `reach()` pixels on each side,
+            so the window centred on (i, j) starts at (i, j).
+        i, j: row and column of the output position.
+        """
+        assert self.strides == 1
+        size = 2 * self.reach() + 1
+        patch = padded_input[:, i:i + size:self.dilation_rate, j:j + size:self.dilation_rate, :]
+        x = tf.tensordot(tf.cast(patch, self.compute_dtype), self.masked_kernel(), axes=3)
+        x = nn.bias_add(x, tf.cast(self.bias, self.compute_dtype))
+        return x
+
+    def queue_size(self, width):
+        """Number of inputs the layer needs to keep in the queue of `call_queue`.
+
+        The window centred on (i, j) reaches back `reach()` rows and `reach()` columns, so
+        in raster order its oldest tap is `reach() * (width + 1)` positions before (i, j).
+        """
+        return self.reach() * (width + 1) + 1
+
+    def call_queue(self, queue, i, j, width):
+        """Compute the output of the layer at (i, j) from a queue of its latest inputs.
+
+        Only the taps left unmasked are read, so the positions at and after (i, j) in raster
+        order are never needed (apart from (i, j) itself with mask B).
+
+        Arguments:
+        queue: tf.Variable with shape [queue_size(W), N, C] holding the input of the layer
+            at the raster position p = i * W + j at index p % queue_size(W). The input at
+            (i, j) must already be written with mask B.
+        i, j: row and column of the output position.
+        width: width W of the image.
+        """
+        assert self.strides == 1
+        size = queue.shape[0]
+        center = self.kernel_size // 2
+
+        taps = np.argwhere(self.mask.numpy()[:, :, 0, 0] != 0).astype('int32')
+        rows = i + (taps[:, 0] - center) * self.dilation_rate
+        columns = j + (taps[:, 1] - center) * self.dilation_rate
+
+        # Taps outside the image read the zero padding
+        valid = (rows >= 0) & (columns >= 0) & (columns < width)
+        x = tf.gather(queue, tf.math.floormod(rows * width + columns, size))
+        x = tf.cast(x, self.compute_dtype) * tf.cast(valid, self.compute_dtype)[:, None, None]
+
+        x = tf.einsum('tnc,tcf->nf', x, tf.gather_nd(tf.cast(self.kernel, self.compute_dtype), taps))
+        x = nn.bias_add(x, tf.cast(self.bias, self.compute_dtype))
+        return x
+
 
 class ResidualBlock(keras.Model):
     """Residual blocks that compose pixelCNN
 
     Blocks of layers with 3 convolutional layers and one residual connection.
-    Based on Figure 5 from [1] where h indicates number of filters.
+    Based on Figure 5 from [1] where h indicates number of filters. The masked
+    convolution can be dilated as in [2] to widen the receptive field without adding
+    blocks.
 
     Refs:
     [1] - Oord, A. V. D., Kalchbrenner, N., & Kavukcuoglu, K. (2016). Pixel recurrent
     neural networks. arXiv preprint arXiv:1601.06759.
+    [2] - Oord, A. V. D., Dieleman, S., Zen, H., Simonyan, K., Vinyals, O., Graves, A., ...
+    & Kavukcuoglu, K. (2016). Wavenet: A generative model for raw audio. arXiv preprint
+    arXiv:1609.03499.
     """
 
-    def __init__(self, h):
+    def __init__(self, h, dilation_rate=1):
         super(ResidualBlock, self).__init__(name='')
 
         self.conv2a = keras.layers.Conv2D(filters=h, kernel_size=1, strides=1)
-        self.conv2b = MaskedConv2D(mask_type='B', filters=h, kernel_size=3, strides=1)
+        self.conv2b = MaskedConv2D(mask_type='B', filters=h, kernel_size=3, strides=1,
+                                   dilation_rate=dilation_rate)
         self.conv2c = keras.layers.Conv2D(filters=2 * h, kernel_size=1, strides=1)
 
     def call(self, input_tensor):
@@ -119,6 +194,263 @@ class ResidualBlock(keras.Model):
         x += input_tensor
         return x
 
+    def call_at(self, input_tensor, cache, i, j):
+        """Compute the output of the block at the single position (i, j).
+
+        Only the masked convolution looks at neighbouring positions, so its input is kept
+        in `cache` (zero padded by `conv2b.reach()` pixels) and the new position is written
+        to it before the convolution is evaluated.
+
+        Arguments:
+        input_tensor: input of the block at (i, j), with shape [N, 2h].
+        cache: tf.Variable with shape [N, H + 2 * reach, W + 2 * reach, h] holding the
+            input of the masked convolution for all the positions already computed.
+        i, j: row and column of the output position.
+        """
+        x = nn.relu(input_tensor[:, None, None, :])
+        x = self.conv2a(x)
+
+        x = nn.relu(x)
+        pad = self.conv2b.reach()
+        cache[:, i + pad, j + pad, :].assign(x[:, 0, 0, :])
+        x = self.conv2b.call_at(cache, i, j)
+
+        x = nn.relu(x[:, None, None, :])
+        x = self.conv2c(x)
+
+        x = x[:, 0, 0, :] + input_tensor
+        return x
+
+    def call_queue(self, input_tensor, queue, i, j, width):
+        """Compute the output of the block at (i, j) keeping only the inputs still needed.
+
+        Same as `call_at`, but the input of the masked convolution is pushed to a queue that
+        only holds the last `conv2b.queue_size(W)` positions, as in Fast WaveNet [1].
+
+        Arguments:
+        input_tensor: input of the block at (i, j), with shape [N, 2h].
+        queue: tf.Variable with shape [conv2b.queue_size(W), N, h], see
+            `MaskedConv2D.call_queue`.
+        i, j: row and column of the output position.
+        width: width W of the image.
+
+        Refs:
+        [1] - Paine, T. L., Khorrami, P., Chang, S., Zhang, Y., Ramachandran, P.,
+        Hasegawa-Johnson, M. A., & Huang, T. S. (2016). Fast wavenet generation algorithm.
+        arXiv preprint arXiv:1611.09482.
+        """
+        x = nn.relu(input_tensor[:, None, None, :])
+        x = self.conv2a(x)
+
+        x = nn.relu(x)
+        queue[(i * width + j) % queue.shape[0]].assign(x[:, 0, 0, :])
+        x = self.conv2b.call_queue(queue, i, j, width)
+
+        x = nn.relu(x[:, None, None, :])
+        x = self.conv2c(x)
+
+        x = x[:, 0, 0, :] + input_tensor
+        return x
+
+
+def build_pixelcnn(height, width, n_channel, q_levels, dilation_rates=None):
+    """Create the PixelCNN model with a mask A stem and 15 residual blocks.
+
+    With `dilation_rates`, the model has one residual block per entry instead, with its
+    masked convolution dilated by that rate. For example, [1, 2, 4, 8, 1, 2, 4, 8] sees 33
+    rows above each pixel with 8 blocks, against 18 rows with the 15 undilated blocks.
+
+    The layers follow the global Keras dtype policy, except the output layer which always
+    computes the logits in float32, so the softmax and the loss stay in float32 under the
+    'mixed_bfloat16' policy.
+    """
+    if dilation_rates is None:
+        dilation_rates = [1] * 15
+
+    inputs = keras.layers.Input(shape=(height, width, n_channel))
+    x = MaskedConv2D(mask_type='A', filters=128, kernel_size=7, strides=1)(inputs)
+
+    for dilation_rate in dilation_rates:
+        x = ResidualBlock(h=64, dilation_rate=dilation_rate)(x)
+
+    x = keras.layers.Activation(activation='relu')(x)
+    x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
+    x = keras.layers.Activation(activation='relu')(x)
+    x = keras.layers.Conv2D(filters=q_levels, kernel_size=1, strides=1, dtype='float32')(x)
+
+    return keras.Model(inputs=inputs, outputs=x)
+
+
+def receptive_field_rows(pixelcnn):
+    """Number of rows above a pixel that can influence the output of the model at it."""
+    rows = 0
+    for layer in pixelcnn.layers:
+        if isinstance(layer, MaskedConv2D):
+            rows += layer.reach()
+        elif isinstance(layer, ResidualBlock):
+            rows += layer.conv2b.reach()
+    return rows
+
+
+def cropped_sample(pixelcnn, samples, q_levels, start_row=0):
+    """Generate pixels in raster order running the model only on the rows that matter.
+
+    The output at row i only depends on the `receptive_field_rows` rows above it, so
+    every step runs the model on that crop of rows instead of the whole image. The crop
+    starts at the top of the receptive field, so the zero padding of the convolutions
+    reaches row i exactly as in the full image and both paths give the same images for a
+    fixed seed.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+    """
+    layers = [layer for layer in pixelcnn.layers if not isinstance(layer, keras.layers.InputLayer)]
+
+    rows = receptive_field_rows(pixelcnn)
+    height, width = samples.shape[1:3]
+    for i in range(start_row, height):
+        top = max(i - rows, 0)
+        for j in range(width):
+            # The layers are applied one by one since the model only accepts full images
+            logits = samples[:, top:i + 1]
+            for layer in layers:
+                logits = layer(logits)
+            next_sample = tf.random.categorical(logits[:, i - top, j, :], 1)
+            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+    return samples
+
+
+def cached_sample(pixelcnn, samples, q_levels, start_row=0):
+    """Generate pixels in raster order computing each activation only once.
+
+    With masks A and B the activation of every layer at position (i, j) depends only on
+    positions that come before (i, j) in raster order, which are final once (i, j) is
+    reached. Caching the input of each masked convolution (as in Fast PixelCNN++ [1])
+    allows every step to evaluate the network at the single position (i, j) instead of
+    over the whole image. The random draws are the same as those of a raster loop running
+    the whole model at every step, so both generate the same images for a fixed seed.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+
+    Refs:
+    [1] - Ramachandran, P., Paine, T. L., Khorrami, P., Babaeizadeh, M., Chang, S., Zhang,
+    Y., ... & Huang, T. S. (2017). Fast generation for convolutional autoregressive models.
+    arXiv preprint arXiv:1704.06001.
+    """
+    for _ in cached_sample_rows(pixelcnn, samples, q_levels, start_row):
+        pass
+    return samples
+
+
+def cached_sample_rows(pixelcnn, samples, q_levels, start_row=0):
+    """Generator version of `cached_sample` that yields every row as soon as it is final.
+
+    Yields (i, row) for each generated row i, where row is the view samples[:, i] with
+    shape [N, W, C]. Rows are yielded in raster order and are never changed afterwards, so
+    a consumer (a progressive preview, an encoder) can use each row while the next ones
+    are generated. Pixels from `start_row` onwards are overwritten in place in the
+    `samples` array.
+    """
+    layers = [layer for layer in pixelcnn.layers if not isinstance(layer, keras.layers.InputLayer)]
+    stem = layers[0]
+    blocks = [layer for layer in layers if isinstance(layer, ResidualBlock)]
+    head = layers[1 + len(blocks):]
+
+    n_samples, height, width, n_channel = samples.shape
+    pad = stem.reach()
+    canvas = tf.Variable(np.pad(samples, ((0, 0), (pad, pad), (pad, pad), (0, 0))), dtype=tf.float32)
+    caches = [tf.Variable(tf.zeros((n_samples,
+                                    height + 2 * block.conv2b.reach(),
+                                    width + 2 * block.conv2b.reach(),
+                                    block.conv2b.filters), dtype=block.conv2b.compute_dtype))
+              for block in blocks]
+
+    @tf.function
+    def step(i, j):
+        x = stem.call_at(canvas, i, j)
+        for block, cache in zip(blocks, caches):
+            x = block.call_at(x, cache, i, j)
+
+        x = x[:, None, None, :]
+        for layer in head:
+            x = layer(x)
+        return x[:, 0, 0, :]
+
+    # Fill the caches with the activations of the pixels that are already known
+    for i in range(start_row):
+        for j in range(width):
+            step(tf.constant(i), tf.constant(j))
+
+    for i in range(start_row, height):
+        for j in range(width):
+            logits = step(tf.constant(i), tf.constant(j))
+            next_sample = tf.random.categorical(logits, 1)
+            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+            canvas[:, i + pad, j + pad, 0].assign(samples[:, i, j, 0])
+        yield i, samples[:, i]
+
+
+def queue_sample(pixelcnn, samples, q_levels, start_row=0):
+    """Generate pixels in raster order keeping only the activations that are still needed.
+
+    Works as `cached_sample`, but the input of every masked convolution is pushed to a
+    circular queue as in Fast WaveNet [1] instead of being kept for the whole image. A
+    convolution with dilation d and kernel size k only reads the last d * (k // 2) rows,
+    so its queue holds `MaskedConv2D.queue_size(W)` positions, and every step gathers the
+    unmasked taps of each layer from its queue. The cost of a step does not depend on the
+    position, so generation is linear in the number of pixels, and the memory of the
+    caches grows with the dilation rates instead of the image height. The random draws
+    are the same as in `cached_sample`, so both functions generate the same images for a
+    fixed seed.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+
+    Refs:
+    [1] - Paine, T. L., Khorrami, P., Chang, S., Zhang, Y., Ramachandran, P.,
+    Hasegawa-Johnson, M. A., & Huang, T. S. (2016). Fast wavenet generation algorithm.
+    arXiv preprint arXiv:1611.09482.
+    """
+    for _ in queue_sample_rows(pixelcnn, samples, q_levels, start_row):
+        pass
+    return samples
+
+
+def queue_sample_rows(pixelcnn, samples, q_levels, start_row=0):
+    """Generator version of `queue_sample`, yielding the rows as `cached_sample_rows`."""
+    layers = [layer for layer in pixelcnn.layers if not isinstance(layer, keras.layers.InputLayer)]
+    stem = layers[0]
+    blocks = [layer for layer in layers if isinstance(layer, ResidualBlock)]
+    head = layers[1 + len(blocks):]
+
+    n_samples, height, width, n_channel = samples.shape
+    stem_queue = tf.Variable(tf.zeros((stem.queue_size(width), n_samples, n_channel)))
+    queues = [tf.Variable(tf.zeros((block.conv2b.queue_size(width), n_samples, block.conv2b.filters),
+                                   dtype=block.conv2b.compute_dtype))
+              for block in blocks]
+
+    @tf.function
+    def step(i, j):
+        x = stem.call_queue(stem_queue, i, j, width)
+        for block, queue in zip(blocks, queues):
+            x = block.call_queue(x, queue, i, j, width)
+
+        x = x[:, None, None, :]
+        for layer in head:
+            x = layer(x)
+        return x[:, 0, 0, :]
+
+    for i in range(height):
+        for j in range(width):
+            logits = step(tf.constant(i), tf.constant(j))
+            if i >= start_row:
+                next_sample = tf.random.categorical(logits, 1)
+                samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+
+            # With mask A the stem only reads (i, j) once it is known
+            stem_queue[(i * width + j) % stem_queue.shape[0]].assign(samples[:, i, j, :])
+
+        if i >= start_row:
+            yield i, samples[:, i]
+
 
 def quantise(images, q_levels):
     """Quantise image into q levels."""
@@ -133,6 +465,12 @@ def main():
     np.random.seed(random_seed)
     rn.seed(random_seed)
 
+    # ------------------------------------------------------------------------------------
+    # Computing the activations in bfloat16, with the weights, logits and loss in float32
+    mixed_precision = False
+    if mixed_precision:
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
     # ------------------------------------------------------------------------------------
     # Loading data
     (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
@@ -170,26 +508,18 @@ def main():
 
     # ------------------------------------------------------------------------------------
     # Create PixelCNN model
-    inputs = keras.layers.Input(shape=(height, width, n_channel))
-    x = MaskedConv2D(mask_type='A', filters=128, kernel_size=7, strides=1)(inputs)
-
-    for i in range(15):
-        x = ResidualBlock(h=64)(x)
-
-    x = keras.layers.Activation(activation='relu')(x)
-    x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
-    x = keras.layers.Activation(activation='relu')(x)
-    x = keras.layers.Conv2D(filters=q_levels, kernel_size=1, strides=1)(x)
-
-    pixelcnn = keras.Model(inputs=inputs, outputs=x)
+    pixelcnn = build_pixelcnn(height, width, n_channel, q_levels)
 
     # ------------------------------------------------------------------------------------
     # Prepare optimizer and loss function
     lr_decay = 0.999995
     learning_rate = 1e-3
-    optimizer = keras.optimizers.Adam(lr=learning_rate)
+    # The learning rate is multiplied by lr_decay after every step
+    lr_schedule = keras.optimizers.schedules.ExponentialDecay(learning_rate, decay_steps=1, decay_rate=lr_decay)
+    optimizer = keras.optimizers.Adam(learning_rate=lr_schedule)
 
-    compute_loss = keras.losses.CategoricalCrossentropy(from_logits=True)
+    # The targets stay integers, without a one-hot copy of the batch
+    compute_loss = keras.losses.SparseCategoricalCrossentropy(from_logits=True)
 
     # ------------------------------------------------------------------------------------
     @tf.function
@@ -197,7 +527,7 @@ def main():
         with tf.GradientTape() as ae_tape:
             logits = pixelcnn(batch_x, training=True)
 
-            loss = compute_loss(tf.squeeze(tf.one_hot(batch_y, q_levels)), logits)
+            loss = compute_loss(batch_y, logits)
 
         gradients = ae_tape.gradient(loss, pixelcnn.trainable_variables)
         gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
@@ -214,11 +544,14 @@ def main():
         print('Epoch {:}/{:}'.format(epoch + 1, n_epochs))
 
         for i_iter, (batch_x, batch_y) in enumerate(train_dataset):
-            optimizer.lr = optimizer.lr * lr_decay
             loss = train_step(batch_x, batch_y)
 
             progbar.add(1, values=[('loss', loss)])
 
+    # ------------------------------------------------------------------------------------
+    # Saving the weights, so the model can be sampled by sharded_sampling.py
+    pixelcnn.save_weights('pixelcnn.h5')
+
     # ------------------------------------------------------------------------------------
     # Test set performance
     test_loss = []
@@ -226,7 +559,7 @@ def main():
         logits = pixelcnn(batch_x, training=False)
 
         # Calculate cross-entropy (= negative log-likelihood)
-        loss = compute_loss(tf.squeeze(tf.one_hot(batch_y, q_levels)), logits)
+        loss = compute_loss(batch_y, logits)
 
         test_loss.append(loss)
     print('nll : {:} nats'.format(np.array(test_loss).mean()))
@@ -235,11 +568,7 @@ def main():
     # ------------------------------------------------------------------------------------
     # Generating new images
     samples = np.zeros((100, height, width, n_channel), dtype='float32')
-    for i in range(height):
-        for j in range(width):
-            logits = pixelcnn(samples)
-            next_sample = tf.random.categorical(logits[:, i, j, :], 1)
-            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+    samples = cached_sample(pixelcnn, samples, q_levels)
 
     fig = plt.figure(figsize=(10, 10))
     for i in range(100):
@@ -265,19 +594,20 @@ def main():
         plt.xticks(np.array([]))
         plt.yticks(np.array([]))
 
-    for i in range(occlude_start_row, height):
-        for j in range(width):
-            logits = pixelcnn(samples)
-            next_sample = tf.random.categorical(logits[:, i, j, :], 1)
-            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
-
+    # The figure is redrawn as soon as each row is generated
     fig = plt.figure(figsize=(10, 10))
 
+    images = []
     for i in range(10):
         ax = fig.add_subplot(1, 10, i + 1)
-        ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
+        images.append(ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary, vmin=0, vmax=1))
         plt.xticks(np.array([]))
         plt.yticks(np.array([]))
+
+    for _ in cached_sample_rows(pixelcnn, samples, q_levels, start_row=occlude_start_row):
+        for i, image in enumerate(images):
+            image.set_data(samples[i, :, :, 0])
+        plt.pause(0.001)
     plt.show()
 
 
@@ -0,0 +1,117 @@
+"""Script to sample many images from a trained pixelCNN with several processes.
+
+A large sampling job is split into shards of `shard_size` images. Every worker process
+builds the model once, with a fixed number of TensorFlow threads so that the workers do
+not compete for the cores, and samples one shard at a time with `queue_sample`. Every
+shard has its own seed, derived from the seed of the job and the index of the shard, so
+the images only depend on the seed and the shard size, not on the number of workers or on
+the order in which the shards are sampled. The workers write the quantised images as uint8
+values straight into one memory-mapped `.npy` file, so no image is sent between processes.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import tensorflow as tf
+
+from pixelCNN import build_pixelcnn, queue_sample
+
+# Model of the worker process, built once by `_init_worker`
+_pixelcnn = None
+
+
+def _init_worker(shape, q_levels, dilation_rates, weights, n_threads):
+    global _pixelcnn
+
+    # The thread pools must be set before TensorFlow runs its first operation
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    height, width, n_channel = shape
+    _pixelcnn = build_pixelcnn(height, width, n_channel, q_levels, dilation_rates=dilation_rates)
+    if weights is not None:
+        _pixelcnn.load_weights(weights)
+
+
+def _sample_shard(path, start, stop, q_levels, seed):
+    tf.random.set_seed(seed)
+
+    images = np.load(path, mmap_mode='r+')
+    samples = np.zeros((stop - start,) + images.shape[1:], dtype='float32')
+    samples = queue_sample(_pixelcnn, samples, q_levels)
+
+    images[start:stop] = np.rint(samples * (q_levels - 1)).astype('uint8')
+    images.flush()
+
+
+def sharded_sample(path, n_images, shape, q_levels, seed, n_workers=None, shard_size=10, n_threads=1,
+                   weights=None, dilation_rates=None):
+    """Generate images with a pool of worker processes, one shard of images at a time.
+
+    Arguments:
+    path: path of the `.npy` file that receives the quantised images, as uint8 values with
+        shape [n_images, H, W, C].
+    n_images: number of images to generate.
+    shape: tuple (height, width, n_channel) of the images.
+    q_levels: number of quantisation levels, at most 256.
+    seed: seed of the job. The shard k is sampled with the seed `seed + k`.
+    n_workers: number of worker processes. By default the cores are split between workers
+        with `n_threads` threads each.
+    shard_size: number of images sampled together by a worker.
+    n_threads: number of TensorFlow intra-op threads of each worker.
+    weights: path of the weights saved by `pixelCNN.py`, None for an untrained model.
+    dilation_rates: dilation rates of the model, as in `build_pixelcnn`.
+
+    Returns:
+    The quantised images, memory-mapped read-only.
+    """
+    assert q_levels <= 256
+    if n_workers is None:
+        n_workers = max(os.cpu_count() // n_threads, 1)
+
+    images = np.lib.format.open_memmap(path, mode='w+', dtype='uint8', shape=(n_images,) + tuple(shape))
+    images.flush()
+    del images
+
+    shards = [(start, min(start + shard_size, n_images)) for start in range(0, n_images, shard_size)]
+
+    # TensorFlow does not support fork, so the workers start from a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(shape, q_levels, dilation_rates, weights, n_threads)) as executor:
+        futures = [executor.submit(_sample_shard, path, start, stop, q_levels, seed + k)
+                   for k, (start, stop) in enumerate(shards)]
+        for future in futures:
+            future.result()
+
+    return np.load(path, mmap_mode='r')
+
+
+def main():
+    # ------------------------------------------------------------------------------------
+    # Sampling the pixelCNN trained by pixelCNN.py with one worker per core
+    random_seed = 42
+    height = 28
+    width = 28
+    n_channel = 1
+    q_levels = 2
+
+    samples = sharded_sample('samples.npy', 100, (height, width, n_channel), q_levels, random_seed,
+                             shard_size=10, n_threads=1, weights='pixelcnn.h5')
+
+    fig = plt.figure(figsize=(10, 10))
+    for i in range(100):
+        ax = fig.add_subplot(10, 10, i + 1)
+        ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 """Script to train pixelCNN on multichannel data."""
+import os
 import random as rn
-import time
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,11 +9,30 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.utils import Progbar
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dataset_cache import load_quantised
+from input_pipeline import build_pipeline
+from losses import nll
+from sampling import generate_with_channel_head
+from trainer import MultiStepTrainer, exponential_decay
+
 
 class MaskedConv2D(tf.keras.layers.Layer):
     """Convolutional layers with masks for autoregressive models
 
-    Convolutional layers with simple implementation to have masks type A and B.
+    Convolutional layers with simple implementation to have masks type A and B. The
+    channels of the input and of the output are split in `input_n_channels` groups
+    (channel c belongs to group c % input_n_channels), one per colour channel in the
+    R -> G -> B order as in PixelRNN [1]. At the centre of the kernel, output group j sees
+    the input groups before j with mask A, and the input groups up to j with mask B. With
+    `input_n_channels=1` they are the usual spatial masks, where mask A hides the whole
+    centre pixel. With `channel_major_output=True` the output channels are split in
+    contiguous groups instead (channel c belongs to group c // (filters // input_n_channels)),
+    as the output layer of a head whose logits are ordered as [C, D].
+
+    Refs:
+    [1] - Oord, A. V. D., Kalchbrenner, N., & Kavukcuoglu, K. (2016). Pixel recurrent
+    neural networks. arXiv preprint arXiv:1601.06759.
     """
 
     def __init__(self,
@@ -23,7 +43,8 @@ class MaskedConv2D(tf.keras.layers.Layer):
                  padding='same',
                  kernel_initializer='glorot_uniform',
                  bias_initializer='zeros',
-                 input_n_channels=3):
+                 input_n_channels=3,
+                 channel_major_output=False):
         super(MaskedConv2D, self).__init__()
 
         assert mask_type in {'A', 'B'}
@@ -36,6 +57,7 @@ class MaskedConv2D(tf.keras.layers.Layer):
         self.kernel_initializer = keras.initializers.get(kernel_initializer)
         self.bias_initializer = keras.initializers.get(bias_initializer)
         self.input_n_channels = input_n_channels
+        self.channel_major_output = channel_major_output
 
     def build(self, input_shape):
         self.kernel = self.add_weight("kernel",
@@ -57,10 +79,17 @@ class MaskedConv2D(tf.keras.layers.Layer):
         mask[center, center + 1:, :, :] = 0.
         mask[center + 1:, :, :, :] = 0.
 
-        for i in range(self.input_n_channels):
-            for j in range(self.input_n_channels):
-                if (self.mask_type == 'A' and i >= j) or (self.mask_type == 'B' and i > j):
-                    mask[center, center, i::self.input_n_channels, j::self.input_n_channels] = 0.
+        input_groups = np.arange(mask.shape[2]) % self.input_n_channels
+        if self.channel_major_output:
+            output_groups = np.arange(self.filters) // (self.filters // self.input_n_channels)
+        else:
+            output_groups = np.arange(self.filters) % self.input_n_channels
+
+        if self.mask_type == 'A':
+            hidden = input_groups[:, None] >= output_groups[None, :]
+        else:
+            hidden = input_groups[:, None] > output_groups[None, :]
+        mask[center, center][hidden] = 0.
 
         self.mask = tf.constant(mask, dtype=tf.float32, name='mask')
 
@@ -87,7 +116,7 @@ class ResidualBlock(tf.keras.Model):
         super(ResidualBlock, self).__init__(name='')
 
         self.conv2a = keras.layers.Conv2D(filters=h, kernel_size=1, strides=1)
-        self.conv2b = MaskedConv2D(mask_type='B', filters=h, kernel_size=3, strides=1)
+        self.conv2b = MaskedConv2D(mask_type='B', filters=h, kernel_size=3, strides=1, input_n_channels=1)
         self.conv2c = keras.layers.Conv2D(filters=2 * h, kernel_size=1, strides=1)
 
     def call(self, input_tensor):
@@ -104,6 +133,37 @@ class ResidualBlock(tf.keras.Model):
         return x
 
 
+class ChannelHead(tf.keras.Model):
+    """Output head that emits the distributions of all the channels of a pixel
+
+    The distribution of each channel is conditioned on the features of the trunk, which only
+    see the previous pixels, and on the channels of the same pixel that come before it
+    (R -> G -> B) through 1x1 convolutions with channel masks. The trunk is evaluated once
+    per pixel and only this head is evaluated again for each channel.
+    """
+
+    def __init__(self, h, q_levels, n_channel):
+        super(ChannelHead, self).__init__(name='')
+
+        self.features_conv = keras.layers.Conv2D(filters=h, kernel_size=1, strides=1)
+        self.pixel_conv = MaskedConv2D(mask_type='A', filters=h, kernel_size=1, input_n_channels=n_channel)
+        self.hidden_conv = MaskedConv2D(mask_type='B', filters=h, kernel_size=1, input_n_channels=n_channel)
+        self.output_conv = MaskedConv2D(mask_type='B', filters=n_channel * q_levels, kernel_size=1,
+                                        input_n_channels=n_channel, channel_major_output=True)
+
+    def call(self, input_tensor):
+        features, pixels = input_tensor
+
+        x = self.features_conv(tf.nn.relu(features)) + self.pixel_conv(pixels)
+
+        x = tf.nn.relu(x)
+        x = self.hidden_conv(x)
+
+        x = tf.nn.relu(x)
+        x = self.output_conv(x)  # shape [N,H,W,CD]
+        return x
+
+
 def quantise(images, q_levels):
     """Quantise image into q levels"""
     return (np.digitize(images, np.arange(q_levels) / q_levels) - 1).astype('float32')
@@ -119,52 +179,33 @@ np.random.seed(random_seed)
 rn.seed(random_seed)
 
 # --------------------------------------------------------------------------------------------------------------
-# Loading data
-(x_train, y_train), (x_test, y_test) = tf.keras.datasets.cifar10.load_data()
-
+# Loading data quantised in q levels (uint8, cached by dataset_cache.py)
 height = 32
 width = 32
 n_channel = 3
 
-x_train = x_train.astype('float32') / 255.
-x_test = x_test.astype('float32') / 255.
-
-x_train = x_train.reshape(x_train.shape[0], height, width, n_channel)
-x_test = x_test.reshape(x_test.shape[0], height, width, n_channel)
-
-# --------------------------------------------------------------------------------------------------------------
-# Quantise the input data in q levels
 q_levels = 64
-x_train_quantised = quantise(x_train, q_levels)
-x_test_quantised = quantise(x_test, q_levels)
+(x_train_quantised, y_train), (x_test_quantised, y_test) = load_quantised('cifar10', q_levels)
 
 # --------------------------------------------------------------------------------------------------------------
 # Creating input stream using tf.data API
 batch_size = 256
-train_buf = 20000
 
-train_dataset = tf.data.Dataset.from_tensor_slices((x_train_quantised / (q_levels - 1),
-                                                    x_train_quantised.astype('int32')))
-train_dataset = train_dataset.shuffle(buffer_size=train_buf)
-train_dataset = train_dataset.batch(batch_size)
-
-test_dataset = tf.data.Dataset.from_tensor_slices((x_test_quantised / (q_levels - 1),
-                                                   x_test_quantised.astype('int32')))
-test_dataset = test_dataset.batch(batch_size)
+train_dataset = build_pipeline(x_train_quantised, q_levels, batch_size, seed=random_seed)
+test_dataset = build_pipeline(x_test_quantised, q_levels, batch_size, shuffle=False)
 
 # --------------------------------------------------------------------------------------------------------------
 # Create PixelCNN model
 inputs = keras.layers.Input(shape=(height, width, n_channel))
-x = MaskedConv2D(mask_type='A', filters=128, kernel_size=7, strides=1)(inputs)
+x = MaskedConv2D(mask_type='A', filters=128, kernel_size=7, strides=1, input_n_channels=1)(inputs)
 
 for i in range(15):
     x = ResidualBlock(h=64)(x)
 
-x = keras.layers.Activation(activation='relu')(x)
-x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
-x = keras.layers.Activation(activation='relu')(x)
-x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
-x = keras.layers.Conv2D(filters=n_channel * q_levels, kernel_size=1, strides=1)(x)  # shape [N,H,W,DC]
+trunk = tf.keras.Model(inputs=inputs, outputs=x)
+
+head = ChannelHead(h=128, q_levels=q_levels, n_channel=n_channel)
+x = head([x, inputs])  # shape [N,H,W,CD]
 
 pixelcnn = tf.keras.Model(inputs=inputs, outputs=x)
 
@@ -172,68 +213,41 @@ pixelcnn = tf.keras.Model(inputs=inputs, outputs=x)
 # Prepare optimizer and loss function
 lr_decay = 0.99995
 learning_rate = 1e-2
-optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
+optimizer = tf.keras.optimizers.Adam(learning_rate=exponential_decay(learning_rate, lr_decay))
 
-compute_loss = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
 
 # --------------------------------------------------------------------------------------------------------------
-@tf.function
-def train_step(batch_x, batch_y):
-    with tf.GradientTape() as ae_tape:
-        logits = pixelcnn(batch_x, training=True)
-
-        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])  # shape [N,H,W,DC] -> [N,H,W,D,C]
-        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])  # shape [N,H,W,D,C] -> [N,H,W,C,D]
-
-        loss = compute_loss(tf.one_hot(batch_y, q_levels), logits)
+def batch_loss(batch_x, batch_y):
+    logits = pixelcnn(batch_x, training=True)  # shape [N,H,W,CD]
+    return nll(batch_y, logits)
 
-    gradients = ae_tape.gradient(loss, pixelcnn.trainable_variables)
-    gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
-    optimizer.apply_gradients(zip(gradients, pixelcnn.trainable_variables))
 
-    return loss
+trainer = MultiStepTrainer(pixelcnn, optimizer, batch_loss, steps_per_call=50, clip_norm=1.0, measure_wait=True)
 
 # --------------------------------------------------------------------------------------------------------------
 # Training loop
 n_epochs = 150
 n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
 for epoch in range(n_epochs):
-    progbar = Progbar(n_iter)
+    progbar = Progbar(n_iter, stateful_metrics=['loss'])
     print('Epoch {:}/{:}'.format(epoch + 1, n_epochs))
 
-    for i_iter, (batch_x, batch_y) in enumerate(train_dataset):
-        start = time.time()
-        optimizer.lr = optimizer.lr * lr_decay
-        loss = train_step(batch_x, batch_y)
-
-        progbar.add(1, values=[("loss", loss)])
+    for i_iter, loss in trainer.epoch(train_dataset):
+        progbar.update(i_iter, values=[("loss", loss)])
+    print('Data wait: {:.1%} of the epoch'.format(trainer.wait_fraction))
 # # --------------------------------------------------------------------------------------------------------------
 # # Test
 # test_loss = []
 # for batch_x, batch_y in test_dataset:
 #     logits = pixelcnn(batch_x, training=False)
-#     logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
-#     logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
 #
 #     # Calculate cross-entropy (= negative log-likelihood)
-#     loss = compute_loss(tf.one_hot(batch_y, q_levels), logits)
-#
-#     test_loss.append(loss)
-# print('nll : {:} nats'.format(np.array(test_loss).mean()))
-# print('bits/dim : {:}'.format(np.array(test_loss).mean() / (height * width)))
+#     test_loss.append(nll(batch_y, logits))
+# print(nll_report(np.mean(test_loss)))
 
 # --------------------------------------------------------------------------------------------------------------
 # Generating new images
-samples = np.zeros((10, height, width, n_channel)) + 0.5 * np.random.rand(10, height, width, n_channel)
-
-for i in range(height):
-    for j in range(width):
-        for k in range(n_channel):
-            logits = pixelcnn(samples)
-            logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
-            logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
-            next_sample = tf.random.categorical(logits[:, i, j, k, :], 1)
-            samples[:, i, j, k] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+samples = generate_with_channel_head(trunk, head, (height, width, n_channel), 10, random_seed)
 
 fig = plt.figure(figsize=(10, 10))
 for i in range(9):
@@ -247,18 +261,12 @@ plt.show()
 # Generating new images
 occlude_start_row = 14
 num_generated_images = 1
-samples = np.copy(x_train_quantised[:10, :, :, :])
+samples = x_train_quantised[:10, :, :, :].astype('float32')
 samples = samples / (q_levels - 1)
 samples[:, occlude_start_row:, :, :] = 0
 
-for i in range(occlude_start_row, height):
-    for j in range(width):
-        for k in range(n_channel):
-            logits = pixelcnn(samples)
-            logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
-            logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
-            next_sample = tf.random.categorical(logits[:, i, j, k, :], 1)
-            samples[:, i, j, k] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+samples = generate_with_channel_head(trunk, head, (height, width, n_channel), 10, random_seed,
+                                     samples=samples, start_row=occlude_start_row)
 
 fig = plt.figure(figsize=(10, 10))
 for i in range(9):
@@ -1,5 +1,7 @@
 """Script to train Gated pixelCNN on the MNIST dataset."""
+import os
 import random as rn
+import sys
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -10,13 +12,20 @@ from tensorflow import nn
 from tensorflow.keras import initializers
 from tensorflow.keras.utils import Progbar
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dataset_cache import load_quantised
+from input_pipeline import build_pipeline
+from losses import nll, nll_report
+from trainer import MultiStepTrainer, exponential_decay
+
 
 class MaskedConv2D(keras.layers.Layer):
     """Convolutional layers with masks extended to work with Gated PixelCNN.
 
     Convolutional layers with simple implementation of masks type A and B for
     autoregressive models. Extended version to work with the verticala and horizontal
-    stacks from the Gated PixelCNN model.
+    stacks from the Gated PixelCNN model. The mask is kept in the compute dtype of the
+    layer, so it also applies under a mixed precision policy.
 
     Arguments:
     mask_type: one of `"V"`, `"A"` or `"B".`
@@ -31,6 +40,9 @@ class MaskedConv2D(keras.layers.Layer):
         Specifying any stride value != 1 is incompatible with specifying any
         `dilation_rate` value != 1.
     padding: one of `"valid"` or `"same"` (case-insensitive).
+    dilation_rate: An integer, the spacing between the kernel taps along the height and
+        width. Dilated kernels must have odd dimensions, so their centre stays on the
+        output position.
     kernel_initializer: Initializer for the `kernel` weights matrix.
     bias_initializer: Initializer for the bias vector.
     """
@@ -41,6 +53,7 @@ class MaskedConv2D(keras.layers.Layer):
                  kernel_size,
                  strides=1,
                  padding='same',
+                 dilation_rate=1,
                  kernel_initializer='glorot_uniform',
                  bias_initializer='zeros'):
         super(MaskedConv2D, self).__init__()
@@ -54,8 +67,11 @@ class MaskedConv2D(keras.layers.Layer):
             kernel_size = (kernel_size, kernel_size)
         self.kernel_size = kernel_size
 
+        assert strides == 1 or dilation_rate == 1
+        assert dilation_rate == 1 or (kernel_size[0] % 2 == 1 and kernel_size[1] % 2 == 1)
         self.strides = strides
         self.padding = padding.upper()
+        self.dilation_rate = dilation_rate
         self.kernel_initializer = initializers.get(kernel_initializer)
         self.bias_initializer = initializers.get(bias_initializer)
 
@@ -95,32 +111,85 @@ class MaskedConv2D(keras.layers.Layer):
             mask[center_h, center_w + (self.mask_type == 'B'):, :, :] = 0.
             mask[center_h + 1:, :, :] = 0.
 
-        self.mask = tf.constant(mask, dtype=tf.float32, name='mask')
+        self.mask = tf.constant(mask, dtype=self.compute_dtype, name='mask')
+
+    def masked_kernel(self):
+        # `call_row` and `call_at` run outside __call__, where Keras does not cast the
+        # variables to the compute dtype
+        return tf.math.multiply(self.mask, tf.cast(self.kernel, self.compute_dtype))
 
     def call(self, input):
-        masked_kernel = tf.math.multiply(self.mask, self.kernel)
+        masked_kernel = self.masked_kernel()
         x = nn.conv2d(input,
                       masked_kernel,
                       strides=[1, self.strides, self.strides, 1],
-                      padding=self.padding)
+                      padding=self.padding,
+                      dilations=self.dilation_rate)
         x = nn.bias_add(x, self.bias)
         return x
 
+    def call_row(self, padded_input, i):
+        """Compute the output of the layer on the single row i.
+
+        Arguments:
+        padded_input: input of the layer zero padded as done by the `"same"` padding, so
+            the window centred on row i starts at row i.
+        i: row of the output.
+        """
+        kernel_h, kernel_w = self.kernel_size
+        rows = padded_input[:, i:i + (kernel_h - 1) * self.dilation_rate + 1, :, :]
+        x = nn.conv2d(tf.cast(rows, self.compute_dtype),
+                      self.masked_kernel(),
+                      strides=[1, 1, 1, 1],
+                      padding='VALID',
+                      dilations=self.dilation_rate)
+        x = nn.bias_add(x, tf.cast(self.bias, self.compute_dtype))
+        return x[:, 0, :, :]
+
+    def call_at(self, padded_input, i, j):
+        """Compute the output of the layer at the single position (i, j).
+
+        Arguments:
+        padded_input: input of the layer zero padded as done by the `"same"` padding, so
+            the window centred on (i, j) starts at (i, j).
+        i, j: row and column of the output position.
+        """
+        kernel_h, kernel_w = self.kernel_size
+        d = self.dilation_rate
+        patch = padded_input[:, i:i + (kernel_h - 1) * d + 1:d, j:j + (kernel_w - 1) * d + 1:d, :]
+        x = tf.tensordot(tf.cast(patch, self.compute_dtype), self.masked_kernel(), axes=3)
+        x = nn.bias_add(x, tf.cast(self.bias, self.compute_dtype))
+        return x
+
+    def same_padding(self):
+        """Paddings [[top, bottom], [left, right]] applied by the `"same"` padding."""
+        kernel_h, kernel_w = self.kernel_size
+        pad_h = (kernel_h - 1) * self.dilation_rate
+        pad_w = (kernel_w - 1) * self.dilation_rate
+        return [[pad_h // 2, pad_h - pad_h // 2], [pad_w // 2, pad_w - pad_w // 2]]
+
 
 class GatedBlock(keras.Model):
-    """ Gated block that compose Gated PixelCNN."""
+    """ Gated block that compose Gated PixelCNN.
 
-    def __init__(self, mask_type, filters, kernel_size):
+    With `dilation_rate` > 1 both stacks use dilated convolutions, so the vertical stack
+    reaches `dilation_rate * (kernel_size // 2)` rows up and the horizontal stack as many
+    columns to the left.
+    """
+
+    def __init__(self, mask_type, filters, kernel_size, dilation_rate=1):
         super(GatedBlock, self).__init__(name='')
 
         self.mask_type = mask_type
         self.vertical_conv = MaskedConv2D(mask_type='V',
                                           filters=2 * filters,
-                                          kernel_size=kernel_size)
+                                          kernel_size=kernel_size,
+                                          dilation_rate=dilation_rate)
 
         self.horizontal_conv = MaskedConv2D(mask_type=mask_type,
                                             filters=2 * filters,
-                                            kernel_size=(1, kernel_size))
+                                            kernel_size=(1, kernel_size),
+                                            dilation_rate=dilation_rate)
 
         self.padding = keras.layers.ZeroPadding2D(padding=((1, 0), 0))
         self.cropping = keras.layers.Cropping2D(cropping=((0, 1), 0))
@@ -160,169 +229,331 @@ class GatedBlock(keras.Model):
 
         return v_out, h_out
 
+    def vertical_row(self, v_cache, i):
+        """Compute the vertical stack on the single row i.
 
-def quantise(images, q_levels):
-    """Quantise image into q levels"""
-    return (np.digitize(images, np.arange(q_levels) / q_levels) - 1).astype('float32')
+        Arguments:
+        v_cache: input of the vertical stack padded as in `MaskedConv2D.same_padding`.
+        i: row of the output.
 
+        Returns:
+        The output of the vertical stack on row i and the contribution of row i to the
+        horizontal stack of row i + 1.
+        """
+        vertical_preactivation = self.vertical_conv.call_row(v_cache, i)
 
-# def main():
-# ------------------------------------------------------------------------------------
-# Defining random seeds
-random_seed = 42
-tf.random.set_seed(random_seed)
-np.random.seed(random_seed)
-rn.seed(random_seed)
+        v_to_h = self.v_to_h_conv(vertical_preactivation[:, None, :, :])[:, 0, :, :]
+        v_out = self._gate(vertical_preactivation)
+        return v_out, v_to_h
+
+    def horizontal_at(self, h, h_cache, v_to_h, i, j):
+        """Compute the horizontal stack at the single position (i, j).
+
+        Arguments:
+        h: input of the horizontal stack at (i, j), with shape [N, C].
+        h_cache: tf.Variable holding the input of the horizontal stack padded as in
+            `MaskedConv2D.same_padding`. `h` is written to it before the convolution.
+        v_to_h: contribution of the vertical stack at (i, j), with shape [N, 2 * filters].
+        i, j: row and column of the output position.
+        """
+        (top, _), (left, _) = self.horizontal_conv.same_padding()
+        h_cache[:, i + top, j + left, :].assign(h)
+        horizontal_preactivation = self.horizontal_conv.call_at(h_cache, i, j)
 
-# ------------------------------------------------------------------------------------
-# Loading data
-(x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
+        horizontal_preactivation = horizontal_preactivation + v_to_h
+        h_activated = self._gate(horizontal_preactivation)
+        h_activated = self.horizontal_output(h_activated[:, None, None, :])[:, 0, 0, :]
 
-height = 28
-width = 28
-n_channel = 1
+        if self.mask_type == 'A':
+            h_out = h_activated
+        elif self.mask_type == 'B':
+            h_out = h + h_activated
 
-x_train = x_train.astype('float32') / 255.
-x_test = x_test.astype('float32') / 255.
+        return h_out
 
-x_train = x_train.reshape(x_train.shape[0], height, width, n_channel)
-x_test = x_test.reshape(x_test.shape[0], height, width, n_channel)
 
-# ------------------------------------------------------------------------------------
-# Quantise the input data in q levels
-q_levels = 2
-x_train_quantised = quantise(x_train, q_levels)
-x_test_quantised = quantise(x_test, q_levels)
+def build_gated_pixelcnn(height, width, n_channel, q_levels, dilation_rates=None):
+    """Create the Gated PixelCNN model with a mask A block and 10 mask B blocks.
 
-# ------------------------------------------------------------------------------------
-# Creating input stream using tf.data API
-batch_size = 256
-train_buf = 60000
+    With `dilation_rates`, the model has one mask B block per entry instead, with its
+    convolutions dilated by that rate. The output layer computes in float32 whatever the
+    global dtype policy, so the logits and the loss are float32 under 'mixed_bfloat16'.
+    """
+    if dilation_rates is None:
+        dilation_rates = [1] * 10
 
-train_dataset = tf.data.Dataset.from_tensor_slices(
-    (x_train_quantised / (q_levels - 1),
-     x_train_quantised.astype('int32'))
-)
-train_dataset = train_dataset.shuffle(buffer_size=train_buf)
-train_dataset = train_dataset.batch(batch_size)
+    inputs = keras.layers.Input(shape=(height, width, n_channel))
+    v, h = GatedBlock(mask_type='A', filters=64, kernel_size=3)([inputs, inputs])
 
-test_dataset = tf.data.Dataset.from_tensor_slices((x_test_quantised / (q_levels - 1),
-                                                   x_test_quantised.astype('int32')))
-test_dataset = test_dataset.batch(batch_size)
+    for dilation_rate in dilation_rates:
+        v, h = GatedBlock(mask_type='B', filters=64, kernel_size=3, dilation_rate=dilation_rate)([v, h])
 
-# ------------------------------------------------------------------------------------
-# Create Gated PixelCNN model
-inputs = keras.layers.Input(shape=(height, width, n_channel))
-v, h = GatedBlock(mask_type='A', filters=64, kernel_size=3)([inputs, inputs])
+    x = keras.layers.Activation(activation='relu')(h)
+    x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
+    x = keras.layers.Activation(activation='relu')(x)
+    x = keras.layers.Conv2D(filters=q_levels, kernel_size=1, strides=1, dtype='float32')(x)
 
-for i in range(10):
-    v, h = GatedBlock(mask_type='B', filters=64, kernel_size=3)([v, h])
+    return keras.Model(inputs=inputs, outputs=x)
 
-x = keras.layers.Activation(activation='relu')(h)
-x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
-x = keras.layers.Activation(activation='relu')(x)
-x = keras.layers.Conv2D(filters=q_levels, kernel_size=1, strides=1)(x)
 
-gated_pixelcnn = keras.Model(inputs=inputs, outputs=x)
+def receptive_field_rows(gated_pixelcnn):
+    """Number of rows above a pixel that can influence the output of the model at it."""
+    blocks = [layer for layer in gated_pixelcnn.layers if isinstance(layer, GatedBlock)]
 
-# ------------------------------------------------------------------------------------
-# Prepare optimizer and loss function
-lr_decay = 0.999
-learning_rate = 1e-3
-optimizer = keras.optimizers.Adam(lr=learning_rate)
+    # Each vertical convolution looks at the rows above up to its centre and the vertical
+    # stack is shifted down by one row before being fed to the horizontal stack
+    rows = 1
+    for block in blocks:
+        (top, _), _ = block.vertical_conv.same_padding()
+        rows += top
+    return rows
 
-compute_loss = keras.losses.CategoricalCrossentropy(from_logits=True)
 
+def cropped_sample(gated_pixelcnn, samples, q_levels, start_row=0):
+    """Generate pixels in raster order running the model only on the rows that matter.
 
-# ------------------------------------------------------------------------------------
-@tf.function
-def train_step(batch_x, batch_y):
-    with tf.GradientTape() as ae_tape:
-        logits = gated_pixelcnn(batch_x, training=True)
+    The output at row i only depends on the `receptive_field_rows` rows above it, so
+    every step runs the model on that crop of rows instead of the whole image. The crop
+    starts at the top of the receptive field, so the zero padding of the convolutions
+    reaches row i exactly as in the full image and both paths give the same images for a
+    fixed seed.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+    """
+    layers = [layer for layer in gated_pixelcnn.layers if not isinstance(layer, keras.layers.InputLayer)]
+    blocks = [layer for layer in layers if isinstance(layer, GatedBlock)]
+    head = layers[len(blocks):]
+
+    rows = receptive_field_rows(gated_pixelcnn)
+    height, width = samples.shape[1:3]
+    for i in range(start_row, height):
+        top = max(i - rows, 0)
+        for j in range(width):
+            # The layers are applied one by one since the model only accepts full images
+            v = h = tf.convert_to_tensor(samples[:, top:i + 1])
+            for block in blocks:
+                v, h = block([v, h])
+
+            logits = h
+            for layer in head:
+                logits = layer(logits)
+            next_sample = tf.random.categorical(logits[:, i - top, j, :], 1)
+            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+    return samples
+
+
+def row_sample(gated_pixelcnn, samples, q_levels, start_row=0):
+    """Generate pixels in raster order updating the vertical stack once per row.
+
+    The vertical stack only sees the rows above the current one, so it is computed once
+    at the start of each row and its contribution to the horizontal stack is kept for the
+    whole row. Within the row, the input of every horizontal convolution is cached and
+    each step evaluates the horizontal stack at the single position being sampled. The
+    random draws are the same as in `sampling.sample`, so both functions generate the same
+    images for a fixed seed.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+    """
+    for _ in row_sample_rows(gated_pixelcnn, samples, q_levels, start_row):
+        pass
+    return samples
+
+
+def row_sample_rows(gated_pixelcnn, samples, q_levels, start_row=0):
+    """Same as `row_sample`, but yields (i, samples[:, i]) once row i is generated.
 
-        loss = compute_loss(tf.squeeze(tf.one_hot(batch_y, q_levels)), logits)
-
-    gradients = ae_tape.gradient(loss, gated_pixelcnn.trainable_variables)
-    gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
-    optimizer.apply_gradients(zip(gradients, gated_pixelcnn.trainable_variables))
-
-    return loss
-
-
-# ------------------------------------------------------------------------------------
-# Training loop
-n_epochs = 20
-n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
-for epoch in range(n_epochs):
-    progbar = Progbar(n_iter)
-    print('Epoch {:}/{:}'.format(epoch + 1, n_epochs))
-
-    for i_iter, (batch_x, batch_y) in enumerate(train_dataset):
-        optimizer.lr = optimizer.lr * lr_decay
-        loss = train_step(batch_x, batch_y)
-
-        progbar.add(1, values=[('loss', loss)])
-
-# ------------------------------------------------------------------------------------
-# Test set performance
-test_loss = []
-for batch_x, batch_y in test_dataset:
-    logits = gated_pixelcnn(batch_x, training=False)
-
-    # Calculate cross-entropy (= negative log-likelihood)
-    loss = compute_loss(tf.squeeze(tf.one_hot(batch_y, q_levels)), logits)
-
-    test_loss.append(loss)
-print('nll : {:} nats'.format(np.array(test_loss).mean()))
-print('bits/dim : {:}'.format(np.array(test_loss).mean() / np.log(2)))
-
-# ------------------------------------------------------------------------------------
-# Generating new images
-samples = np.zeros((100, height, width, n_channel), dtype='float32')
-for i in range(height):
-    for j in range(width):
-        logits = gated_pixelcnn(samples)
-        next_sample = tf.random.categorical(logits[:, i, j, :], 1)
-        samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
-
-fig = plt.figure(figsize=(10, 10))
-for i in range(100):
-    ax = fig.add_subplot(10, 10, i + 1)
-    ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
-    plt.xticks(np.array([]))
-    plt.yticks(np.array([]))
-plt.show()
-
-# ------------------------------------------------------------------------------------
-# Filling occluded images
-occlude_start_row = 14
-num_generated_images = 10
-samples = np.copy(x_test_quantised[0:num_generated_images, :, :, :])
-samples = samples / (q_levels - 1)
-samples[:, occlude_start_row:, :, :] = 0
-
-fig = plt.figure(figsize=(10, 10))
-
-for i in range(10):
-    ax = fig.add_subplot(1, 10, i + 1)
-    ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
-    plt.xticks(np.array([]))
-    plt.yticks(np.array([]))
-
-for i in range(occlude_start_row, height):
-    for j in range(width):
-        logits = gated_pixelcnn(samples)
-        next_sample = tf.random.categorical(logits[:, i, j, :], 1)
-        samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
-
-fig = plt.figure(figsize=(10, 10))
-
-for i in range(10):
-    ax = fig.add_subplot(1, 10, i + 1)
-    ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
-    plt.xticks(np.array([]))
-    plt.yticks(np.array([]))
-plt.show()
-
-# if __name__ == '__main__':
-#     main()
+    The rows come in raster order and are final when yielded, so they can be shown or
+    encoded while the rest of the image is generated.
+    """
+    layers = [layer for layer in gated_pixelcnn.layers if not isinstance(layer, keras.layers.InputLayer)]
+    blocks = [layer for layer in layers if isinstance(layer, GatedBlock)]
+    head = layers[len(blocks):]
+
+    n_samples, height, width, n_channel = samples.shape
+
+    def padded_variable(conv, n_filters):
+        (top, bottom), (left, right) = conv.same_padding()
+        return tf.Variable(tf.zeros((n_samples, height + top + bottom, width + left + right, n_filters),
+                                    dtype=conv.compute_dtype))
+
+    v_caches = [padded_variable(block.vertical_conv, block.vertical_conv.kernel.shape[2])
+                for block in blocks]
+    h_caches = [padded_variable(block.horizontal_conv, block.horizontal_conv.kernel.shape[2])
+                for block in blocks]
+    v_to_h = [tf.Variable(tf.zeros((n_samples, width, block.v_to_h_conv.filters),
+                                   dtype=block.v_to_h_conv.compute_dtype))
+              for block in blocks]
+
+    (v_top, _), (v_left, _) = blocks[0].vertical_conv.same_padding()
+    (h_top, _), (h_left, _) = blocks[0].horizontal_conv.same_padding()
+    v_caches[0][:, v_top:v_top + height, v_left:v_left + width, :].assign(tf.cast(samples, v_caches[0].dtype))
+    h_caches[0][:, h_top:h_top + height, h_left:h_left + width, :].assign(tf.cast(samples, h_caches[0].dtype))
+
+    # The vertical stack is shifted down by one row, so row 0 only sees the zero padding
+    for block, v_to_h_row in zip(blocks, v_to_h):
+        zeros = tf.zeros((n_samples, 1, width, block.vertical_conv.filters))
+        v_to_h_row.assign(block.v_to_h_conv(zeros)[:, 0, :, :])
+
+    @tf.function
+    def row_step(i):
+        # Contribution of the vertical stack to row i, computed from row i - 1
+        for k, block in enumerate(blocks):
+            v_out, v_to_h_i = block.vertical_row(v_caches[k], i - 1)
+            v_to_h[k].assign(v_to_h_i)
+            if k + 1 < len(blocks):
+                (top, _), (left, _) = blocks[k + 1].vertical_conv.same_padding()
+                v_caches[k + 1][:, i - 1 + top, left:left + width, :].assign(v_out)
+
+    @tf.function
+    def pixel_step(i, j):
+        h = v_caches[0][:, i + v_top, j + v_left, :]
+        for block, h_cache, v_to_h_row in zip(blocks, h_caches, v_to_h):
+            h = block.horizontal_at(h, h_cache, v_to_h_row[:, j, :], i, j)
+
+        x = h[:, None, None, :]
+        for layer in head:
+            x = layer(x)
+        return x[:, 0, 0, :]
+
+    for i in range(height):
+        if i > 0:
+            row_step(tf.constant(i))
+
+        for j in range(width):
+            logits = pixel_step(tf.constant(i), tf.constant(j))
+            if i < start_row:
+                # Only fill the caches for the pixels that are already known
+                continue
+
+            next_sample = tf.random.categorical(logits, 1)
+            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+            v_caches[0][:, i + v_top, j + v_left, 0].assign(tf.cast(samples[:, i, j, 0], v_caches[0].dtype))
+            h_caches[0][:, i + h_top, j + h_left, 0].assign(tf.cast(samples[:, i, j, 0], h_caches[0].dtype))
+
+        if i >= start_row:
+            yield i, samples[:, i]
+
+
+def quantise(images, q_levels):
+    """Quantise image into q levels"""
+    return (np.digitize(images, np.arange(q_levels) / q_levels) - 1).astype('float32')
+
+
+def main():
+    # ------------------------------------------------------------------------------------
+    # Defining random seeds
+    random_seed = 42
+    tf.random.set_seed(random_seed)
+    np.random.seed(random_seed)
+    rn.seed(random_seed)
+
+    # ------------------------------------------------------------------------------------
+    # Computing the activations in bfloat16, with the weights, logits and loss in float32
+    mixed_precision = False
+    if mixed_precision:
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    # ------------------------------------------------------------------------------------
+    # Loading data quantised in q levels (uint8, cached by dataset_cache.py)
+    height = 28
+    width = 28
+    n_channel = 1
+
+    q_levels = 2
+    (x_train_quantised, y_train), (x_test_quantised, y_test) = load_quantised('mnist', q_levels)
+
+    # ------------------------------------------------------------------------------------
+    # Creating input stream using tf.data API
+    batch_size = 256
+
+    train_dataset = build_pipeline(x_train_quantised, q_levels, batch_size, seed=random_seed)
+    test_dataset = build_pipeline(x_test_quantised, q_levels, batch_size, shuffle=False)
+
+    # ------------------------------------------------------------------------------------
+    # Create Gated PixelCNN model
+    gated_pixelcnn = build_gated_pixelcnn(height, width, n_channel, q_levels)
+
+    # ------------------------------------------------------------------------------------
+    # Prepare optimizer and loss function
+    lr_decay = 0.999
+    learning_rate = 1e-3
+    optimizer = keras.optimizers.Adam(learning_rate=exponential_decay(learning_rate, lr_decay))
+
+    # ------------------------------------------------------------------------------------
+    def batch_loss(batch_x, batch_y):
+        logits = gated_pixelcnn(batch_x, training=True)
+        return nll(batch_y, logits)
+
+    trainer = MultiStepTrainer(gated_pixelcnn, optimizer, batch_loss, steps_per_call=50, clip_norm=1.0,
+                               measure_wait=True)
+
+    # ------------------------------------------------------------------------------------
+    # Training loop
+    n_epochs = 20
+    n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
+    for epoch in range(n_epochs):
+        progbar = Progbar(n_iter, stateful_metrics=['loss'])
+        print('Epoch {:}/{:}'.format(epoch + 1, n_epochs))
+
+        for i_iter, loss in trainer.epoch(train_dataset):
+            progbar.update(i_iter, values=[('loss', loss)])
+        print('Data wait: {:.1%} of the epoch'.format(trainer.wait_fraction))
+
+    # ------------------------------------------------------------------------------------
+    # Test set performance
+    test_loss = []
+    for batch_x, batch_y in test_dataset:
+        logits = gated_pixelcnn(batch_x, training=False)
+
+        # Calculate cross-entropy (= negative log-likelihood)
+        test_loss.append(nll(batch_y, logits))
+    print(nll_report(np.mean(test_loss)))
+
+    # ------------------------------------------------------------------------------------
+    # Generating new images
+    samples = np.zeros((100, height, width, n_channel), dtype='float32')
+    samples = row_sample(gated_pixelcnn, samples, q_levels)
+
+    fig = plt.figure(figsize=(10, 10))
+    for i in range(100):
+        ax = fig.add_subplot(10, 10, i + 1)
+        ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+    plt.show()
+
+    # ------------------------------------------------------------------------------------
+    # Filling occluded images
+    occlude_start_row = 14
+    num_generated_images = 10
+    samples = x_test_quantised[0:num_generated_images, :, :, :].astype('float32')
+    samples = samples / (q_levels - 1)
+    samples[:, occlude_start_row:, :, :] = 0
+
+    fig = plt.figure(figsize=(10, 10))
+
+    for i in range(10):
+        ax = fig.add_subplot(1, 10, i + 1)
+        ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+
+    # The figure is redrawn as soon as each row is generated
+    fig = plt.figure(figsize=(10, 10))
+
+    images = []
+    for i in range(10):
+        ax = fig.add_subplot(1, 10, i + 1)
+        images.append(ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary, vmin=0, vmax=1))
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+
+    for _ in row_sample_rows(gated_pixelcnn, samples, q_levels, start_row=occlude_start_row):
+        for i, image in enumerate(images):
+            image.set_data(samples[i, :, :, 0])
+        plt.pause(0.001)
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
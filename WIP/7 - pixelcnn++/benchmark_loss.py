@@ -0,0 +1,84 @@
+"""Peak memory and step time of the discretized mixture of logistics losses.
+
+Compares `discretized_mix_logistic_loss` with `fused_discretized_mix_logistic_loss` on batches
+of 32x32x3 images. Every measurement computes the loss and its gradient with respect to the
+network output in a fresh process, and the peak memory is the increase of the maximum resident
+set size (or of the GPU peak allocation when a GPU is available) over the inputs.
+"""
+import importlib
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+pixelcnn_pp = importlib.import_module('pixelcnn++')
+
+LOSSES = {
+    'reference': pixelcnn_pp.discretized_mix_logistic_loss,
+    'fused': pixelcnn_pp.fused_discretized_mix_logistic_loss,
+}
+
+
+def peak_memory():
+    if tf.config.list_physical_devices('GPU'):
+        return tf.config.experimental.get_memory_info('GPU:0')['peak']
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(name, nr_mix, batch_size, n_steps, queue):
+    loss_fn = LOSSES[name]
+
+    @tf.function
+    def step(x, l):
+        with tf.GradientTape() as tape:
+            tape.watch(l)
+            loss = loss_fn(x, l)
+
+        return loss, tape.gradient(loss, l)
+
+    rng = np.random.default_rng(42)
+    x = tf.constant(rng.integers(0, 256, (batch_size, 32, 32, 3)).astype('float32') / 127.5 - 1)
+    l = tf.constant(rng.normal(size=(batch_size, 32, 32, 10 * nr_mix)).astype('float32'))
+
+    step.get_concrete_function(x, l)
+    if tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.reset_memory_stats('GPU:0')
+    baseline = peak_memory()
+
+    start = time.time()
+    for _ in range(n_steps):
+        loss, gradient = step(x, l)
+    gradient.numpy()
+    elapsed = (time.time() - start) / n_steps
+
+    queue.put((float(loss), elapsed, peak_memory() - baseline))
+
+
+def main():
+    batch_size = 64
+    n_steps = 20
+
+    context = multiprocessing.get_context('spawn')
+    for nr_mix in [5, 10]:
+        for name in LOSSES:
+            queue = context.Queue()
+            process = context.Process(target=measure, args=(name, nr_mix, batch_size, n_steps, queue))
+            process.start()
+            loss, elapsed, peak = queue.get()
+            process.join()
+
+            print('nr_mix={:<3} {:>9}: loss {:.1f}, {:7.2f} ms/step, peak {:8.1f} MiB'.format(nr_mix,
+                                                                                             name,
+                                                                                             loss,
+                                                                                             elapsed * 1000,
+                                                                                             peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Benchmark of the PixelCNN++ samplers on CPU.
+
+The cached sampler is first checked against the full network: with every pixel taken from a
+given image instead of being sampled, the mixture parameters computed at every step must match
+the output of the full network on that image. The sampling speed does not depend on the trained
+weights, so both samplers then run on an untrained model.
+"""
+import importlib
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+pixelcnn_pp = importlib.import_module('pixelcnn++')
+
+
+def max_cached_difference(model, images):
+    n_images, height, width, n_channel = images.shape
+    images = tf.constant(images)
+    outputs = tf.Variable(tf.zeros([height * width, n_images, 10 * model.nr_logistic_mix]))
+    position = tf.Variable(0)
+
+    def copy_pixel(l):
+        outputs[position].assign(l)
+        pixel = images[:, position // width, position % width]
+        position.assign_add(1)
+        return pixel
+
+    pixelcnn_pp.cached_sample(model, np.zeros(images.shape, dtype='float32'), sample_pixel=copy_pixel)
+
+    outputs = tf.transpose(tf.reshape(outputs, [height, width, n_images, -1]), [2, 0, 1, 3])
+    return np.abs(outputs - model(images, training=False)).max()
+
+
+def main():
+    random_seed = 42
+    height = 32
+    width = 32
+    n_channel = 3
+    num_generated_images = 8
+
+    tf.random.set_seed(random_seed)
+    pixelcnn = pixelcnn_pp.PixelCNNpp(nr_resnet=5, nr_filters=64, nr_logistic_mix=10)
+
+    images = np.random.RandomState(random_seed).uniform(-1, 1, (2, height, width, n_channel)).astype('float32')
+    print('max difference of the cached mixture parameters: {:.3g}'.format(max_cached_difference(pixelcnn, images)))
+
+    for name, sampler in [('naive', pixelcnn_pp.sample), ('cached', pixelcnn_pp.cached_sample)]:
+        samples = np.zeros((num_generated_images, height, width, n_channel), dtype='float32')
+
+        start = time.time()
+        sampler(pixelcnn, samples)
+        elapsed = time.time() - start
+
+        print('{:>7}: {:.2f} s, {:.3f} images/second'.format(name, elapsed, num_generated_images / elapsed))
+
+
+if __name__ == '__main__':
+    main()
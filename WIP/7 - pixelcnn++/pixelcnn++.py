@@ -107,6 +107,114 @@ def discretized_mix_logistic_loss(x, l, sum_all=True):
         return -tf.reduce_sum(log_sum_exp(log_probs), [1, 2])
 
 
+def mix_logistic_params(x, l):
+    """ unpacks the mixture params, with the means already adjusted on the preceding sub-pixels """
+    nr_mix = int(l.shape[-1] / 10)
+    logit_probs = l[:, :, :, :nr_mix]
+    l = tf.reshape(l[:, :, :, nr_mix:], tf.concat([tf.shape(x), [nr_mix * 3]], 0))
+
+    x = x[:, :, :, :, None]
+    means = l[:, :, :, :, :nr_mix]
+    log_scales = l[:, :, :, :, nr_mix:2 * nr_mix]
+    coeffs = tf.nn.tanh(l[:, :, :, :, 2 * nr_mix:3 * nr_mix])
+
+    means = means + tf.concat([tf.zeros_like(coeffs[:, :, :, :1]),
+                               coeffs[:, :, :, 0:1] * x[:, :, :, 0:1],
+                               coeffs[:, :, :, 1:2] * x[:, :, :, 0:1] + coeffs[:, :, :, 2:3] * x[:, :, :, 1:2]], 3)
+
+    return x, logit_probs, means, log_scales, coeffs
+
+
+def mix_logistic_log_probs(x, means, log_scales):
+    """ log probability of every sub-pixel under every logistic, with the pieces its gradient needs """
+    clipped_log_scales = tf.maximum(log_scales, -7.)
+    inv_stdv = tf.exp(-clipped_log_scales)
+    centered_x = x - means
+    plus_in = inv_stdv * (centered_x + 1. / 255.)
+    min_in = inv_stdv * (centered_x - 1. / 255.)
+    mid_in = inv_stdv * centered_x
+    cdf_plus = tf.nn.sigmoid(plus_in)
+    cdf_min = tf.nn.sigmoid(min_in)
+    cdf_delta = cdf_plus - cdf_min
+
+    # same cases as in discretized_mix_logistic_loss: left edge, right edge, normal, extremely low prob
+    cases = (x < -0.999, x > 0.999, cdf_delta > 1e-5)
+    log_probs = tf.where(cases[0],
+                         -tf.nn.softplus(-plus_in),
+                         tf.where(cases[1],
+                                  -tf.nn.softplus(min_in),
+                                  tf.where(cases[2],
+                                           tf.math.log(tf.maximum(cdf_delta, 1e-12)),
+                                           mid_in - clipped_log_scales - 2. * tf.nn.softplus(mid_in) - np.log(127.5))))
+
+    return log_probs, cases, inv_stdv, plus_in, min_in, mid_in, cdf_plus, cdf_min, cdf_delta
+
+
+@tf.custom_gradient
+def mix_logistic_log_likelihood(x, l):
+    """ log-likelihood of every pixel, keeping only x and l for the backward pass
+
+    The backward pass recomputes the cheap element-wise terms from x and l and applies the analytic
+    derivatives of the logistic CDF, so none of the [B,H,W,3,nr_mix] intermediates of the forward
+    pass stay alive between the two passes.
+    """
+    x_, logit_probs, means, log_scales, coeffs = mix_logistic_params(x, l)
+    log_probs = mix_logistic_log_probs(x_, means, log_scales)[0]
+    log_probs = tf.reduce_sum(log_probs, 3) + tf.nn.log_softmax(logit_probs)
+
+    def grad(dy):
+        x_, logit_probs, means, log_scales, coeffs = mix_logistic_params(x, l)
+        log_probs, cases, inv_stdv, plus_in, min_in, mid_in, cdf_plus, cdf_min, cdf_delta = \
+            mix_logistic_log_probs(x_, means, log_scales)
+        cdf_delta = tf.maximum(cdf_delta, 1e-12)
+        pdf_plus = cdf_plus * (1. - cdf_plus)
+        pdf_min = cdf_min * (1. - cdf_min)
+        mid_slope = 1. - 2. * tf.nn.sigmoid(mid_in)
+
+        # derivatives of the sub-pixel log probability w.r.t. the centered x and the log scale
+        d_centered_x = inv_stdv * tf.where(cases[0],
+                                           1. - cdf_plus,
+                                           tf.where(cases[1],
+                                                    -cdf_min,
+                                                    tf.where(cases[2], (pdf_plus - pdf_min) / cdf_delta, mid_slope)))
+        d_log_scales = tf.where(cases[0],
+                                -plus_in * (1. - cdf_plus),
+                                tf.where(cases[1],
+                                         min_in * cdf_min,
+                                         tf.where(cases[2],
+                                                  (pdf_min * min_in - pdf_plus * plus_in) / cdf_delta,
+                                                  -mid_in * mid_slope - 1.)))
+        d_log_scales = tf.where(log_scales >= -7., d_log_scales, 0.)
+
+        # responsibilities of the mixture components
+        log_probs = tf.reduce_sum(log_probs, 3) + tf.nn.log_softmax(logit_probs)
+        responsibilities = tf.nn.softmax(log_probs, 3) * dy[:, :, :, None]
+
+        d_logit_probs = responsibilities - tf.nn.softmax(logit_probs) * dy[:, :, :, None]
+        d_means = -d_centered_x * responsibilities[:, :, :, None]
+        d_log_scales = d_log_scales * responsibilities[:, :, :, None]
+        d_coeffs = tf.concat([d_means[:, :, :, 1:2] * x_[:, :, :, 0:1],
+                              d_means[:, :, :, 2:3] * x_[:, :, :, 0:1],
+                              d_means[:, :, :, 2:3] * x_[:, :, :, 1:2]], 3) * (1. - coeffs ** 2)
+
+        d_l = tf.concat([d_means, d_log_scales, d_coeffs], 4)
+        d_l = tf.concat([d_logit_probs, tf.reshape(d_l, tf.concat([tf.shape(l)[:3], [-1]], 0))], 3)
+
+        return tf.zeros_like(x), d_l
+
+    return tf.reduce_logsumexp(log_probs, 3), grad
+
+
+@tf.function
+def fused_discretized_mix_logistic_loss(x, l, sum_all=True):
+    """ memory-lean discretized_mix_logistic_loss, same values and gradients """
+    if sum_all:
+        return -tf.reduce_sum(mix_logistic_log_likelihood(x, l))
+    else:
+        return -tf.reduce_sum(mix_logistic_log_likelihood(x, l), [1, 2])
+
+
+
 def sample_from_discretized_mix_logistic(l, nr_mix):
     ls = l.shape
     xs = ls[:-1] + [3]
@@ -142,141 +250,406 @@ def concat_elu(x):
     axis = len(x.get_shape())-1
     return tf.nn.elu(tf.concat([x, -x], axis))
 
-def nin(x, num_units, **kwargs):
-    """ a network in network layer (1x1 CONV) """
-    s = x.shape
-    x = tf.reshape(x, [np.prod(s[:-1]),s[-1]])
-    x = keras.layers.Dense(num_units, **kwargs)(x)
-    return tf.reshape(x, s[:-1]+[num_units])
-
-def gated_resnet(x, a=None, conv=keras.layers.Conv2D, dropout_p=0., **kwargs):
-    xs = x.shape
-    num_filters = xs[-1]
-
-    c1 = conv(concat_elu(x), num_filters)
-    if a is not None: # add short-cut connection if auxiliary input 'a' is given
-        c1 += nin(concat_elu(a), num_filters)
-    c1 = concat_elu(c1)
-    if dropout_p > 0:
-        c1 = tf.nn.dropout(c1, keep_prob=1. - dropout_p)
-    c2 = conv(c1, num_filters * 2)
-    a, b = tf.split(c2, 2, 3)
-    c3 = a * tf.nn.sigmoid(b)
-    return x + c3
-
 ''' utilities for shifting the image around, efficient alternative to masking convolutions '''
 
 def down_shift(x):
-    xs = x.shape
-    return tf.concat([tf.zeros([xs[0],1,xs[2],xs[3]]), x[:,:xs[1]-1,:,:]],1)
+    return tf.pad(x, [[0, 0], [1, 0], [0, 0], [0, 0]])[:, :-1]
 
 def right_shift(x):
-    xs = x.shape
-    return tf.concat([tf.zeros([xs[0],xs[1],1,xs[3]]), x[:,:,:xs[2]-1,:]],2)
-
-def down_shifted_conv2d(x, num_filters, filter_size=[2,3], stride=[1,1], **kwargs):
-    x = tf.pad(x, [[0,0],[filter_size[0]-1,0], [int((filter_size[1]-1)/2),int((filter_size[1]-1)/2)],[0,0]])
-    return keras.layers.Conv2D(num_filters, kernel_size=filter_size, padding='valid', strides=stride, **kwargs)(x)
-
-def down_shifted_deconv2d(x, num_filters, filter_size=[2,3], stride=[1,1], **kwargs):
-    x = keras.layers.Conv2DTranspose(num_filters, kernel_size=filter_size, padding='valid', strides=stride, **kwargs)(x)
-    xs = x.shape
-    return x[:,:(xs[1]-filter_size[0]+1),int((filter_size[1]-1)/2):(xs[2]-int((filter_size[1]-1)/2)),:]
-
-def down_right_shifted_conv2d(x, num_filters, filter_size=[2,2], stride=[1,1], **kwargs):
-    x = tf.pad(x, [[0,0],[filter_size[0]-1, 0], [filter_size[1]-1, 0],[0,0]])
-    return keras.layers.Conv2D(num_filters, kernel_size=filter_size, padding='valid', strides=stride, **kwargs)(x)
-
-def down_right_shifted_deconv2d(x, num_filters, filter_size=[2,2], stride=[1,1], **kwargs):
-    x = keras.layers.Conv2DTranspose(num_filters, kernel_size=filter_size, padding='valid', strides=stride, **kwargs)(x)
-    xs = x.shape
-    return x[:,:(xs[1]-filter_size[0]+1):,:(xs[2]-filter_size[1]+1),:]
-
-# --------------------------------------------------------------------------------------------------------------
-# Defining random seeds
-random_seed = 42
-tf.random.set_seed(random_seed)
-np.random.seed(random_seed)
-rn.seed(random_seed)
-
-
-# --------------------------------------------------------------------------------------------------------------
-# Loading data
-(x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
-
-height = 28
-width = 28
-n_channel = 1
-
-x_train = (x_train.astype('float32') / 127.5) - 1
-x_test = (x_test.astype('float32') / 127.5) - 1
-
-x_train = x_train.reshape(x_train.shape[0], height, width, 1)
-x_test = x_test.reshape(x_test.shape[0], height, width, 1)
-
-
-batch_size = 128
-train_buf = 60000
-
-train_dataset = tf.data.Dataset.from_tensor_slices((x_train, x_train))
-train_dataset = train_dataset.shuffle(buffer_size=train_buf)
-train_dataset = train_dataset.batch(batch_size)
-
-test_dataset = tf.data.Dataset.from_tensor_slices((x_test, x_test))
-test_dataset = test_dataset.batch(batch_size)
-
-nr_logistic_mix = 5
-
-dropout_p=0.5
-nr_resnet=5
-nr_filters=160
-
-# ////////// up pass through pixelCNN ////////
-xs = x.shape
-# add channel of ones to distinguish image from padding later on
-x_pad = tf.concat([x, tf.ones(xs[:-1] + [1])], 3)
-
-# stream for pixels above
-u_list = [down_shift(down_shifted_conv2d(x_pad, num_filters=nr_filters, filter_size=[2, 3]))]
-# stream for up and to the left
-ul_list = [down_shift(down_shifted_conv2d(x_pad, num_filters=nr_filters, filter_size=[1, 3])) + \
-           right_shift(down_right_shifted_conv2d(x_pad, num_filters=nr_filters, filter_size=[2, 1]))]
-
-for rep in range(nr_resnet):
-    u_list.append(gated_resnet(u_list[-1], conv=down_shifted_conv2d))
-    ul_list.append(gated_resnet(ul_list[-1], u_list[-1], conv=down_right_shifted_conv2d))
-
-u_list.append(down_shifted_conv2d(u_list[-1], num_filters=nr_filters, stride=[2, 2]))
-ul_list.append(down_right_shifted_conv2d(ul_list[-1], num_filters=nr_filters, stride=[2, 2]))
-
-for rep in range(nr_resnet):
-    u_list.append(gated_resnet(u_list[-1], conv=down_shifted_conv2d))
-    ul_list.append(gated_resnet(ul_list[-1], u_list[-1], conv=down_right_shifted_conv2d))
-
-u_list.append(down_shifted_conv2d(u_list[-1], num_filters=nr_filters, stride=[2, 2]))
-ul_list.append(down_right_shifted_conv2d(ul_list[-1], num_filters=nr_filters, stride=[2, 2]))
-
-for rep in range(nr_resnet):
-    u_list.append(gated_resnet(u_list[-1], conv=down_shifted_conv2d))
-    ul_list.append(gated_resnet(ul_list[-1], u_list[-1], conv=down_right_shifted_conv2d))
-
-# /////// down pass ////////
-u = u_list.pop()
-ul = ul_list.pop()
-for rep in range(nr_resnet):
-    u = gated_resnet(u, u_list.pop(), conv=down_shifted_conv2d)
-    ul = gated_resnet(ul, tf.concat([u, ul_list.pop()], 3), conv=down_right_shifted_conv2d)
-
-u = down_shifted_deconv2d(u, num_filters=nr_filters, stride=[2, 2])
-ul = down_right_shifted_deconv2d(ul, num_filters=nr_filters, stride=[2, 2])
-
-for rep in range(nr_resnet + 1):
-    u = gated_resnet(u, u_list.pop(), conv=down_shifted_conv2d)
-    ul = gated_resnet(ul, tf.concat([u, ul_list.pop()], 3), conv=down_right_shifted_conv2d)
-
-u = down_shifted_deconv2d(u, num_filters=nr_filters, stride=[2, 2])
-ul = down_right_shifted_deconv2d(ul, num_filters=nr_filters, stride=[2, 2])
-
-for rep in range(nr_resnet + 1):
-    u = gated_resnet(u, u_list.pop(), conv=down_shifted_conv2d)
-    ul = gated_resnet(ul, tf.concat([u, ul_list.pop()], 3), conv=down_right_shifted_conv2d)
+    return tf.pad(x, [[0, 0], [0, 0], [1, 0], [0, 0]])[:, :, :-1]
+
+
+class DownShiftedConv2D(keras.layers.Layer):
+    """ convolution over the rows above, centred horizontally """
+    def __init__(self, num_filters, filter_size=[2, 3], stride=[1, 1], **kwargs):
+        super(DownShiftedConv2D, self).__init__()
+        self.filter_size = filter_size
+        self.stride = stride
+        self.pad = [[filter_size[0] - 1, 0], [int((filter_size[1] - 1) / 2), int((filter_size[1] - 1) / 2)]]
+        self.conv = keras.layers.Conv2D(num_filters, kernel_size=filter_size, padding='valid', strides=stride,
+                                        **kwargs)
+
+    def call(self, x):
+        return self.conv(tf.pad(x, [[0, 0]] + self.pad + [[0, 0]]))
+
+    def call_rows(self, x, row, n_rows):
+        """ output rows [row, row + n_rows) computed from x, the input already padded as in call """
+        x = tf.slice(x, [0, row * self.stride[0], 0, 0],
+                     [-1, (n_rows - 1) * self.stride[0] + self.filter_size[0], -1, -1])
+        return self.conv(x)
+
+    def call_cached(self, x, cache, in_row, out_row):
+        """ writes the input rows starting at in_row into the padded cache and returns two output rows """
+        cache[:, in_row + self.pad[0][0]:in_row + self.pad[0][0] + x.shape[1],
+              self.pad[1][0]:self.pad[1][0] + x.shape[2]].assign(x)
+        return self.call_rows(cache, out_row, 2)
+
+
+class DownRightShiftedConv2D(DownShiftedConv2D):
+    """ convolution over the rows above and the columns to the left """
+    def __init__(self, num_filters, filter_size=[2, 2], stride=[1, 1], **kwargs):
+        super(DownRightShiftedConv2D, self).__init__(num_filters, filter_size, stride, **kwargs)
+        self.pad = [[filter_size[0] - 1, 0], [filter_size[1] - 1, 0]]
+
+
+class DownShiftedDeconv2D(keras.layers.Layer):
+    def __init__(self, num_filters, filter_size=[2, 3], stride=[1, 1], **kwargs):
+        super(DownShiftedDeconv2D, self).__init__()
+        self.filter_size = filter_size
+        # output_padding gives the (H - 1) * stride + filter_size + stride - 1 output rows of the original deconv2d
+        self.deconv = keras.layers.Conv2DTranspose(num_filters, kernel_size=filter_size, padding='valid',
+                                                   strides=stride, output_padding=[s - 1 for s in stride], **kwargs)
+
+    def call(self, x):
+        x = self.deconv(x)
+        xs = x.shape
+        return x[:, :(xs[1] - self.filter_size[0] + 1),
+                 int((self.filter_size[1] - 1) / 2):(xs[2] - int((self.filter_size[1] - 1) / 2)), :]
+
+
+class DownRightShiftedDeconv2D(DownShiftedDeconv2D):
+    def __init__(self, num_filters, filter_size=[2, 2], stride=[1, 1], **kwargs):
+        super(DownRightShiftedDeconv2D, self).__init__(num_filters, filter_size, stride, **kwargs)
+
+    def call(self, x):
+        x = self.deconv(x)
+        xs = x.shape
+        return x[:, :(xs[1] - self.filter_size[0] + 1), :(xs[2] - self.filter_size[1] + 1), :]
+
+
+class GatedResnet(keras.layers.Layer):
+    def __init__(self, num_filters, conv=DownShiftedConv2D, auxiliary=False, dropout_p=0.):
+        super(GatedResnet, self).__init__()
+        self.conv1 = conv(num_filters)
+        # network in network layer (1x1 CONV) for the short-cut connection of the auxiliary input
+        self.nin = keras.layers.Dense(num_filters) if auxiliary else None
+        self.dropout = keras.layers.Dropout(dropout_p)
+        self.conv2 = conv(num_filters * 2)
+
+    def call(self, x, a=None, training=None):
+        c1 = self.conv1(concat_elu(x))
+        if a is not None:  # add short-cut connection if auxiliary input 'a' is given
+            c1 += self.nin(concat_elu(a))
+        c1 = self.dropout(concat_elu(c1), training=training)
+        c2 = self.conv2(c1)
+        a, b = tf.split(c2, 2, 3)
+        return x + a * tf.nn.sigmoid(b)
+
+    def call_cached(self, x, a, caches, row):
+        """ two rows starting at row, reading the rows above from the input caches of the convolutions """
+        c1 = self.conv1.call_cached(concat_elu(x), caches[self.conv1], row, row)
+        if a is not None:
+            c1 += self.nin(concat_elu(a))
+        c2 = self.conv2.call_cached(concat_elu(c1), caches[self.conv2], row, row)
+        a, b = tf.split(c2, 2, 3)
+        return x + a * tf.nn.sigmoid(b)
+
+
+class PixelCNNpp(keras.Model):
+    """ PixelCNN++ with the up and down passes over three resolutions of the openai implementation
+
+    Refs:
+    [1] - Salimans, T., Karpathy, A., Chen, X., & Kingma, D. P. (2017). Pixelcnn++: Improving the pixelcnn with
+    discretized logistic mixture likelihood and other modifications. arXiv preprint arXiv:1701.05517.
+    """
+    def __init__(self, nr_resnet=5, nr_filters=160, nr_logistic_mix=10, dropout_p=0.5):
+        super(PixelCNNpp, self).__init__()
+        self.nr_logistic_mix = nr_logistic_mix
+
+        # stream for pixels above and stream for up and to the left
+        self.u_init = DownShiftedConv2D(nr_filters, filter_size=[2, 3])
+        self.ul_init_down = DownShiftedConv2D(nr_filters, filter_size=[1, 3])
+        self.ul_init_right = DownRightShiftedConv2D(nr_filters, filter_size=[2, 1])
+
+        def resnets(n, conv, auxiliary):
+            return [GatedResnet(nr_filters, conv, auxiliary, dropout_p) for _ in range(n)]
+
+        self.up_u = [resnets(nr_resnet, DownShiftedConv2D, False) for _ in range(3)]
+        self.up_ul = [resnets(nr_resnet, DownRightShiftedConv2D, True) for _ in range(3)]
+        self.u_downsample = [DownShiftedConv2D(nr_filters, stride=[2, 2]) for _ in range(2)]
+        self.ul_downsample = [DownRightShiftedConv2D(nr_filters, stride=[2, 2]) for _ in range(2)]
+
+        self.down_u = [resnets(nr_resnet + min(level, 1), DownShiftedConv2D, True) for level in range(3)]
+        self.down_ul = [resnets(nr_resnet + min(level, 1), DownRightShiftedConv2D, True) for level in range(3)]
+        self.u_upsample = [DownShiftedDeconv2D(nr_filters, stride=[2, 2]) for _ in range(2)]
+        self.ul_upsample = [DownRightShiftedDeconv2D(nr_filters, stride=[2, 2]) for _ in range(2)]
+
+        self.out = keras.layers.Dense(10 * nr_logistic_mix)
+
+    def call(self, x, training=None):
+        # add channel of ones to distinguish image from padding later on
+        x_pad = tf.concat([x, tf.ones_like(x[:, :, :, :1])], 3)
+
+        # ////////// up pass through pixelCNN ////////
+        u_list = [down_shift(self.u_init(x_pad))]
+        ul_list = [down_shift(self.ul_init_down(x_pad)) + right_shift(self.ul_init_right(x_pad))]
+
+        for level in range(3):
+            if level > 0:
+                u_list.append(self.u_downsample[level - 1](u_list[-1]))
+                ul_list.append(self.ul_downsample[level - 1](ul_list[-1]))
+
+            for u_resnet, ul_resnet in zip(self.up_u[level], self.up_ul[level]):
+                u_list.append(u_resnet(u_list[-1], training=training))
+                ul_list.append(ul_resnet(ul_list[-1], u_list[-1], training=training))
+
+        # /////// down pass ////////
+        u = u_list.pop()
+        ul = ul_list.pop()
+        for level in range(3):
+            if level > 0:
+                u = self.u_upsample[level - 1](u)
+                ul = self.ul_upsample[level - 1](ul)
+
+            for u_resnet, ul_resnet in zip(self.down_u[level], self.down_ul[level]):
+                u = u_resnet(u, u_list.pop(), training=training)
+                ul = ul_resnet(ul, tf.concat([u, ul_list.pop()], 3), training=training)
+
+        return self.out(tf.nn.elu(ul))
+
+    def cached_convs(self):
+        """ (convolution, resolution level of its input) of the convolutions after the first layer """
+        convs = []
+        for level in range(3):
+            if level > 0:
+                convs += [(self.u_downsample[level - 1], level - 1), (self.ul_downsample[level - 1], level - 1)]
+            for resnet in self.up_u[level] + self.up_ul[level]:
+                convs += [(resnet.conv1, level), (resnet.conv2, level)]
+            # the down pass starts from the lowest resolution
+            for resnet in self.down_u[2 - level] + self.down_ul[2 - level]:
+                convs += [(resnet.conv1, level), (resnet.conv2, level)]
+        return convs
+
+    def call_cached(self, canvases, caches, rows):
+        """ two rows of ul starting at rows[0], the network evaluated only on the rows rows[level] of every level
+
+        canvases holds the padded input image of the three first convolutions, with an extra row on top for
+        the down shift, and caches the padded inputs of all the other convolutions.
+        """
+        u = self.u_init.call_rows(canvases[0], rows[0], 2)
+        ul = self.ul_init_down.call_rows(canvases[1], rows[0], 2)
+        # with the extra row the first rows computed belong to row - 1, which the down shift sets to zero, the
+        # right shifted convolution starts one row further down
+        shifted = tf.cast(tf.range(rows[0] - 1, rows[0] + 1) >= 0, u.dtype)[None, :, None, None]
+        u_list = [u * shifted]
+        ul_list = [ul * shifted + right_shift(self.ul_init_right.call_rows(canvases[2], rows[0] + 1, 2))]
+
+        for level in range(3):
+            if level > 0:
+                u_list.append(self.u_downsample[level - 1].call_cached(
+                    u_list[-1], caches[self.u_downsample[level - 1]], rows[level - 1], rows[level]))
+                ul_list.append(self.ul_downsample[level - 1].call_cached(
+                    ul_list[-1], caches[self.ul_downsample[level - 1]], rows[level - 1], rows[level]))
+
+            for u_resnet, ul_resnet in zip(self.up_u[level], self.up_ul[level]):
+                u_list.append(u_resnet.call_cached(u_list[-1], None, caches, rows[level]))
+                ul_list.append(ul_resnet.call_cached(ul_list[-1], u_list[-1], caches, rows[level]))
+
+        u = u_list.pop()
+        ul = ul_list.pop()
+        for level in range(3):
+            if level > 0:
+                # the deconvolution maps row r to the rows 2r and 2r + 1, keep the two starting at rows[2 - level]
+                offset = rows[2 - level] - 2 * rows[3 - level]
+                u = tf.slice(self.u_upsample[level - 1](u), [0, offset, 0, 0], [-1, 2, -1, -1])
+                ul = tf.slice(self.ul_upsample[level - 1](ul), [0, offset, 0, 0], [-1, 2, -1, -1])
+
+            for u_resnet, ul_resnet in zip(self.down_u[level], self.down_ul[level]):
+                u = u_resnet.call_cached(u, u_list.pop(), caches, rows[2 - level])
+                ul = ul_resnet.call_cached(ul, tf.concat([u, ul_list.pop()], 3), caches, rows[2 - level])
+
+        return ul
+
+
+def sample(model, samples, start_row=0):
+    """Generate pixels in raster order running the full network at every step."""
+    n_samples, height, width, n_channel = samples.shape
+    for i in range(start_row, height):
+        for j in range(width):
+            l = model(samples, training=False)
+            x = sample_from_discretized_mix_logistic(l[:, i:i + 1, j:j + 1], model.nr_logistic_mix)
+            samples[:, i, j] = x[:, 0, 0]
+
+    return samples
+
+
+def cached_sample(model, samples, start_row=0, sample_pixel=None):
+    """Generate pixels in raster order recomputing only the rows of every layer that can change.
+
+    All the convolutions of PixelCNN++ are shifted down, so every row of a layer depends only on the rows at
+    and above it in the same resolution. The inputs of all the convolutions (the u_list and ul_list streams
+    and the inner activations of the gated resnets) are cached as in Fast PixelCNN++ [1], and every step
+    evaluates the network only on two rows per resolution: the ones holding the previous pixel, which becomes
+    final, and the current pixel. The mixture of logistics is sampled only at the current pixel, and the
+    whole generation runs in a single tf.function loop.
+
+    Pixels from `start_row` onwards are generated, the rows above are kept from `samples`. `sample_pixel`
+    maps the [batch, 10 * nr_logistic_mix] output at the current pixel to a [batch, 3] sample, by default
+    with sample_from_discretized_mix_logistic.
+
+    Refs:
+    [1] - Ramachandran, P., Paine, T. L., Khorrami, P., Babaeizadeh, M., Chang, S., Zhang, Y., ... & Huang,
+    T. S. (2017). Fast generation for convolutional autoregressive models. arXiv preprint arXiv:1704.06001.
+    """
+    if sample_pixel is None:
+        def sample_pixel(l):
+            x = sample_from_discretized_mix_logistic(tf.reshape(l, [l.shape[0], 1, 1, l.shape[1]]),
+                                                     model.nr_logistic_mix)
+            return tf.reshape(x, [l.shape[0], 3])
+
+    n_samples, height, width, n_channel = samples.shape
+    model(tf.zeros([1, height, width, n_channel]))
+
+    # the first convolutions read the image (with its channel of ones) from canvases with one more row on top
+    canvases = []
+    for conv in [model.u_init, model.ul_init_down, model.ul_init_right]:
+        (top, _), (left, right) = conv.pad
+        canvas = np.zeros((n_samples, top + 1 + height + 2, left + width + right, n_channel + 1), dtype='float32')
+        canvas[:, top + 1:top + 1 + height, left:left + width] = np.concatenate(
+            [samples, np.ones_like(samples[:, :, :, :1])], 3)
+        canvases.append(tf.Variable(canvas))
+
+    caches = {}
+    for conv, level in model.cached_convs():
+        (top, _), (left, right) = conv.pad
+        caches[conv] = tf.Variable(tf.zeros([n_samples,
+                                             top + height // 2 ** level + 2,
+                                             left + width // 2 ** level + right,
+                                             conv.conv.kernel.shape[2]]))
+
+    def step(i, j):
+        # rows of the previous pixel at every resolution
+        previous_row = tf.where(j > 0, i, tf.maximum(i - 1, 0))
+        rows = [previous_row // 2 ** level for level in range(3)]
+        ul = model.call_cached(canvases, caches, rows)
+        return model.out(tf.nn.elu(ul[:, i - rows[0], j]))
+
+    @tf.function
+    def generate():
+        for i in tf.range(1, max(start_row, 1)):
+            step(i, 0)
+
+        for p in tf.range(start_row * width, height * width):
+            i = p // width
+            j = p % width
+            x = sample_pixel(step(i, j))
+            for canvas, conv in zip(canvases, [model.u_init, model.ul_init_down, model.ul_init_right]):
+                (top, _), (left, _) = conv.pad
+                canvas[:, top + 1 + i, left + j, :n_channel].assign(x)
+
+    generate()
+
+    (top, _), (left, _) = model.u_init.pad
+    return canvases[0][:, top + 1:top + 1 + height, left:left + width, :n_channel].numpy()
+
+
+def main():
+    # --------------------------------------------------------------------------------------------------------------
+    # Defining random seeds
+    random_seed = 42
+    tf.random.set_seed(random_seed)
+    np.random.seed(random_seed)
+    rn.seed(random_seed)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Loading data
+    (x_train, y_train), (x_test, y_test) = tf.keras.datasets.cifar10.load_data()
+
+    height = 32
+    width = 32
+    n_channel = 3
+
+    x_train = (x_train.astype('float32') / 127.5) - 1
+    x_test = (x_test.astype('float32') / 127.5) - 1
+
+    batch_size = 16
+    train_buf = 50000
+
+    train_dataset = tf.data.Dataset.from_tensor_slices(x_train)
+    train_dataset = train_dataset.shuffle(buffer_size=train_buf)
+    train_dataset = train_dataset.batch(batch_size)
+
+    test_dataset = tf.data.Dataset.from_tensor_slices(x_test)
+    test_dataset = test_dataset.batch(batch_size)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Create PixelCNN++ model
+    nr_logistic_mix = 10
+    dropout_p = 0.5
+    nr_resnet = 5
+    nr_filters = 160
+
+    pixelcnn = PixelCNNpp(nr_resnet, nr_filters, nr_logistic_mix, dropout_p)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Prepare optimizer
+    lr_decay = 0.999995
+    learning_rate = 1e-3
+    optimizer = keras.optimizers.Adam(lr=learning_rate)
+
+    # --------------------------------------------------------------------------------------------------------------
+    @tf.function
+    def train_step(batch_x):
+        with tf.GradientTape() as ae_tape:
+            logits = pixelcnn(batch_x, training=True)
+
+            loss = fused_discretized_mix_logistic_loss(batch_x, logits)
+
+        gradients = ae_tape.gradient(loss, pixelcnn.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, pixelcnn.trainable_variables))
+
+        return loss
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Training loop
+    n_epochs = 100
+    for epoch in range(n_epochs):
+        start_epoch = time.time()
+        for batch_x in train_dataset:
+            optimizer.lr = optimizer.lr * lr_decay
+            loss = train_step(batch_x)
+
+        print('Epoch {:}/{:} - {:.1f} s - bits/dim : {:}'.format(epoch + 1, n_epochs, time.time() - start_epoch,
+                                                               loss / (np.log(2) * batch_size * height * width
+                                                                       * n_channel)))
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Test set performance
+    test_loss = 0
+    for batch_x in test_dataset:
+        logits = pixelcnn(batch_x, training=False)
+        test_loss += fused_discretized_mix_logistic_loss(batch_x, logits)
+    print('bits/dim : {:}'.format(test_loss / (np.log(2) * x_test.size)))
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Generating new images
+    samples = np.zeros((100, height, width, n_channel), dtype='float32')
+    samples = cached_sample(pixelcnn, samples)
+
+    fig = plt.figure(figsize=(10, 10))
+    for i in range(100):
+        ax = fig.add_subplot(10, 10, i + 1)
+        ax.imshow((samples[i] + 1) / 2)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+    plt.show()
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Filling occluded images
+    occlude_start_row = 16
+    samples = np.copy(x_test[0:10])
+    samples[:, occlude_start_row:] = 0
+
+    samples = cached_sample(pixelcnn, samples, start_row=occlude_start_row)
+
+    fig = plt.figure(figsize=(10, 10))
+    for i in range(10):
+        ax = fig.add_subplot(1, 10, i + 1)
+        ax.imshow((samples[i] + 1) / 2)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Peak memory and time of the PixelSNAIL causal attention against the canvas size.
+
+Compares the dense masked attention that PixelSNAIL used before (kept here as a reference)
+with the scaled_dot_product_attention and the chunked online softmax paths of
+`causal_attention`. Every measurement runs a forward and a backward pass in a fresh process,
+and the peak memory is the maximum resident set size above the resident set size before the
+pass (or the increase of the CUDA peak allocation when a GPU is available).
+"""
+import multiprocessing
+import os
+import resource
+import time
+from math import sqrt
+
+import numpy as np
+import torch
+
+from pixelsnail import causal_attention
+
+
+def dense_causal_attention(query, key, value):
+    size = query.shape[2]
+    mask = torch.from_numpy(np.triu(np.ones([size, size]), k=1).astype(np.uint8).T).unsqueeze(0)
+    start_mask = torch.ones(size, 1)
+    start_mask[0] = 0
+
+    attn = torch.matmul(query, key.transpose(2, 3)) / sqrt(query.shape[3])
+    attn = attn.masked_fill(mask.to(query.device) == 0, -1e4)
+    attn = torch.softmax(attn, 3) * start_mask.to(query.device)
+
+    return attn @ value
+
+
+ATTENTIONS = {
+    'dense': dense_causal_attention,
+    'sdpa': causal_attention,
+    'chunked': lambda query, key, value: causal_attention(query, key, value, chunk_size=256),
+}
+
+
+def current_rss():
+    # Resident set size of this process, in bytes (Linux)
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss():
+    # Maximum resident set size of this process since the last reset, in bytes (Linux). The
+    # ru_maxrss of getrusage also covers the process before exec, the parent of a spawned process.
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+
+def measure(name, canvas_size, n_head, dim_head, batch, queue):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    # One pass on a small canvas first, so the lazy initialisations of torch are not measured
+    for size in [4, canvas_size]:
+        query, key, value = [
+            torch.randn(batch, n_head, size ** 2, dim_head, device=device, requires_grad=True)
+            for _ in range(3)
+        ]
+        if size != canvas_size:
+            ATTENTIONS[name](query, key, value).sum().backward()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.max_memory_allocated()
+
+    else:
+        # Reset the maximum resident set size to the current one (Linux)
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        baseline = current_rss()
+
+    start = time.time()
+    out = ATTENTIONS[name](query, key, value)
+    out.sum().backward()
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+
+    else:
+        peak = peak_rss()
+
+    queue.put((time.time() - start, peak - baseline))
+
+
+def main():
+    n_head = 8
+    dim_head = 16
+    batch = 1
+
+    torch.manual_seed(0)
+    query, key, value = [torch.randn(2, n_head, 23 ** 2, dim_head, requires_grad=True) for _ in range(3)]
+    grad_out = torch.randn(2, n_head, 23 ** 2, dim_head)
+
+    results = {}
+    for name in ATTENTIONS:
+        # The checkpoints of the chunked path only support backward(), not autograd.grad()
+        out = ATTENTIONS[name](query, key, value)
+        (out * grad_out).sum().backward()
+        results[name] = [out.detach()] + [input.grad for input in [query, key, value]]
+        query.grad = key.grad = value.grad = None
+
+    for name in ['sdpa', 'chunked']:
+        differences = [(a - b).abs().max().item() for a, b in zip(results[name], results['dense'])]
+        print('{:>7}: max difference from dense {:.3g}, of the gradients {:.3g}'.format(name,
+                                                                                      differences[0],
+                                                                                      max(differences[1:])))
+
+    # Large blocks are mapped and unmapped one by one, so the resident set size of the
+    # measuring processes follows the memory in use instead of the high-water mark of the heap
+    os.environ['MALLOC_MMAP_THRESHOLD_'] = str(2 ** 16)
+    context = multiprocessing.get_context('spawn')
+    for canvas_size in [16, 32, 64, 96]:
+        for name in ATTENTIONS:
+            queue = context.Queue()
+            process = context.Process(target=measure,
+                                      args=(name, canvas_size, n_head, dim_head, batch, queue))
+            process.start()
+            process.join()
+
+            if process.exitcode != 0:
+                print('{:>3}x{:<3} {:>7}: failed (out of memory?)'.format(canvas_size, canvas_size, name))
+                continue
+
+            elapsed, peak = queue.get()
+            print('{:>3}x{:<3} {:>7}: {:8.3f} s, peak {:9.1f} MiB'.format(canvas_size,
+                                                                          canvas_size,
+                                                                          name,
+                                                                          elapsed,
+                                                                          peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Throughput and bits/dim of PixelSNAIL with downsampled attention against full attention.
+
+Every configuration is trained for the same number of steps on grayscale CIFAR-10 quantised
+to `n_class` levels, and the bits/dim are measured on the test set. The training throughput
+is also measured on random 64x64 inputs, where the cost of full attention grows fastest.
+Each of these measurements runs in a fresh process, so a configuration that does not fit in
+memory is reported instead of ending the benchmark. With `data_dir`, CIFAR-10 is read from `data_dir`/cifar10.npz (uint8 arrays x_train and
+x_test with shape [N, 32, 32, 3]) instead of being downloaded with torchvision.
+"""
+import multiprocessing
+import os
+import time
+from math import log
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from pixelsnail import PixelSNAIL
+
+
+def load_data(train, n_class, data_dir=None):
+    if data_dir is None:
+        from torchvision.datasets import CIFAR10
+
+        images = CIFAR10('data', train=train, download=True).data
+    else:
+        with np.load(os.path.join(data_dir, 'cifar10.npz')) as data:
+            images = data['x_train' if train else 'x_test']
+    images = torch.from_numpy(images).float().mean(3)
+
+    return (images * n_class / 256).long()
+
+
+def build_model(size, n_class, attn_downsample):
+    return PixelSNAIL([size, size], n_class, 64, 5, 4, 2, 64, attn_downsample=attn_downsample)
+
+
+def train_step(model, optimizer, input):
+    out, _ = model(input)
+    loss = F.cross_entropy(out, input)
+
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+    return loss.item()
+
+
+@torch.no_grad()
+def bits_per_dim(model, images, batch_size):
+    model.eval()
+
+    total = 0
+    for start in range(0, len(images), batch_size):
+        input = images[start: start + batch_size]
+        out, _ = model(input)
+        total += F.cross_entropy(out, input, reduction='sum').item()
+
+    model.train()
+
+    return total / images.numel() / log(2)
+
+
+def throughput(model, n_class, size, batch_size, n_steps):
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+    input = torch.randint(n_class, (batch_size, size, size))
+
+    train_step(model, optimizer, input)
+    start = time.time()
+    for step in range(n_steps):
+        train_step(model, optimizer, input)
+
+    return batch_size * n_steps / (time.time() - start)
+
+
+def measure_throughput(n_class, size, attn_downsample, batch_size, n_steps, queue):
+    queue.put(throughput(build_model(size, n_class, attn_downsample), n_class, size, batch_size, n_steps))
+
+
+def throughput_in_process(n_class, size, attn_downsample, batch_size, n_steps):
+    """`throughput` of a new model in a fresh process, None if the process died (e.g. out of memory)."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure_throughput,
+                              args=(n_class, size, attn_downsample, batch_size, n_steps, queue))
+    process.start()
+    process.join()
+
+    return queue.get() if process.exitcode == 0 else None
+
+
+def main():
+    random_seed = 42
+    n_class = 16
+    batch_size = 4
+    n_train_steps = 250  # about 25 minutes with full attention on one CPU core
+    n_test_images = 200
+    throughput_batch_size = 1
+    throughput_steps = 3
+    data_dir = None
+
+    train_images = load_data(True, n_class, data_dir)
+    test_images = load_data(False, n_class, data_dir)[:n_test_images]
+
+    configurations = [
+        ('full', 1),
+        ('[1, 1, 2, 2]', [1, 1, 2, 2]),
+        ('2', 2),
+        ('[1, 2, 4, 4]', [1, 2, 4, 4]),
+    ]
+
+    # The 64x64 measurements run first, while this process still holds little memory
+    images_per_second_64 = {}
+    for name, attn_downsample in configurations:
+        images_per_second_64[name] = throughput_in_process(n_class, 64, attn_downsample,
+                                                           throughput_batch_size, throughput_steps)
+
+    for name, attn_downsample in configurations:
+        torch.manual_seed(random_seed)
+        model = build_model(32, n_class, attn_downsample)
+        optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+
+        start = time.time()
+        for step in range(n_train_steps):
+            index = torch.randint(len(train_images), (batch_size,))
+            train_step(model, optimizer, train_images[index])
+        images_per_second_32 = batch_size * n_train_steps / (time.time() - start)
+
+        test_bits_per_dim = bits_per_dim(model, test_images, batch_size)
+
+        if images_per_second_64[name] is None:
+            speed_64 = 'out of memory'
+        else:
+            speed_64 = '{:.3f} images/second'.format(images_per_second_64[name])
+
+        print('{:>12}: {:.3f} bits/dim, {:.3f} images/second at 32x32, {:} at 64x64'.format(name,
+                                                                                       test_bits_per_dim,
+                                                                                       images_per_second_32,
+                                                                                       speed_64))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Microbenchmark of the categorical samplers against the per-row np.random.choice loop."""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from sampling import sample_categorical, sample_categorical_np
+
+
+def sample_from(distribution):
+    """Sample random values from distribution with one np.random.choice call per row"""
+    batch_size, bins = distribution.shape
+    return np.array([np.random.choice(bins, p=distr) for distr in distribution])
+
+
+def time_per_call(function, n_calls):
+    function()
+    start = time.time()
+    for _ in range(n_calls):
+        function()
+    return (time.time() - start) / n_calls
+
+
+def main():
+    q_levels = 256
+    n_calls = 50
+
+    sample_categorical_graph = tf.function(sample_categorical)
+
+    for batch_size in [100, 1000]:
+        logits = np.random.randn(batch_size, q_levels).astype('float32')
+        probs = tf.nn.softmax(logits).numpy().astype('float64')
+        probs /= probs.sum(axis=-1, keepdims=True)
+        seeds = np.arange(batch_size)
+
+        samplers = [
+            ('np.random.choice loop', lambda: sample_from(probs)),
+            ('NumPy inverse CDF', lambda: sample_categorical_np(logits)),
+            ('NumPy inverse CDF row seeds', lambda: sample_categorical_np(logits, seeds=seeds)),
+            ('TF Gumbel-max eager', lambda: sample_categorical(logits).numpy()),
+            ('TF Gumbel-max', lambda: sample_categorical_graph(logits).numpy()),
+            ('TF Gumbel-max top-k=16', lambda: sample_categorical_graph(logits, top_k=16).numpy()),
+            ('TF Gumbel-max top-p=0.9', lambda: sample_categorical_graph(logits, top_p=0.9).numpy()),
+            ('TF Gumbel-max row seeds', lambda: sample_categorical_graph(logits, seeds=seeds).numpy()),
+        ]
+
+        print('batch size {:}, {:} levels'.format(batch_size, q_levels))
+        reference = time_per_call(samplers[0][1], n_calls)
+        for name, sampler in samplers:
+            elapsed = time_per_call(sampler, n_calls)
+            print('{:>28}: {:8.3f} ms/call, {:6.1f}x'.format(name, 1000 * elapsed, reference / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Loading time, memory and epoch time of the quantised dataset cache.
+
+Compares the data preparation of the training scripts (float32 conversion, `np.digitize`
+and a float32 input and int32 target copy in `from_tensor_slices`) with `load_quantised`,
+the first time (quantising into the cache) and once the cache exists, followed by the
+`build_pipeline` of the training scripts, without shuffling. Every measurement runs in a fresh process, and the peak memory is the
+increase of the maximum resident set size during the preparation and one epoch.
+"""
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from dataset_cache import DATASETS, load_quantised
+from input_pipeline import build_pipeline
+
+
+def quantise(images, q_levels):
+    """Quantise image into q levels"""
+    return (np.digitize(images, np.arange(q_levels) / q_levels) - 1).astype('float32')
+
+
+def peak_memory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(method, name, q_levels, batch_size, cache_dir, queue):
+    # Only measure the data, not the download or the start of TensorFlow
+    DATASETS[name].load_data()
+    tf.constant(0)
+    baseline = peak_memory()
+
+    start = time.time()
+    if method == 'scripts':
+        (x_train, _), _ = DATASETS[name].load_data()
+        x_train = x_train.astype('float32') / 255.
+        x_train = x_train.reshape(x_train.shape[:3] + (-1,))
+        x_train_quantised = quantise(x_train, q_levels)
+
+        dataset = tf.data.Dataset.from_tensor_slices((x_train_quantised / (q_levels - 1),
+                                                      x_train_quantised.astype('int32')))
+        dataset = dataset.batch(batch_size)
+    else:
+        (x_train_quantised, _), _ = load_quantised(name, q_levels, cache_dir=cache_dir)
+        dataset = build_pipeline(x_train_quantised, q_levels, batch_size, shuffle=False)
+    load_time = time.time() - start
+
+    start = time.time()
+    for batch_x, batch_y in dataset:
+        pass
+    epoch_time = time.time() - start
+
+    queue.put((load_time, epoch_time, peak_memory() - baseline))
+
+
+def main():
+    q_levels = 256
+    batch_size = 128
+
+    cache_dir = tempfile.mkdtemp()
+    context = multiprocessing.get_context('spawn')
+    try:
+        for name in ['mnist', 'cifar10']:
+            for method in ['scripts', 'cache (cold)', 'cache (warm)']:
+                queue = context.Queue()
+                process = context.Process(target=measure, args=(method, name, q_levels, batch_size, cache_dir, queue))
+                process.start()
+                load_time, epoch_time, peak = queue.get()
+                process.join()
+
+                print('{:>7} {:>12}: load {:6.2f} s, epoch {:6.2f} s, peak {:8.1f} MiB'.format(name,
+                                                                                             method,
+                                                                                             load_time,
+                                                                                             epoch_time,
+                                                                                             peak / 2 ** 20))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Data wait of the training loop with the input pipeline of the scripts and `build_pipeline`.
+
+The Gated PixelCNN is trained on binarised MNIST for a few hundred steps with the
+pipeline of the training scripts (a float32 and an int32 copy of the data in
+`from_tensor_slices`, a shuffle buffer of the whole set, no prefetch) and with
+`build_pipeline` on the uint8 memory map of `dataset_cache`. `DataWaitCounter` reports the
+fraction of the epoch spent waiting for batches, which includes filling the shuffle buffer
+at the start of the epoch.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from dataset_cache import load_quantised
+from input_pipeline import DataWaitCounter, build_pipeline
+from losses import nll
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '4 - Gated PixelCNN'))
+from gated_pixelCNN import build_gated_pixelcnn
+
+
+def scripts_pipeline(x_train_quantised, q_levels, batch_size):
+    x_train_quantised = np.array(x_train_quantised, dtype='float32')
+    dataset = tf.data.Dataset.from_tensor_slices((x_train_quantised / (q_levels - 1),
+                                                  x_train_quantised.astype('int32')))
+    dataset = dataset.shuffle(buffer_size=len(x_train_quantised))
+    return dataset.batch(batch_size)
+
+
+def main():
+    random_seed = 42
+    q_levels = 2
+    batch_size = 128
+    n_steps = 200
+
+    (x_train_quantised, _), _ = load_quantised('mnist', q_levels)
+    n_samples, height, width, n_channel = x_train_quantised.shape
+
+    for name, train_dataset in [('scripts', scripts_pipeline(x_train_quantised, q_levels, batch_size)),
+                                ('build_pipeline', build_pipeline(x_train_quantised, q_levels, batch_size,
+                                                                  seed=random_seed))]:
+        tf.random.set_seed(random_seed)
+        gated_pixelcnn = build_gated_pixelcnn(height, width, n_channel, q_levels)
+        optimizer = keras.optimizers.Adam(learning_rate=1e-3)
+
+        @tf.function
+        def train_step(batch_x, batch_y):
+            with tf.GradientTape() as ae_tape:
+                logits = gated_pixelcnn(batch_x, training=True)
+                loss = nll(batch_y, logits)
+
+            gradients = ae_tape.gradient(loss, gated_pixelcnn.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, gated_pixelcnn.trainable_variables))
+            return loss
+
+        # Trace the training step outside the measured epoch
+        batch_x, batch_y = next(iter(train_dataset))
+        train_step(batch_x, batch_y)
+
+        data_wait = DataWaitCounter()
+        start = time.time()
+        for batch_x, batch_y in data_wait.epoch(train_dataset.take(n_steps)):
+            loss = train_step(batch_x, batch_y)
+        loss.numpy()
+        elapsed = time.time() - start
+
+        print('{:>14}: {:.2f} s for {:} steps, {:.1f} ms/step, data wait {:.1%}'.format(name,
+                                                                                       elapsed,
+                                                                                       n_steps,
+                                                                                       elapsed / n_steps * 1000,
+                                                                                       data_wait.wait_fraction))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Time and memory of the loss of a training step with one-hot and with sparse targets.
+
+The logits of a batch of the 256-level CIFAR-10 setup (shape [N, 32, 32, 3 * 256]) go
+through the loss and its gradient with respect to the logits, as in the training step:
+- 'one-hot': the logits ordered as [N, H, W, D, C] are reshaped and transposed to
+    [N, H, W, C, D], and `CategoricalCrossentropy` compares them with
+    `tf.one_hot(batch_y, q_levels)`, as in the scripts before losses.py.
+- 'sparse': the same logits ordered as [N, H, W, C, D] by a channel-major head go through
+    `losses.nll` with the integer targets.
+Both must give the same loss and the same gradients, up to the order of the logits. The
+peak memory is the peak of the CPU allocator during the step, above what was allocated
+before it.
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from losses import bits_per_dim, nll
+
+
+def peak_memory(function, *args):
+    """Peak number of bytes allocated on the CPU while running `function`, above the bytes already allocated."""
+    tf.config.experimental.reset_memory_stats('CPU:0')
+    before = tf.config.experimental.get_memory_info('CPU:0')['current']
+    function(*args)
+    return tf.config.experimental.get_memory_info('CPU:0')['peak'] - before
+
+
+def main():
+    random_seed = 42
+    batch_size = 16
+    height = 32
+    width = 32
+    n_channel = 3
+    q_levels = 256
+    n_repeats = 20
+
+    rng = np.random.RandomState(random_seed)
+    batch_y = tf.constant(rng.randint(q_levels, size=(batch_size, height, width, n_channel)), dtype=tf.int32)
+    logits_cd = rng.normal(size=(batch_size, height, width, n_channel, q_levels)).astype('float32')
+    # Same logits in the order of the heads of the scripts, [N, H, W, D, C]
+    logits_dc = tf.constant(np.swapaxes(logits_cd, 3, 4).reshape(batch_size, height, width, -1))
+    logits_cd = tf.constant(logits_cd.reshape(batch_size, height, width, -1))
+
+    compute_loss = keras.losses.CategoricalCrossentropy(from_logits=True)
+
+    def one_hot_loss(logits):
+        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
+        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
+        return compute_loss(tf.one_hot(batch_y, q_levels), logits)
+
+    def sparse_loss(logits):
+        return nll(batch_y, logits)
+
+    results = {}
+    for name, loss_function, logits in [('one-hot', one_hot_loss, logits_dc),
+                                        ('sparse', sparse_loss, logits_cd)]:
+        @tf.function
+        def step(logits, loss_function=loss_function):
+            with tf.GradientTape() as tape:
+                tape.watch(logits)
+                loss = loss_function(logits)
+            return loss, tape.gradient(loss, logits)
+
+        loss, gradients = step(logits)
+
+        start = time.time()
+        for _ in range(n_repeats):
+            step(logits)[0].numpy()
+        step_time = (time.time() - start) / n_repeats
+
+        memory = peak_memory(lambda logits: step(logits)[0].numpy(), logits)
+        results[name] = (loss, gradients)
+        print('{:>8}: {:7.2f} ms/step, peak memory {:7.1f} MiB, loss {:.6f} nats ({:.6f} bits/dim)'.format(
+            name, step_time * 1000, memory / 2 ** 20, float(loss), float(bits_per_dim(loss))))
+
+    loss_dc, gradients_dc = results['one-hot']
+    loss_cd, gradients_cd = results['sparse']
+    gradients_dc = tf.transpose(tf.reshape(gradients_dc, [-1, height, width, q_levels, n_channel]), [0, 1, 2, 4, 3])
+    gradients_cd = tf.reshape(gradients_cd, [-1, height, width, n_channel, q_levels])
+    print('Loss difference {:.2e}, largest gradient difference {:.2e}'.format(
+        abs(float(loss_dc) - float(loss_cd)),
+        float(tf.reduce_max(tf.abs(gradients_dc - gradients_cd)))))
+    print('The one-hot targets alone take {:.1f} MiB'.format(batch_y.shape.num_elements() * q_levels * 4 / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Bits/dim and throughput of the PixelCNN models in float32 and with 'mixed_bfloat16'.
+
+For PixelCNN, the Gated PixelCNN and the conditioned Gated PixelCNN, a float32 model and a
+mixed precision model (bfloat16 activations, float32 weights, logits and loss) start from
+the same weights and are trained for a few steps on the same batches of binarised MNIST.
+The test bits/dim of both must agree within `tolerance`, and so must the bits/dim of the
+float32 weights evaluated with the mixed precision model. The training step time and the
+images per second of the forward pass are measured for both policies.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from dataset_cache import load_quantised
+from input_pipeline import build_pipeline
+from losses import bits_per_dim, nll
+from train_gatedpixelcnn2_conditioned import build_conditioned_gated_pixelcnn
+from trainer import MultiStepTrainer, exponential_decay
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '4 - Gated PixelCNN'))
+from gated_pixelCNN import build_gated_pixelcnn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '1 - Autoregressive Models - PixelCNN'))
+from pixelCNN import build_pixelcnn
+
+
+def compute_nll(model, batch_x, batch_y, batch_label, training=False):
+    """Mean negative log-likelihood in nats per sub-pixel, computed in float32."""
+    logits = model([batch_x, batch_label] if len(model.inputs) == 2 else batch_x, training=training)
+    return nll(batch_y, logits)
+
+
+def test_bits_per_dim(model, dataset):
+    return bits_per_dim(np.mean([compute_nll(model, *batch).numpy() for batch in dataset]))
+
+
+def images_per_second(model, dataset):
+    forward = tf.function(lambda batch: compute_nll(model, *batch))
+    forward(next(iter(dataset)))
+
+    start = time.time()
+    n_images = 0
+    for batch in dataset:
+        forward(batch).numpy()
+        n_images += batch[0].shape[0]
+    return n_images / (time.time() - start)
+
+
+def main():
+    random_seed = 42
+    q_levels = 2
+    batch_size = 16
+    steps_per_call = 10
+    n_steps = 20
+    n_test = 128
+    tolerance = 0.01  # bits/dim
+    learning_rate = 1e-3
+    lr_decay = 0.9995
+
+    (x_train_quantised, y_train), (x_test_quantised, y_test) = load_quantised('mnist', q_levels)
+    n_samples, height, width, n_channel = x_train_quantised.shape
+    train_dataset = build_pipeline(x_train_quantised[:batch_size * n_steps], q_levels, batch_size,
+                                   labels=y_train[:batch_size * n_steps], shuffle=False)
+    test_dataset = build_pipeline(x_test_quantised[:n_test], q_levels, 64, labels=y_test[:n_test], shuffle=False)
+
+    tf.random.set_seed(random_seed)
+    for name, build in [('PixelCNN', build_pixelcnn),
+                        ('Gated PixelCNN', build_gated_pixelcnn),
+                        ('conditioned Gated', build_conditioned_gated_pixelcnn)]:
+        models = {}
+        initial_weights = None
+        for policy in ['float32', 'mixed_bfloat16']:
+            keras.mixed_precision.set_global_policy(policy)
+            model = build(height, width, n_channel, q_levels)
+            if initial_weights is None:
+                initial_weights = model.get_weights()
+            model.set_weights(initial_weights)
+
+            optimizer = keras.optimizers.Adam(learning_rate=exponential_decay(learning_rate, lr_decay))
+            trainer = MultiStepTrainer(model, optimizer,
+                                       lambda *batch, model=model: compute_nll(model, *batch, training=True),
+                                       steps_per_call=steps_per_call)
+
+            # The first call traces the training step and is not timed
+            times = []
+            start = time.time()
+            for i_iter, loss in trainer.epoch(train_dataset):
+                times.append(time.time() - start)
+                start = time.time()
+            step_time = sum(times[1:]) / (len(times) - 1) / steps_per_call
+
+            models[policy] = model
+            print('{:>17} {:>14}: train {:7.1f} ms/step, forward {:6.1f} images/s, '
+                  'test {:.4f} bits/dim'.format(name,
+                                                policy,
+                                                step_time * 1000,
+                                                images_per_second(model, test_dataset),
+                                                test_bits_per_dim(model, test_dataset)))
+
+        # Same float32 weights evaluated by both policies
+        models['mixed_bfloat16'].set_weights(models['float32'].get_weights())
+        difference = abs(test_bits_per_dim(models['mixed_bfloat16'], test_dataset) -
+                         test_bits_per_dim(models['float32'], test_dataset))
+        print('{:>17} {:>14}: {:.4f} bits/dim between the policies with the same weights, '
+              '{:}'.format(name, '', difference, 'OK' if difference < tolerance else 'ABOVE TOLERANCE'))
+
+    keras.mixed_precision.set_global_policy('float32')
+
+
+if __name__ == '__main__':
+    main()
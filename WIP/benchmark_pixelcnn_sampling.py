@@ -0,0 +1,82 @@
+"""Benchmark of the samplers of the PixelCNN of part 1 on CPU.
+
+All the samplers run on the same untrained model with the same random seed, so they must
+generate the same images. The sampling speed does not depend on the trained weights. The
+default model with 15 residual blocks is compared with a model with 8 dilated blocks, which
+sees more rows above each pixel. Jacobi decoding then runs with the Gumbel noise of the
+sequential sampler, whose images it must reproduce in fewer forward passes.
+"""
+import os
+import sys
+import time
+
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import numpy as np
+import tensorflow as tf
+
+from sampling import gumbel_noise, jacobi_sample, sample
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '1 - Autoregressive Models - PixelCNN'))
+from pixelCNN import build_pixelcnn, cached_sample, cropped_sample, queue_sample, receptive_field_rows
+
+
+def main():
+    random_seed = 42
+    height = 28
+    width = 28
+    n_channel = 1
+    q_levels = 2
+    num_generated_images = 10
+
+    for model_name, dilation_rates in [('15 blocks', None), ('8 dilated blocks', [1, 2, 4, 8, 1, 2, 4, 8])]:
+        pixelcnn = build_pixelcnn(height, width, n_channel, q_levels, dilation_rates=dilation_rates)
+        print('{:}: {:} rows of receptive field'.format(model_name, receptive_field_rows(pixelcnn)))
+
+        results = {}
+        for name, sampler in [('naive', sample),
+                              ('cropped', cropped_sample),
+                              ('cached', cached_sample),
+                              ('queue', queue_sample)]:
+            tf.random.set_seed(random_seed)
+            samples = np.zeros((num_generated_images, height, width, n_channel), dtype='float32')
+
+            start = time.time()
+            samples = sampler(pixelcnn, samples, q_levels)
+            elapsed = time.time() - start
+
+            results[name] = samples
+            print('{:>7}: {:.2f} s, {:.3f} images/second'.format(name,
+                                                                 elapsed,
+                                                                 num_generated_images / elapsed))
+
+        for name in results:
+            n_different = np.sum(results['naive'] != results[name])
+            print('{:>7}: {:} of {:} pixels differ from naive'.format(name,
+                                                                      n_different,
+                                                                      results['naive'].size))
+
+        # Jacobi decoding with the noise of the sequential sampler
+        np.random.seed(random_seed)
+        noise = gumbel_noise((num_generated_images, height, width, q_levels))
+
+        samples = np.zeros((num_generated_images, height, width, n_channel), dtype='float32')
+        start = time.time()
+        sequential = sample(pixelcnn, samples, q_levels, noise=noise)
+        sequential_time = time.time() - start
+
+        samples = np.zeros((num_generated_images, height, width, n_channel), dtype='float32')
+        start = time.time()
+        samples, n_iterations = jacobi_sample(pixelcnn, samples, q_levels, noise=noise)
+        jacobi_time = time.time() - start
+
+        print('sequential: {:.2f} s, {:} forward passes'.format(sequential_time, height * width))
+        print('    jacobi: {:.2f} s, {:} forward passes, {:} of {:} pixels differ from sequential'.format(
+            jacobi_time,
+            n_iterations,
+            np.sum(sequential != samples),
+            samples.size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Checks and benchmarks of the PixelSNAIL samplers on CPU.
+
+The cached forward pass must give the same logits as the full forward pass at every position,
+with and without conditioning and with downsampled attention. Both samplers run on the same
+untrained model, with and without conditioning, with the same random seed, so they must
+generate the same images. The Jacobi sampler must also give the same images as the
+sequential sampler with the same Gumbel noise.
+"""
+import time
+
+import torch
+
+from pixelsnail import PixelSNAIL, cached_sample, gumbel_noise, jacobi_sample, sample
+
+
+def max_forward_at_difference(model, input, condition=None):
+    out, _ = model(input, condition=condition)
+
+    cache = {}
+    max_difference = 0
+    for i in range(input.shape[1]):
+        for j in range(input.shape[2]):
+            out_at, cache = model.forward_at(input, i, j, condition=condition, cache=cache)
+            max_difference = max(max_difference, (out_at - out[:, :, i, j]).abs().max().item())
+
+    return max_difference
+
+
+@torch.no_grad()
+def main():
+    random_seed = 42
+    height = 16
+    width = 16
+    n_class = 64
+    num_generated_images = 8
+
+    torch.manual_seed(random_seed)
+    input = torch.randint(n_class, (4, height, width))
+    condition = torch.randint(n_class, (4, height // 2, width // 2))
+
+    model = PixelSNAIL([height, width], n_class, 64, 5, 2, 2, 64).eval()
+    conditioned_model = PixelSNAIL([height, width], n_class, 64, 5, 2, 2, 64,
+                                   n_cond_res_block=2, cond_res_channel=32).eval()
+    downsampled_model = PixelSNAIL([height, width], n_class, 64, 5, 2, 2, 64,
+                                   attn_downsample=[2, 3]).eval()
+
+    print('max logit difference: {:.3g} (unconditioned), {:.3g} (conditioned), '
+          '{:.3g} (downsampled attention)'.format(
+              max_forward_at_difference(model, input),
+              max_forward_at_difference(conditioned_model, input, condition),
+              max_forward_at_difference(downsampled_model, input)))
+
+    sample_condition = torch.randint(n_class, (num_generated_images, height // 2, width // 2))
+    for model_name, sampled_model, model_condition in [('unconditioned', model, None),
+                                                       ('conditioned', conditioned_model, sample_condition)]:
+        results = {}
+        for name, sampler in [('naive', sample), ('cached', cached_sample)]:
+            torch.manual_seed(random_seed)
+
+            start = time.time()
+            samples = sampler(sampled_model, num_generated_images, (height, width), condition=model_condition)
+            elapsed = time.time() - start
+
+            results[name] = samples
+            print('{:>13} {:>6}: {:.2f} s, {:.3f} images/second'.format(model_name,
+                                                                        name,
+                                                                        elapsed,
+                                                                        num_generated_images / elapsed))
+
+        n_different = (results['naive'] != results['cached']).sum().item()
+        print('{:>13} cached: {:} of {:} pixels differ from naive'.format(model_name,
+                                                                         n_different,
+                                                                         results['naive'].numel()))
+
+    for name, jacobi_model in [('jacobi', model), ('jacobi (downsampled attention)', downsampled_model)]:
+        noise = gumbel_noise((num_generated_images, n_class, height, width))
+        sequential = sample(jacobi_model, num_generated_images, (height, width), noise=noise)
+
+        start = time.time()
+        parallel, n_iteration = jacobi_sample(jacobi_model, num_generated_images, (height, width), noise=noise)
+        elapsed = time.time() - start
+
+        print('{:}: {:.2f} s, {:} forward passes instead of {:}, {:} pixels differ from '
+              'sequential'.format(name,
+                                  elapsed,
+                                  n_iteration,
+                                  height * width,
+                                  (parallel != sequential).sum().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Throughput and latency of the sampling service under a synthetic load.
+
+A load generator sends a mix of unconditional, class-conditional and inpainting requests
+with Poisson arrivals to a `SamplingService` running in the same process, and measures the
+latency of every request from the client side. The service is run without batching, with
+batches of increasing size, and with continuous batching, where every slot of the batch
+takes a new request as soon as its image is complete. The latency of the inpainting jobs,
+which generate fewer rows, is also given on its own, as well as the time to the first row of
+a streamed request on the idle service. The speed does not depend on the
+trained weights, so the service runs an untrained class-conditional Gated PixelCNN.
+"""
+import asyncio
+import os
+import time
+
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import numpy as np
+import tensorflow as tf
+
+from sampling_service import ContinuousBatchingService, SamplingClient, SamplingService
+from train_gatedpixelcnn2_conditioned import build_conditioned_gated_pixelcnn
+
+
+async def timed(request):
+    start = time.time()
+    await request
+    return time.time() - start
+
+
+async def generate_load(client, n_requests, rate, shape, q_levels, n_classes, random_seed):
+    """Send `n_requests` requests at `rate` requests per second on average.
+
+    Returns the latency of every request in seconds, the type of every request and the
+    total time.
+    """
+    rng = np.random.RandomState(random_seed)
+    height = shape[0]
+
+    start = time.time()
+    requests = []
+    request_types = []
+    for seed in range(n_requests):
+        await asyncio.sleep(rng.exponential(1 / rate))
+
+        request_type = rng.choice(['unconditional', 'class', 'inpainting'])
+        if request_type == 'unconditional':
+            request = client.sample(seed=seed)
+        elif request_type == 'class':
+            request = client.sample(label=rng.randint(n_classes), seed=seed)
+        else:
+            image = rng.randint(q_levels, size=shape)
+            request = client.inpaint(image, rng.randint(height // 4, 3 * height // 4), seed=seed)
+
+        requests.append(asyncio.ensure_future(timed(request)))
+        request_types.append(request_type)
+
+    latencies = await asyncio.gather(*requests)
+    return np.array(latencies), np.array(request_types), time.time() - start
+
+
+async def run(service, shape, q_levels, n_classes, n_requests, rate, port):
+    await service.start('127.0.0.1', port)
+
+    client = SamplingClient()
+    await client.connect('127.0.0.1', port)
+
+    # The first batch traces the sampling functions
+    await client.sample(seed=0)
+
+    start = time.time()
+    first_row = None
+    async for _ in client.stream(seed=0):
+        if first_row is None:
+            first_row = time.time() - start
+    stream_time = time.time() - start
+
+    latencies, request_types, elapsed = await generate_load(client, n_requests, rate, shape, q_levels, n_classes,
+                                                            random_seed=42)
+
+    await client.close()
+    await service.close()
+    return latencies, request_types, elapsed, first_row, stream_time
+
+
+def main():
+    height = 28
+    width = 28
+    n_channel = 1
+    q_levels = 256
+    n_classes = 10
+    n_requests = 64
+    rate = 4.
+
+    tf.random.set_seed(42)
+    pixelcnn = build_conditioned_gated_pixelcnn(height, width, n_channel, q_levels)
+
+    shape = (height, width, n_channel)
+    services = [('max_batch_size=1 max_wait=0.00', SamplingService(pixelcnn, shape, n_classes, 1, 0.)),
+                ('max_batch_size=8 max_wait=0.05', SamplingService(pixelcnn, shape, n_classes, 8, 0.05)),
+                ('max_batch_size=32 max_wait=0.05', SamplingService(pixelcnn, shape, n_classes, 32, 0.05)),
+                ('continuous, 8 slots', ContinuousBatchingService(pixelcnn, shape, n_classes, 8)),
+                ('continuous, 32 slots', ContinuousBatchingService(pixelcnn, shape, n_classes, 32))]
+
+    for port, (name, service) in enumerate(services, start=8765):
+        latencies, request_types, elapsed, first_row, stream_time = asyncio.run(run(service, shape, q_levels,
+                                                                                    n_classes, n_requests,
+                                                                                    rate, port))
+        inpainting = request_types == 'inpainting'
+
+        print('{:<31}: {:.2f} requests/second, latency p50 {:.2f} s, p99 {:.2f} s, '
+              'inpainting p50 {:.2f} s'.format(name,
+                                               n_requests / elapsed,
+                                               np.percentile(latencies, 50),
+                                               np.percentile(latencies, 99),
+                                               np.percentile(latencies[inpainting], 50)))
+        print('{:<31}: streamed image, first row after {:.2f} s of {:.2f} s'.format('', first_row, stream_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Time per training step of the Python training loop and of `MultiStepTrainer`.
+
+A Gated PixelCNN with 3 blocks is trained on binarised MNIST with the loop of the scripts
+(the learning rate updated from Python and the loss read back at every step) and with
+`MultiStepTrainer` running 1 and 50 steps per call, with and without the measurement of
+the data wait. What running several steps per call saves is the Python dispatch and the
+read back of every step, which only shows next to a small step, so the runs use batches of
+1 and of 16 images. All the runs of a batch size start from the same weights and see the
+same batches in the same order, so their mean losses must match up to the rounding of the
+computations.
+
+The batches come from `in_memory_dataset` rather than from `build_pipeline`: on a single
+core, the threads of the pipeline cannot run alongside the step, and waking them up
+between steps left the process idle for up to half of the epoch, in steps of about 51 ms.
+That noise hid the difference between the loops, which `benchmark_input_pipeline.py`
+leaves to the pipeline. When MNIST cannot be loaded (e.g. on a
+machine without network access), the runs use random binary images of the same shape,
+which cost the same per step.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from dataset_cache import load_quantised
+from losses import nll
+from trainer import MultiStepTrainer, exponential_decay
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '4 - Gated PixelCNN'))
+from gated_pixelCNN import build_gated_pixelcnn
+
+
+def in_memory_dataset(images, q_levels, batch_size):
+    """Batches of (x, y) as from `build_pipeline`, prepared by the thread that asks for them.
+
+    The images are converted up front and the dataset has no parallel map, no prefetch and
+    no autotuning, so getting a batch never waits for another thread.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(((images / (q_levels - 1)).astype('float32'),
+                                                  images.astype('int32')))
+    options = tf.data.Options()
+    options.autotune.enabled = False
+    options.experimental_optimization.inject_prefetch = False
+    return dataset.batch(batch_size).with_options(options)
+
+
+def main():
+    random_seed = 42
+    q_levels = 2
+    n_steps = 100
+    n_rounds = 3
+    learning_rate = 1e-3
+    lr_decay = 0.999
+
+    try:
+        (x_train_quantised, _), _ = load_quantised('mnist', q_levels)
+    except Exception as error:
+        print('MNIST could not be loaded ({:}), using random binary images'.format(error))
+        rng = np.random.RandomState(random_seed)
+        x_train_quantised = rng.randint(q_levels, size=(16 * n_steps, 28, 28, 1)).astype('uint8')
+    n_samples, height, width, n_channel = x_train_quantised.shape
+
+    tf.random.set_seed(random_seed)
+    gated_pixelcnn = build_gated_pixelcnn(height, width, n_channel, q_levels, dilation_rates=[1, 1])
+    initial_weights = gated_pixelcnn.get_weights()
+
+    def batch_loss(batch_x, batch_y):
+        logits = gated_pixelcnn(batch_x, training=True)
+        return nll(batch_y, logits)
+
+    for batch_size in [1, 16]:
+        print('Batches of {:} images'.format(batch_size))
+        train_dataset = in_memory_dataset(x_train_quantised[:batch_size * n_steps], q_levels, batch_size)
+
+        runs = []
+        for name, steps_per_call, measure_wait in [('python loop', None, False),
+                                                   ('trainer K=1', 1, False),
+                                                   ('trainer K=50', 50, False),
+                                                   ('K=50 + wait', 50, True)]:
+            if steps_per_call is None:
+                optimizer = keras.optimizers.Adam(learning_rate=learning_rate)
+
+                @tf.function
+                def train_step(batch_x, batch_y, optimizer=optimizer):
+                    with tf.GradientTape() as ae_tape:
+                        loss = batch_loss(batch_x, batch_y)
+
+                    gradients = ae_tape.gradient(loss, gated_pixelcnn.trainable_variables)
+                    gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
+                    optimizer.apply_gradients(zip(gradients, gated_pixelcnn.trainable_variables))
+                    return loss
+
+                # Same learning rates as exponential_decay: the first step uses learning_rate
+                def run_epoch(optimizer=optimizer, train_step=train_step, train_dataset=train_dataset):
+                    losses = []
+                    for i_iter, (batch_x, batch_y) in enumerate(train_dataset):
+                        optimizer.learning_rate = learning_rate * lr_decay ** i_iter
+                        losses.append(train_step(batch_x, batch_y).numpy())
+                    return np.mean(losses)
+            else:
+                optimizer = keras.optimizers.Adam(learning_rate=exponential_decay(learning_rate, lr_decay))
+                trainer = MultiStepTrainer(gated_pixelcnn, optimizer, batch_loss, steps_per_call=steps_per_call,
+                                           measure_wait=measure_wait)
+
+                def run_epoch(trainer=trainer, train_dataset=train_dataset):
+                    for i_iter, loss in trainer.epoch(train_dataset):
+                        pass
+                    return loss
+
+            # The first epoch traces the functions
+            run_epoch()
+            runs.append((name, optimizer, run_epoch))
+
+        # The speed of the machine drifts over minutes, so the loops take turns and each
+        # keeps its fastest epoch, always trained from the initial state
+        step_times = {}
+        losses = {}
+        for _ in range(n_rounds):
+            for name, optimizer, run_epoch in runs:
+                gated_pixelcnn.set_weights(initial_weights)
+                for variable in optimizer.variables():
+                    variable.assign(tf.zeros_like(variable))
+
+                start = time.time()
+                losses[name] = run_epoch()
+                elapsed = time.time() - start
+                step_times[name] = min(step_times.get(name, np.inf), elapsed / n_steps)
+
+        for name, _, _ in runs:
+            print('{:>13}: {:.2f} ms/step, mean loss {:.6f}'.format(name, step_times[name] * 1000, losses[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Step time of the training step with `tf.function` and with XLA on CPU, and its fusions.
+
+PixelCNN, the Gated PixelCNN and the conditioned Gated PixelCNN are trained on binarised
+MNIST with `MultiStepTrainer`, once as a plain `tf.function` and once with
+`jit_compile=True`, from the same weights and on the same batches. For the XLA step, the
+optimised HLO shows which operations of the forward pass end up in a fusion with other
+operations: the multiplication of the kernels by their masks, the bias additions and the
+tanh, sigmoid and multiplication of the gates.
+"""
+import collections
+import os
+import re
+import sys
+import time
+
+import tensorflow as tf
+from tensorflow import keras
+
+from dataset_cache import load_quantised
+from input_pipeline import build_pipeline
+from losses import nll
+from train_gatedpixelcnn2_conditioned import build_conditioned_gated_pixelcnn
+from trainer import MultiStepTrainer, exponential_decay
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '4 - Gated PixelCNN'))
+from gated_pixelCNN import build_gated_pixelcnn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '1 - Autoregressive Models - PixelCNN'))
+from pixelCNN import build_pixelcnn
+
+# Operations of the forward pass, by the name of the TensorFlow operation they come from
+CHECKED_OPS = collections.OrderedDict([
+    ('mask multiply', r'masked_conv2d(_\d+)?/Mul$'),
+    ('bias add', r'/BiasAdd$'),
+    ('gate tanh', r'/Tanh(_\d+)?$'),
+    ('gate sigmoid', r'/Sigmoid(_\d+)?$'),
+    ('gate multiply', r'gated_block(_\d+)?/mul(_1)?$'),
+])
+
+
+def fused_computations(hlo):
+    """Names of the TensorFlow operations in every fused computation of an HLO module."""
+    computation = None
+    op_names = collections.defaultdict(set)
+    fused = set()
+    for line in hlo.splitlines():
+        header = re.match(r'^(?:ENTRY )?%(\S+) ', line)
+        if header:
+            computation = header.group(1)
+            continue
+
+        fused.update(re.findall(r'fusion\(.*calls=%([\w.\-]+)', line))
+        op_name = re.search(r'op_name="([^"]+)"', line)
+        if computation is not None and op_name is not None and ' parameter(' not in line:
+            op_names[computation].add(op_name.group(1))
+    return [op_names[name] for name in fused]
+
+
+def fusion_report(hlo):
+    """For every checked operation of the forward pass, how many of its instances share a fusion
+    with other operations."""
+    computations = [{name for name in op_names if not name.startswith('gradient_tape')}
+                    for op_names in fused_computations(hlo)]
+
+    report = collections.OrderedDict()
+    for label, pattern in CHECKED_OPS.items():
+        instances = set()
+        fused = set()
+        for op_names in computations:
+            for name in op_names:
+                if re.search(pattern, name):
+                    instances.add(name)
+                    if len(op_names) > 1:
+                        fused.add(name)
+        report[label] = (len(fused), len(instances))
+    return report
+
+
+def main():
+    random_seed = 42
+    q_levels = 2
+    batch_size = 16
+    steps_per_call = 10
+    n_calls = 2
+    learning_rate = 1e-3
+    lr_decay = 0.9995
+
+    (x_train_quantised, y_train), _ = load_quantised('mnist', q_levels)
+    n_samples, height, width, n_channel = x_train_quantised.shape
+    n_images = batch_size * steps_per_call * n_calls
+    train_dataset = build_pipeline(x_train_quantised[:n_images], q_levels, batch_size,
+                                   labels=y_train[:n_images], shuffle=False)
+
+    tf.random.set_seed(random_seed)
+
+    for name, model in [('PixelCNN', build_pixelcnn(height, width, n_channel, q_levels)),
+                        ('Gated PixelCNN', build_gated_pixelcnn(height, width, n_channel, q_levels)),
+                        ('conditioned Gated', build_conditioned_gated_pixelcnn(height, width, n_channel, q_levels))]:
+        initial_weights = model.get_weights()
+        conditioned = len(model.inputs) == 2
+
+        def batch_loss(batch_x, batch_y, batch_label, model=model, conditioned=conditioned):
+            logits = model([batch_x, batch_label] if conditioned else batch_x, training=True)
+            return nll(batch_y, logits)
+
+        for jit_compile in [False, True]:
+            model.set_weights(initial_weights)
+            optimizer = keras.optimizers.Adam(learning_rate=exponential_decay(learning_rate, lr_decay))
+            trainer = MultiStepTrainer(model, optimizer, batch_loss, steps_per_call=steps_per_call,
+                                       jit_compile=jit_compile)
+
+            # The first call traces (and compiles) the step and is not timed
+            times = []
+            start = time.time()
+            for i_iter, loss in trainer.epoch(train_dataset):
+                times.append(time.time() - start)
+                start = time.time()
+
+            print('{:>17} {:>11}: first call {:6.2f} s, {:7.1f} ms/step, mean loss {:.6f}'.format(
+                name,
+                'XLA' if jit_compile else 'tf.function',
+                times[0],
+                sum(times[1:]) / (len(times) - 1) / steps_per_call * 1000,
+                loss))
+
+        batch = next(iter(train_dataset))
+        for label, (fused, instances) in fusion_report(trainer.step_hlo(batch)).items():
+            if instances > 0:
+                print('{:>31}: {:2d} of {:2d} fused with other operations'.format(label, fused, instances))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Cache of the quantised datasets as memory-mapped uint8 arrays.
+
+The training scripts load a Keras dataset, convert it to float32, quantise it with
+`np.digitize` on every run and then keep a float32 input copy and an int32 target copy of
+the whole set, 8 bytes per sub-pixel for values that fit in one byte. Here every dataset is
+quantised once per number of levels into uint8 `.npy` files, which later runs open as
+memory maps, and `input_pipeline.build_pipeline` derives the float input and the int32
+target from the uint8 values batch by batch inside the `tf.data` pipeline.
+"""
+import os
+
+import numpy as np
+from tensorflow import keras
+
+DATASETS = {
+    'mnist': keras.datasets.mnist,
+    'fashion_mnist': keras.datasets.fashion_mnist,
+    'cifar10': keras.datasets.cifar10,
+}
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.keras', 'datasets', 'quantised')
+
+
+def quantise(images, q_levels, chunk_size=10000):
+    """Quantise uint8 images into q levels, as the `quantise` of the training scripts.
+
+    The images are scaled to [0, 1] in float32 and digitized chunk by chunk, which gives
+    the same levels as the training scripts without a float copy of the whole set.
+
+    Returns:
+    Array of uint8 with the same shape as `images`.
+    """
+    assert q_levels <= 256
+    bins = np.arange(q_levels) / q_levels
+
+    quantised = np.empty(images.shape, dtype='uint8')
+    for start in range(0, len(images), chunk_size):
+        chunk = images[start:start + chunk_size].astype('float32') / 255.
+        quantised[start:start + chunk_size] = np.digitize(chunk, bins) - 1
+    return quantised
+
+
+def _save(path, array):
+    # Write to a temporary file first, so an interrupted run never leaves a partial file
+    np.save(path + '.tmp.npy', array)
+    os.replace(path + '.tmp.npy', path)
+
+
+def load_quantised(name, q_levels, cache_dir=None):
+    """Load a Keras dataset quantised into q levels, from the cache when possible.
+
+    The first call for a dataset and a number of levels quantises the images and saves
+    them in `cache_dir`. Later calls only open the cached files.
+
+    Arguments:
+    name: name of the dataset, a key of `DATASETS`.
+    q_levels: number of quantisation levels, at most 256.
+    cache_dir: directory of the cached files, `CACHE_DIR` by default.
+
+    Returns:
+    (x_train, y_train), (x_test, y_test), where the images are read-only uint8 memory maps
+    with shape [N, H, W, C] and the labels are int32 arrays with shape [N].
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    prefix = os.path.join(cache_dir, '{:}_q{:}'.format(name, q_levels))
+    paths = [prefix + '_{:}.npy'.format(split) for split in ['x_train', 'y_train', 'x_test', 'y_test']]
+
+    if not all(os.path.exists(path) for path in paths):
+        os.makedirs(cache_dir, exist_ok=True)
+        (x_train, y_train), (x_test, y_test) = DATASETS[name].load_data()
+
+        for path, array in zip(paths, [x_train, y_train, x_test, y_test]):
+            if array.ndim == 1:
+                array = array.astype('int32')
+            elif array.ndim == 2:
+                # Labels with shape [N, 1], as in CIFAR-10
+                array = array[:, 0].astype('int32')
+            else:
+                # Images get a channel axis if they have none
+                array = quantise(array.reshape(array.shape[:3] + (-1,)), q_levels)
+            _save(path, array)
+
+    x_train, y_train, x_test, y_test = [np.load(path, mmap_mode='r') for path in paths]
+    return (x_train, np.array(y_train)), (x_test, np.array(y_test))
+
@@ -0,0 +1,101 @@
+"""Input pipeline of the training scripts, with the data preparation overlapping training.
+
+With `from_tensor_slices(...).shuffle(buffer_size=60000)` the shuffle buffer holds a second
+copy of the whole training set, and every batch is prepared by the training loop between
+two steps. `build_pipeline` shuffles the indices of the images instead, gathers every
+batch from the (memory-mapped) uint8 store, quantises and normalises it in a parallel map
+and prefetches the batches, so the next batches are prepared while a step runs.
+`DataWaitCounter` measures how long the training loop still waits for its batches.
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def build_pipeline(images, q_levels, batch_size, labels=None, shuffle=True, seed=None, raw=False):
+    """Build a `tf.data` pipeline of training batches from a uint8 image store.
+
+    Arguments:
+    images: uint8 array with shape [N, H, W, C], e.g. memory-mapped by
+        `dataset_cache.load_quantised`. Only the images of each batch are read.
+    q_levels: number of quantisation levels.
+    batch_size: number of images per batch.
+    labels: optional array with shape [N] with the class of every image.
+    shuffle: if True, the images are shuffled again at every epoch.
+    seed: seed of the shuffling.
+    raw: if True, `images` holds the values in [0, 255] of the Keras datasets, which are
+        quantised in the map as by the `quantise` of the training scripts. Otherwise the
+        images are already quantised.
+
+    Returns:
+    Dataset of (x, y) batches, or (x, y, label) batches if `labels` is given, where x is
+    the input scaled to [0, 1] and y the int32 quantised values.
+    """
+    n_samples, height, width, n_channel = images.shape
+    bins = tf.constant(np.arange(q_levels) / q_levels)
+
+    def gather(indices):
+        # Reading the rows of the memory map in order is faster, and the order of the
+        # images within a batch does not matter
+        indices = np.sort(indices)
+        batch_labels = np.zeros(len(indices), dtype='int32') if labels is None else labels[indices]
+        return np.asarray(images[indices]), batch_labels.astype('int32')
+
+    def prepare(indices):
+        batch, batch_labels = tf.numpy_function(gather, [indices], [tf.uint8, tf.int32])
+        batch = tf.ensure_shape(batch, [None, height, width, n_channel])
+
+        if raw:
+            # Same levels as np.digitize(images / 255., bins) - 1
+            values = tf.cast(tf.cast(batch, tf.float32) / 255., tf.float64)
+            y = tf.searchsorted(bins[None, :], tf.reshape(values, [1, -1]), side='right') - 1
+            y = tf.reshape(y, tf.shape(batch))
+        else:
+            y = tf.cast(batch, tf.int32)
+        x = tf.cast(y, tf.float32) / (q_levels - 1)
+
+        if labels is None:
+            return x, y
+        return x, y, tf.ensure_shape(batch_labels, [None])
+
+    dataset = tf.data.Dataset.range(n_samples)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=n_samples, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(prepare, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+class DataWaitCounter(object):
+    """Time the training loop spends waiting for its batches.
+
+    The loop iterates over `counter.epoch(dataset)` instead of `dataset`. The time spent
+    getting every batch is the data wait, and after the epoch `wait_fraction` is the
+    fraction of the epoch it took. A fraction close to 0 means that the input pipeline
+    keeps up with the training steps.
+    """
+
+    def __init__(self):
+        self.wait_time = 0.
+        self.epoch_time = 0.
+
+    def epoch(self, dataset):
+        self.wait_time = 0.
+        start_epoch = time.time()
+
+        iterator = iter(dataset)
+        while True:
+            start = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            self.wait_time += time.time() - start
+            yield batch
+
+        self.epoch_time = time.time() - start_epoch
+
+    @property
+    def wait_fraction(self):
+        return self.wait_time / self.epoch_time if self.epoch_time > 0 else 0.
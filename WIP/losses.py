@@ -0,0 +1,46 @@
+"""Negative log-likelihood of the categorical outputs of the PixelCNN models.
+
+The scripts computed the loss as `CategoricalCrossentropy` of `tf.one_hot(batch_y, q_levels)`,
+which materialises a float tensor of shape [N, H, W, C, D] at every step (D being the
+number of quantisation levels), after a reshape of the logits to [N, H, W, D, C] and a
+transpose to [N, H, W, C, D]. Here the targets stay integers, and the output heads emit
+their N * H * W * C * D logits channel-major, ordered as [N, H, W, C, D], so the logits of
+the sub-pixels are a reshape of the output of the model.
+
+All the losses are in nats per sub-pixel; `bits_per_dim` converts them to bits per
+sub-pixel, as reported by the papers.
+"""
+import numpy as np
+import tensorflow as tf
+
+
+def channel_logits(logits, n_channel):
+    """Logits with shape [N, H, W, C, D] from the output [N, H, W, C * D] of a channel-major head."""
+    return tf.reshape(logits, tf.concat([tf.shape(logits)[:-1], [n_channel, -1]], axis=0))
+
+
+def nll(targets, logits):
+    """Mean negative log-likelihood in nats per sub-pixel.
+
+    Arguments:
+    targets: integer tensor with shape [N, H, W, C] with the quantised values.
+    logits: tensor with shape [N, H, W, C * D], the output of a channel-major head, or
+        already split as [N, H, W, C, D]. The softmax is computed in float32 whatever the
+        dtype of the logits.
+
+    Returns:
+    Scalar float32 tensor.
+    """
+    targets = tf.cast(targets, tf.int32)
+    logits = tf.reshape(tf.cast(logits, tf.float32), tf.concat([tf.shape(targets), [-1]], axis=0))
+    return tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=targets, logits=logits))
+
+
+def bits_per_dim(nats):
+    """Convert a negative log-likelihood in nats per sub-pixel into bits per sub-pixel."""
+    return nats / np.log(2)
+
+
+def nll_report(nats):
+    """Text with the negative log-likelihood in nats and in bits/dim, as printed by the scripts."""
+    return 'nll : {:.4f} nats, bits/dim : {:.4f}'.format(float(nats), float(bits_per_dim(nats)))
@@ -6,12 +6,12 @@
 # Borrowed from https://github.com/neocxi/pixelsnail-public and ported it to PyTorch
 
 from math import sqrt
-from functools import partial, lru_cache
+from functools import partial
 
-import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def wn_linear(in_dim, out_dim):
@@ -68,6 +68,26 @@ def shift_right(input, size=1):
     return F.pad(input, [size, 0, 0, 0])[:, :, :, : input.shape[3]]
 
 
+def window(input, padding, kernel_size, i, j):
+    # Patch of the zero padded input read by a stride 1 convolution at output position (i, j)
+    left, _, top, _ = padding
+    height, width = input.shape[2:]
+    row, col = i - top, j - left
+
+    row_start, row_end = min(max(row, 0), height), min(max(row + kernel_size[0], 0), height)
+    col_start, col_end = min(max(col, 0), width), min(max(col + kernel_size[1], 0), width)
+    pad_top = min(max(-row, 0), kernel_size[0])
+    pad_left = min(max(-col, 0), kernel_size[1])
+    pad = [
+        pad_left,
+        kernel_size[1] - pad_left - (col_end - col_start),
+        pad_top,
+        kernel_size[0] - pad_top - (row_end - row_start),
+    ]
+
+    return F.pad(input[:, :, row_start:row_end, col_start:col_end], pad)
+
+
 class CausalConv2d(nn.Module):
     def __init__(
             self,
@@ -118,6 +138,12 @@ class CausalConv2d(nn.Module):
 
         return out
 
+    def forward_at(self, input, i, j):
+        if self.causal > 0:
+            self.conv.conv.weight_v.data[:, :, -1, self.causal:].zero_()
+
+        return self.conv(window(input, self.pad.padding, self.kernel_size, i, j))
+
 
 class GatedResBlock(nn.Module):
     def __init__(
@@ -178,22 +204,146 @@ class GatedResBlock(nn.Module):
 
         return out
 
+    def forward_at(self, input, cache, i, j, size, condition=None):
+        # input is the block input at (i, j), shape [batch, in_channel, 1, 1]. The activated inputs
+        # and hidden activations of the previous positions are read back from cache.
+        input = self.activation(input)
+
+        if 'input' not in cache:
+            cache['input'] = input.new_zeros(input.shape[0], input.shape[1], *size)
+        cache['input'][:, :, i, j] = input[:, :, 0, 0]
 
-@lru_cache(maxsize=64)
-def causal_mask(size):
-    shape = [size, size]
-    mask = np.triu(np.ones(shape), k=1).astype(np.uint8).T
-    start_mask = np.ones(size).astype(np.float32)
-    start_mask[0] = 0
+        out = self.conv1.forward_at(cache['input'], i, j)
+        out = self.activation(out)
+        out = self.dropout(out)
 
-    return (
-        torch.from_numpy(mask).unsqueeze(0),
-        torch.from_numpy(start_mask).unsqueeze(1),
-    )
+        if 'hidden' not in cache:
+            cache['hidden'] = out.new_zeros(out.shape[0], out.shape[1], *size)
+        cache['hidden'][:, :, i, j] = out[:, :, 0, 0]
+
+        out = self.conv2.forward_at(cache['hidden'], i, j)
+
+        if condition is not None:
+            condition = self.condition(condition)
+            out += condition
+
+        out = self.gate(out)
+        out += input
+
+        return out
+
+
+def attend_chunk(query, key, value, start, end, chunk_size, dropout):
+    # Online softmax of the queries in [start, end) over key tiles of chunk_size positions
+    query = query[:, :, start:end] / sqrt(query.shape[3])
+    query_position = torch.arange(start, end, device=query.device).unsqueeze(1)
+
+    max_score = query.new_full((*query.shape[:3], 1), float('-inf'))
+    normalizer = query.new_zeros((*query.shape[:3], 1))
+    out = query.new_zeros((*query.shape[:3], value.shape[3]))
+
+    for key_start in range(0, end, chunk_size):
+        key_end = min(key_start + chunk_size, end)
+        score = query @ key[:, :, key_start:key_end].transpose(2, 3)
+
+        if key_end > start + 1:
+            key_position = torch.arange(key_start, key_end, device=query.device)
+            score = score.masked_fill(key_position > query_position, float('-inf'))
+
+        new_max = torch.maximum(max_score, score.amax(3, keepdim=True))
+        correction = torch.exp(max_score - new_max)
+        prob = torch.exp(score - new_max)
+        normalizer = normalizer * correction + prob.sum(3, keepdim=True)
+
+        if dropout > 0:
+            prob = F.dropout(prob, dropout)
+
+        out = out * correction + prob @ value[:, :, key_start:key_end]
+        max_score = new_max
+
+    return out / normalizer
+
+
+def chunked_causal_attention(query, key, value, chunk_size=256, dropout=0.0):
+    # Causal attention (diagonal included) computed in chunk_size x chunk_size tiles, so the
+    # scores of one tile are kept at a time instead of the full length x length matrix. In
+    # training every query chunk is recomputed in the backward pass for the same reason. The
+    # reentrant checkpoint is used because the non-reentrant one kept the scores of every tile
+    # alive until the backward pass; it only supports backward(), not autograd.grad().
+    length = query.shape[2]
+    out = []
+
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+
+        if query.requires_grad:
+            chunk = checkpoint(
+                attend_chunk, query, key, value, start, end, chunk_size, dropout,
+                use_reentrant=True,
+            )
+
+        else:
+            chunk = attend_chunk(query, key, value, start, end, chunk_size, dropout)
+
+        out.append(chunk)
+
+    return torch.cat(out, 2)
+
+
+def causal_attention(query, key, value, dropout=0.0, chunk_size=None):
+    # Every position attends to the positions strictly before it and the first position gets
+    # zeros. Dropping the first query and the last key turns this into causal attention with
+    # the diagonal included, so no mask has to be built.
+    query, key, value = query[:, :, 1:], key[:, :, :-1], value[:, :, :-1]
+
+    if chunk_size is None and hasattr(F, 'scaled_dot_product_attention'):
+        out = F.scaled_dot_product_attention(
+            query, key, value, dropout_p=dropout, is_causal=True
+        )
+
+    else:
+        out = chunked_causal_attention(query, key, value, chunk_size or 256, dropout)
+
+    return F.pad(out, [0, 0, 1, 0])
+
+
+def downsampled_causal_mask(height, width, downsample, device=None):
+    # A position may attend to a downsample x downsample cell once all the positions of the
+    # cell come before it in raster order, that is after the last one (bottom right).
+    last_row = (torch.arange(0, height, downsample, device=device) + downsample).clamp(max=height) - 1
+    last_col = (torch.arange(0, width, downsample, device=device) + downsample).clamp(max=width) - 1
+    last = (last_row.unsqueeze(1) * width + last_col.unsqueeze(0)).view(-1)
+    position = torch.arange(height * width, device=device)
+
+    return last.unsqueeze(0) < position.unsqueeze(1)
+
+
+def downsampled_causal_attention(query, key, value, height, width, downsample, dropout=0.0):
+    # Keys and values come from max pooled cells, the positions that come before the end of
+    # the first cell get zeros
+    mask = downsampled_causal_mask(height, width, downsample, query.device)
+
+    attn = torch.matmul(query, key.transpose(2, 3)) / sqrt(query.shape[3])
+    attn = attn.masked_fill(~mask, -1e4)
+    attn = torch.softmax(attn, 3) * mask.any(1, keepdim=True).type_as(attn)
+
+    if dropout > 0:
+        attn = F.dropout(attn, dropout)
+
+    return attn @ value
 
 
 class CausalAttention(nn.Module):
-    def __init__(self, query_channel, key_channel, channel, n_head=8, dropout=0.1):
+    def __init__(
+            self,
+            query_channel,
+            key_channel,
+            channel,
+            n_head=8,
+            dropout=0.1,
+            chunk_size=None,
+            downsample=1,
+    ):
         super().__init__()
 
         self.query = wn_linear(query_channel, channel)
@@ -204,9 +354,14 @@ class CausalAttention(nn.Module):
         self.n_head = n_head
 
         self.dropout = nn.Dropout(dropout)
+        self.chunk_size = chunk_size
+        self.downsample = downsample
 
     def forward(self, query, key):
-        batch, _, height, width = key.shape
+        batch, _, height, width = query.shape
+
+        if self.downsample > 1:
+            key = F.max_pool2d(key, self.downsample, ceil_mode=True)
 
         def reshape(input):
             return input.view(batch, -1, self.n_head, self.dim_head).transpose(1, 2)
@@ -214,18 +369,18 @@ class CausalAttention(nn.Module):
         query_flat = query.view(batch, query.shape[1], -1).transpose(1, 2)
         key_flat = key.view(batch, key.shape[1], -1).transpose(1, 2)
         query = reshape(self.query(query_flat))
-        key = reshape(self.key(key_flat)).transpose(2, 3)
+        key = reshape(self.key(key_flat))
         value = reshape(self.value(key_flat))
 
-        attn = torch.matmul(query, key) / sqrt(self.dim_head)
-        mask, start_mask = causal_mask(height * width)
-        mask = mask.type_as(query)
-        start_mask = start_mask.type_as(query)
-        attn = attn.masked_fill(mask == 0, -1e4)
-        attn = torch.softmax(attn, 3) * start_mask
-        attn = self.dropout(attn)
+        dropout = self.dropout.p if self.training else 0.0
 
-        out = attn @ value
+        if self.downsample > 1:
+            out = downsampled_causal_attention(
+                query, key, value, height, width, self.downsample, dropout
+            )
+
+        else:
+            out = causal_attention(query, key, value, dropout, self.chunk_size)
         out = out.transpose(1, 2).reshape(
             batch, height, width, self.dim_head * self.n_head
         )
@@ -233,6 +388,58 @@ class CausalAttention(nn.Module):
 
         return out
 
+    def forward_at(self, query, key, cache, i, j, size):
+        # Attends from the query at (i, j) to the keys and values of the cells completed before
+        # (i, j), which are kept in cache. Cells complete in raster order, so they form a prefix.
+        # Without downsampling every position is a cell of its own.
+        batch = key.shape[0]
+        height, width = size
+        cell_width = -(-width // self.downsample)
+        cell = (i // self.downsample) * cell_width + j // self.downsample
+
+        def reshape(input):
+            return input.view(batch, -1, self.n_head, self.dim_head).transpose(1, 2)
+
+        query_flat = query.view(batch, query.shape[1], -1).transpose(1, 2)
+        query = reshape(self.query(query_flat))
+
+        if 'key' not in cache:
+            n_cell = -(-height // self.downsample) * cell_width
+            cache['pooled'] = key.new_full((batch, key.shape[1], n_cell), float('-inf'))
+            cache['key'] = query.new_zeros(batch, self.n_head, n_cell, self.dim_head)
+            cache['value'] = query.new_zeros(batch, self.n_head, n_cell, self.dim_head)
+            cache['n_cell'] = 0
+
+        n_cell = cache['n_cell']
+
+        # Max pooling of the key input, the cell key and value are computed at its last position
+        cache['pooled'][:, :, cell] = torch.maximum(cache['pooled'][:, :, cell], key[:, :, 0, 0])
+        last_row = min((i // self.downsample + 1) * self.downsample, height) - 1
+        last_col = min((j // self.downsample + 1) * self.downsample, width) - 1
+
+        if i == last_row and j == last_col:
+            key_flat = cache['pooled'][:, :, cell].unsqueeze(1)
+            cache['key'][:, :, cell] = reshape(self.key(key_flat))[:, :, 0]
+            cache['value'][:, :, cell] = reshape(self.value(key_flat))[:, :, 0]
+            cache['n_cell'] = cell + 1
+
+        if n_cell == 0:
+            # start_mask zeroes the attention of the first positions
+            return query.new_zeros(batch, self.dim_head * self.n_head, 1, 1)
+
+        key = cache['key'][:, :, :n_cell].transpose(2, 3)
+        value = cache['value'][:, :, :n_cell]
+
+        attn = torch.matmul(query, key) / sqrt(self.dim_head)
+        attn = torch.softmax(attn, 3)
+        attn = self.dropout(attn)
+
+        out = attn @ value
+        out = out.transpose(1, 2).reshape(batch, 1, 1, self.dim_head * self.n_head)
+        out = out.permute(0, 3, 1, 2)
+
+        return out
+
 
 class PixelBlock(nn.Module):
     def __init__(
@@ -244,6 +451,8 @@ class PixelBlock(nn.Module):
             attention=True,
             dropout=0.1,
             condition_dim=0,
+            attn_chunk_size=None,
+            attn_downsample=1,
     ):
         super().__init__()
 
@@ -273,7 +482,12 @@ class PixelBlock(nn.Module):
             )
 
             self.causal_attention = CausalAttention(
-                in_channel + 2, in_channel * 2 + 2, in_channel // 2, dropout=dropout
+                in_channel + 2,
+                in_channel * 2 + 2,
+                in_channel // 2,
+                dropout=dropout,
+                chunk_size=attn_chunk_size,
+                downsample=attn_downsample,
             )
 
             self.out_resblock = GatedResBlock(
@@ -307,6 +521,30 @@ class PixelBlock(nn.Module):
 
         return out
 
+    def forward_at(self, input, background, cache, i, j, size, condition=None):
+        if 'resblocks' not in cache:
+            cache['resblocks'] = [{} for _ in self.resblocks]
+            cache['attention'] = {}
+
+        out = input
+
+        for resblock, resblock_cache in zip(self.resblocks, cache['resblocks']):
+            out = resblock.forward_at(out, resblock_cache, i, j, size, condition=condition)
+
+        if self.attention:
+            key_cat = torch.cat([input, out, background], 1)
+            key = self.key_resblock(key_cat)
+            query_cat = torch.cat([out, background], 1)
+            query = self.query_resblock(query_cat)
+            attn_out = self.causal_attention.forward_at(query, key, cache['attention'], i, j, size)
+            out = self.out_resblock(out, attn_out)
+
+        else:
+            bg_cat = torch.cat([out, background], 1)
+            out = self.out(bg_cat)
+
+        return out
+
 
 class CondResNet(nn.Module):
     def __init__(self, in_channel, channel, kernel_size, n_res_block):
@@ -339,6 +577,8 @@ class PixelSNAIL(nn.Module):
             cond_res_channel=0,
             cond_res_kernel=3,
             n_out_res_block=0,
+            attn_chunk_size=None,
+            attn_downsample=1,
     ):
         super().__init__()
 
@@ -367,6 +607,10 @@ class PixelSNAIL(nn.Module):
 
         self.blocks = nn.ModuleList()
 
+        # One downsampling rate for all the blocks or one per block
+        if isinstance(attn_downsample, int):
+            attn_downsample = [attn_downsample] * n_block
+
         for i in range(n_block):
             self.blocks.append(
                 PixelBlock(
@@ -377,6 +621,8 @@ class PixelSNAIL(nn.Module):
                     attention=attention,
                     dropout=dropout,
                     condition_dim=cond_res_channel,
+                    attn_chunk_size=attn_chunk_size,
+                    attn_downsample=attn_downsample[i],
                 )
             )
 
@@ -394,6 +640,21 @@ class PixelSNAIL(nn.Module):
 
         self.out = nn.Sequential(*out)
 
+    def encode_condition(self, condition, cache):
+        if 'condition' in cache:
+            return cache['condition']
+
+        condition = (
+            F.one_hot(condition, self.n_class)
+                .permute(0, 3, 1, 2)
+                .type_as(self.background)
+        )
+        condition = self.cond_resnet(condition)
+        condition = F.interpolate(condition, scale_factor=2)
+        cache['condition'] = condition.detach().clone()
+
+        return condition
+
     def forward(self, input, condition=None, cache=None):
         if cache is None:
             cache = {}
@@ -408,20 +669,7 @@ class PixelSNAIL(nn.Module):
         background = self.background[:, :, :height, :].expand(batch, 2, height, width)
 
         if condition is not None:
-            if 'condition' in cache:
-                condition = cache['condition']
-                condition = condition[:, :, :height, :]
-
-            else:
-                condition = (
-                    F.one_hot(condition, self.n_class)
-                        .permute(0, 3, 1, 2)
-                        .type_as(self.background)
-                )
-                condition = self.cond_resnet(condition)
-                condition = F.interpolate(condition, scale_factor=2)
-                cache['condition'] = condition.detach().clone()
-                condition = condition[:, :, :height, :]
+            condition = self.encode_condition(condition, cache)[:, :, :height, :]
 
         for block in self.blocks:
             out = block(out, background, condition=condition)
@@ -429,3 +677,151 @@ class PixelSNAIL(nn.Module):
         out = self.out(out)
 
         return out, cache
+
+    def forward_at(self, input, i, j, condition=None, cache=None):
+        """Logits of position (i, j) only, shape [batch, n_class].
+
+        Every layer is evaluated at (i, j) alone. The activations, keys and values of the previous
+        positions are kept in `cache`, so the method has to be called at every position in raster
+        order starting from (0, 0) with a fresh cache, and the pixels of `input` before (i, j)
+        must not change between calls. The model has to be in eval mode.
+        """
+        if cache is None:
+            cache = {}
+        batch, height, width = input.shape
+        size = (height, width)
+
+        if 'input' not in cache:
+            cache['input'] = self.background.new_zeros(batch, self.n_class, height, width)
+            cache['blocks'] = [{} for _ in self.blocks]
+
+        # The pixel sampled at the previous step is the only new one read by the input convolutions
+        if j > 0 or i > 0:
+            prev_i, prev_j = (i, j - 1) if j > 0 else (i - 1, width - 1)
+            cache['input'][:, :, prev_i, prev_j] = F.one_hot(
+                input[:, prev_i, prev_j], self.n_class
+            ).type_as(self.background)
+
+        if i > 0:
+            horizontal = self.horizontal.forward_at(cache['input'], i - 1, j)
+
+        else:
+            horizontal = self.background.new_zeros(batch, self.horizontal.conv.out_channel, 1, 1)
+
+        if j > 0:
+            vertical = self.vertical.forward_at(cache['input'], i, j - 1)
+
+        else:
+            vertical = self.background.new_zeros(batch, self.vertical.conv.out_channel, 1, 1)
+
+        out = horizontal + vertical
+
+        background = self.background[:, :, i: i + 1, j: j + 1].expand(batch, 2, 1, 1)
+
+        if condition is not None:
+            condition = self.encode_condition(condition, cache)[:, :, i: i + 1, j: j + 1]
+
+        for block, block_cache in zip(self.blocks, cache['blocks']):
+            out = block.forward_at(out, background, block_cache, i, j, size, condition=condition)
+
+        out = self.out(out)
+
+        return out[:, :, 0, 0], cache
+
+
+def gumbel_noise(shape, device=None):
+    """Gumbel noise, so that argmax(logits + noise) is a sample of softmax(logits)."""
+    uniform = torch.rand(shape, device=device).clamp_min(torch.finfo(torch.float32).tiny)
+
+    return -torch.log(-torch.log(uniform))
+
+
+@torch.no_grad()
+def sample(model, batch, size, temperature=1.0, condition=None, noise=None):
+    """Samples pixels in raster order running the full network at every step.
+
+    With `noise` (Gumbel noise of shape [batch, n_class, height, width]), every pixel is the
+    argmax of its logits plus its noise instead of a draw of torch.multinomial.
+    """
+    row = torch.zeros(batch, *size, dtype=torch.int64, device=model.background.device)
+    cache = {}
+
+    for i in range(size[0]):
+        for j in range(size[1]):
+            # The rows below i do not change the logits of row i, but cutting them off would
+            # make the last row of downsampled attention cells look complete
+            out, cache = model(row, condition=condition, cache=cache)
+
+            if noise is None:
+                prob = torch.softmax(out[:, :, i, j] / temperature, 1)
+                row[:, i, j] = torch.multinomial(prob, 1).squeeze(-1)
+
+            else:
+                row[:, i, j] = (out[:, :, i, j] / temperature + noise[:, :, i, j]).argmax(1)
+
+    return row
+
+
+@torch.no_grad()
+def jacobi_sample(model, batch, size, temperature=1.0, condition=None, noise=None):
+    """Samples pixels by fixed-point iteration over the whole canvas.
+
+    With the Gumbel noise of every pixel drawn up front, the sample is a deterministic
+    function of the noise, which every iteration evaluates on the whole canvas at once as in
+    [1]. In raster order, the first pixel that changes in an iteration was computed from
+    pixels that are all final, so it is final too, and so are the unchanged pixels before it.
+    Every iteration fixes at least one pixel, and the result is exactly `sample` with the
+    same `noise`, usually in far fewer forward passes.
+
+    Returns the samples and the number of forward passes.
+
+    Refs:
+    [1] - Song, Y., Meng, C., Liao, R., & Ermon, S. (2021). Accelerating feedforward
+    computation via parallel nonlinear equation solving. In International Conference on
+    Machine Learning.
+    """
+    device = model.background.device
+    n_pixel = size[0] * size[1]
+
+    if noise is None:
+        noise = gumbel_noise((batch, model.n_class, *size), device=device)
+
+    row = torch.zeros(batch, n_pixel, dtype=torch.int64, device=device)
+    position = torch.arange(n_pixel, device=device)
+    n_final = torch.zeros(batch, dtype=torch.int64, device=device)
+    cache = {}
+
+    n_iteration = 0
+    while (n_final < n_pixel).any():
+        out, cache = model(row.view(batch, *size), condition=condition, cache=cache)
+        new_row = (out / temperature + noise).argmax(1).view(batch, n_pixel)
+
+        pending = position >= n_final.unsqueeze(1)
+        changed = pending & (new_row != row)
+        first_changed = torch.where(changed, position, n_pixel - 1).min(1).values
+
+        n_final = first_changed + 1
+        row = torch.where(pending, new_row, row)
+        n_iteration += 1
+
+    return row.view(batch, *size), n_iteration
+
+
+@torch.no_grad()
+def cached_sample(model, batch, size, temperature=1.0, condition=None):
+    """Samples pixels in raster order evaluating the network only at the new pixel.
+
+    Uses `PixelSNAIL.forward_at`, so every step costs one position of the convolutions and one
+    query against the cached keys of the attention layers, instead of a full forward pass over
+    H*W positions. The random draws are the same as in `sample` for a fixed seed.
+    """
+    row = torch.zeros(batch, *size, dtype=torch.int64, device=model.background.device)
+    cache = {}
+
+    for i in range(size[0]):
+        for j in range(size[1]):
+            out, cache = model.forward_at(row, i, j, condition=condition, cache=cache)
+            prob = torch.softmax(out / temperature, 1)
+            row[:, i, j] = torch.multinomial(prob, 1).squeeze(-1)
+
+    return row
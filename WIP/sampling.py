@@ -0,0 +1,364 @@
+"""Sampling routines shared by the autoregressive models."""
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+
+def _truncate_logits(logits, top_k=None, top_p=None):
+    """Set to -inf the logits outside the top-k values and outside the nucleus of mass top-p."""
+    if top_k is not None:
+        kth_value = tf.math.top_k(logits, k=top_k).values[:, -1:]
+        logits = tf.where(logits < kth_value, -np.inf, logits)
+
+    if top_p is not None:
+        sorted_logits = tf.sort(logits, axis=-1, direction='DESCENDING')
+        mass_before = tf.cumsum(tf.nn.softmax(sorted_logits), axis=-1, exclusive=True)
+        # Smallest logit of the smallest set of values whose probability reaches top_p
+        threshold = tf.reduce_min(tf.where(mass_before < top_p, sorted_logits, np.inf), axis=-1, keepdims=True)
+        logits = tf.where(logits < threshold, -np.inf, logits)
+
+    return logits
+
+
+# Constants of the SplitMix64 generator [1], used to draw per-row random numbers
+_SPLITMIX64_GAMMA = 0x9E3779B97F4A7C15
+_SPLITMIX64_MIX = (0xBF58476D1CE4E5B9, 0x94D049BB133111EB)
+
+
+def _row_uniform(seeds, depth):
+    """Uniform numbers in (0, 1) with shape [N, depth], row b from the stream of seeds[b].
+
+    SplitMix64 [1] is a counter based generator, so the numbers of all the rows are
+    computed at once and do not depend on the other rows of the batch.
+
+    Refs:
+    [1] - Steele Jr, G. L., Lea, D., & Flood, C. H. (2014). Fast splittable pseudorandom
+    number generators. ACM SIGPLAN Notices, 49(10), 453-472.
+    """
+    def shift(x, n):
+        return tf.bitwise.right_shift(x, tf.constant(n, tf.uint64))
+
+    counter = tf.cast(tf.range(1, depth + 1), tf.uint64)
+    z = tf.cast(tf.cast(seeds, tf.int64), tf.uint64)[:, None] + counter[None, :] * tf.constant(_SPLITMIX64_GAMMA,
+                                                                                                 tf.uint64)
+    z = tf.bitwise.bitwise_xor(z, shift(z, 30)) * tf.constant(_SPLITMIX64_MIX[0], tf.uint64)
+    z = tf.bitwise.bitwise_xor(z, shift(z, 27)) * tf.constant(_SPLITMIX64_MIX[1], tf.uint64)
+    z = tf.bitwise.bitwise_xor(z, shift(z, 31))
+
+    # Top 24 bits, so the numbers are exactly representable in float32 and never 0 or 1
+    return (tf.cast(shift(z, 40), tf.float32) + 0.5) / 2. ** 24
+
+
+def _row_uniform_np(seeds, depth):
+    """NumPy version of `_row_uniform`, giving the same numbers."""
+    with np.errstate(over='ignore'):
+        counter = np.arange(1, depth + 1, dtype=np.uint64)
+        z = np.asarray(seeds).astype(np.int64).astype(np.uint64)[:, None] + counter[None, :] * np.uint64(
+            _SPLITMIX64_GAMMA)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(_SPLITMIX64_MIX[0])
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(_SPLITMIX64_MIX[1])
+        z = z ^ (z >> np.uint64(31))
+    return ((z >> np.uint64(40)).astype(np.float32) + 0.5) / 2. ** 24
+
+
+def sample_categorical(logits, temperature=1., top_k=None, top_p=None, seeds=None):
+    """Draw one value from each row of logits using the Gumbel-max trick.
+
+    All the rows are sampled with a few vectorised operations, so it can replace the
+    per-row `np.random.choice` calls and also run inside a `tf.function`.
+
+    Arguments:
+    logits: tensor with shape [N, D] with the unnormalised log-probabilities.
+    temperature: Float > 0, the logits are divided by it before sampling.
+    top_k: Integer, if given only the top_k most likely values of each row are sampled.
+    top_p: Float in (0, 1], if given only the smallest set of most likely values of each
+        row whose probability adds up to top_p is sampled (nucleus sampling).
+    seeds: optional integer tensor with shape [N] with the seed of each row. A row with a
+        given seed always gets the same value, whatever the rest of the batch is.
+
+    Returns:
+    Int32 tensor with shape [N] with the sampled values.
+    """
+    logits = tf.cast(logits, tf.float32) / temperature
+    logits = _truncate_logits(logits, top_k=top_k, top_p=top_p)
+
+    if seeds is None:
+        uniform = tf.random.uniform(tf.shape(logits), minval=np.finfo(np.float32).tiny, maxval=1.)
+    else:
+        uniform = _row_uniform(seeds, tf.shape(logits)[-1])
+
+    gumbel = -tf.math.log(-tf.math.log(uniform))
+    return tf.argmax(logits + gumbel, axis=-1, output_type=tf.int32)
+
+
+def sample_categorical_np(logits, temperature=1., top_k=None, top_p=None, seeds=None):
+    """NumPy version of `sample_categorical` for offline use, using the inverse CDF.
+
+    Only one uniform number is drawn per row, from `np.random` or, if `seeds` is given,
+    from the stream of the seed of the row.
+    """
+    logits = np.asarray(logits, dtype=np.float64) / temperature
+
+    if top_k is not None:
+        kth_value = np.partition(logits, -top_k, axis=-1)[:, -top_k:-top_k + 1]
+        logits = np.where(logits < kth_value, -np.inf, logits)
+
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+
+    if top_p is not None:
+        sorted_probs = -np.sort(-probs, axis=-1)
+        mass_before = np.cumsum(sorted_probs, axis=-1) - sorted_probs
+        threshold = np.where(mass_before < top_p, sorted_probs, np.inf).min(axis=-1, keepdims=True)
+        probs = np.where(probs < threshold, 0., probs)
+
+    if seeds is None:
+        uniform = np.random.random_sample((probs.shape[0], 1))
+    else:
+        uniform = _row_uniform_np(seeds, 1)
+
+    cdf = np.cumsum(probs, axis=-1)
+    values = np.sum(cdf <= uniform * cdf[:, -1:], axis=-1)
+    return np.minimum(values, probs.shape[-1] - 1)
+
+
+def _is_pointwise(layer):
+    if isinstance(layer, keras.layers.Activation):
+        return True
+    return isinstance(layer, keras.layers.Conv2D) and tuple(layer.kernel_size) == (1, 1)
+
+
+def split_pointwise_head(model):
+    """Split a functional model into its trunk and the pointwise layers of its output head.
+
+    The output head of the models (ReLU and 1x1 convolutions) works on each position
+    independently, so it can be evaluated on a single position of the trunk features.
+
+    Returns:
+    The trunk as a Keras model that returns the features fed to the head, and the list of
+    head layers in the order they are applied.
+    """
+    head = []
+    output = model.output
+    for layer in reversed(model.layers):
+        if not _is_pointwise(layer) or layer.output is not output:
+            break
+        head.insert(0, layer)
+        output = layer.input
+
+    trunk = keras.Model(inputs=model.inputs, outputs=output)
+    return trunk, head
+
+
+def generate(model, shape, n, seed, samples=None, start_row=0, jit_compile=False, pointwise_head=True):
+    """Generate images in raster order with the whole loop running inside one graph.
+
+    The model is called on the canvas once per sub-pixel, as in the eager loops of the
+    training scripts, but the loop, the sampling and the canvas update all run inside a
+    `tf.while_loop`, so there is no copy between host and TensorFlow between steps.
+
+    The model must map a canvas with shape [N, H, W, C] and values in [0, 1] to logits
+    with shape [N, H, W, C * D] ordered as [N, H, W, C, D] (see losses.py), where D is the
+    number of quantisation levels.
+
+    Arguments:
+    model: Keras model to sample from.
+    shape: tuple (height, width, n_channel) of the images.
+    n: Integer, number of images to generate.
+    seed: Integer, seed of the stateless random draws. The same seed always generates the
+        same images.
+    samples: optional array with shape [n, H, W, C] holding the known pixels. Used to
+        fill occluded images from `start_row` onwards.
+    start_row: Integer, first row to generate.
+    jit_compile: if True, compile the sampling loop with XLA.
+    pointwise_head: if True, run only the trunk of the model on the whole canvas and
+        evaluate the pointwise output head (see `split_pointwise_head`) at the sub-pixel
+        being sampled.
+
+    Returns:
+    Numpy array with the generated images, with values in [0, 1].
+    """
+    height, width, n_channel = shape
+    q_levels = model.output_shape[-1] // n_channel
+
+    if samples is None:
+        samples = tf.zeros((n, height, width, n_channel))
+    samples = tf.convert_to_tensor(samples, dtype=tf.float32)
+
+    start = start_row * width * n_channel
+    end = height * width * n_channel
+    batch_index = tf.range(n)
+
+    if pointwise_head:
+        trunk, head = split_pointwise_head(model)
+
+    def logits_at(canvas, i, j, k):
+        if not pointwise_head:
+            logits = model(canvas, training=False)
+            logits = tf.reshape(logits, [-1, height, width, n_channel, q_levels])
+            return logits[:, i, j, k, :]
+
+        x = trunk(canvas, training=False)
+        x = x[:, i, j, :][:, None, None, :]
+        for layer in head:
+            x = layer(x)
+        logits = tf.reshape(x, [-1, n_channel, q_levels])
+        return logits[:, k, :]
+
+    def body(t, canvas):
+        i = t // (width * n_channel)
+        j = (t // n_channel) % width
+        k = t % n_channel
+
+        logits = logits_at(canvas, i, j, k)
+        next_sample = tf.random.stateless_categorical(logits, 1, seed=tf.stack([seed, t]))
+        next_sample = tf.cast(next_sample[:, 0], tf.float32) / (q_levels - 1)
+
+        indices = tf.stack([batch_index,
+                            tf.fill([n], i),
+                            tf.fill([n], j),
+                            tf.fill([n], k)], axis=1)
+        canvas = tf.tensor_scatter_nd_update(canvas, indices, next_sample)
+        return t + 1, canvas
+
+    @tf.function(jit_compile=jit_compile)
+    def sampling_loop(canvas):
+        _, canvas = tf.while_loop(lambda t, canvas: t < end,
+                                  body,
+                                  [tf.constant(start), canvas])
+        return canvas
+
+    return sampling_loop(samples).numpy()
+
+
+def generate_with_channel_head(trunk, head, shape, n, seed, samples=None, start_row=0, jit_compile=False):
+    """Generate images in raster order with one trunk evaluation per pixel.
+
+    Same as `generate` for models whose trunk only sees the previous pixels and whose
+    output head conditions each channel on the channels of the same pixel that come
+    before it (see `ChannelHead` in multichannel.py). The trunk features of a pixel are
+    computed once and only the head is evaluated for each of its channels, so generating
+    an image takes H * W trunk evaluations instead of H * W * C.
+
+    Arguments:
+    trunk: Keras model mapping the canvas [N, H, W, C] to the features fed to the head.
+    head: Keras model mapping [features, pixels] with shapes [N, 1, 1, F] and [N, 1, 1, C]
+        to logits with shape [N, 1, 1, C * D] ordered as [N, 1, 1, C, D].
+    shape, n, seed, samples, start_row, jit_compile: as in `generate`.
+
+    Returns:
+    Numpy array with the generated images, with values in [0, 1].
+    """
+    height, width, n_channel = shape
+    q_levels = head.output_shape[-1] // n_channel
+
+    if samples is None:
+        samples = tf.zeros((n, height, width, n_channel))
+    samples = tf.convert_to_tensor(samples, dtype=tf.float32)
+
+    start = start_row * width
+    end = height * width
+    batch_index = tf.range(n)
+
+    def body(t, canvas):
+        i = t // width
+        j = t % width
+
+        features = trunk(canvas, training=False)
+        features = features[:, i, j, :][:, None, None, :]
+
+        for k in range(n_channel):
+            pixels = canvas[:, i, j, :][:, None, None, :]
+            logits = head([features, pixels], training=False)
+            logits = tf.reshape(logits, [-1, n_channel, q_levels])
+
+            next_sample = tf.random.stateless_categorical(logits[:, k, :], 1,
+                                                          seed=tf.stack([seed, t * n_channel + k]))
+            next_sample = tf.cast(next_sample[:, 0], tf.float32) / (q_levels - 1)
+
+            indices = tf.stack([batch_index,
+                                tf.fill([n], i),
+                                tf.fill([n], j),
+                                tf.fill([n], k)], axis=1)
+            canvas = tf.tensor_scatter_nd_update(canvas, indices, next_sample)
+        return t + 1, canvas
+
+    @tf.function(jit_compile=jit_compile)
+    def sampling_loop(canvas):
+        _, canvas = tf.while_loop(lambda t, canvas: t < end,
+                                  body,
+                                  [tf.constant(start), canvas])
+        return canvas
+
+    return sampling_loop(samples).numpy()
+
+
+def gumbel_noise(shape):
+    """Gumbel noise, so that argmax(logits + noise) is a sample of softmax(logits)."""
+    uniform = np.random.uniform(np.finfo(np.float32).tiny, 1., shape)
+    return -np.log(-np.log(uniform)).astype('float32')
+
+
+def sample(model, samples, q_levels, start_row=0, noise=None):
+    """Generate pixels in raster order running the whole model at every step.
+
+    The model maps a single-channel canvas with shape [N, H, W, 1] to logits with shape
+    [N, H, W, D], as the PixelCNN and the Gated PixelCNN of the scripts. With `noise`
+    (Gumbel noise with shape [N, H, W, D]), every pixel is the argmax of its logits plus
+    its noise instead of a draw of tf.random.categorical.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+    """
+    height, width = samples.shape[1:3]
+    for i in range(start_row, height):
+        for j in range(width):
+            logits = model(samples)
+            if noise is None:
+                next_sample = tf.random.categorical(logits[:, i, j, :], 1).numpy()[:, 0]
+            else:
+                next_sample = np.argmax(logits[:, i, j, :].numpy() + noise[:, i, j, :], axis=-1)
+            samples[:, i, j, 0] = next_sample / (q_levels - 1)
+    return samples
+
+
+def jacobi_sample(model, samples, q_levels, start_row=0, noise=None):
+    """Generate pixels by fixed-point iteration running the whole model at every step.
+
+    With the Gumbel noise of every pixel drawn up front, the image is a deterministic
+    function of the noise, which every iteration evaluates on the whole image at once as
+    in [1]. In raster order, the first pixel that changes in an iteration was computed
+    from pixels that are all final, so it is final too, and so are the unchanged pixels
+    before it. Every iteration fixes at least one pixel, and the result is exactly
+    `sample` with the same `noise`, usually in far fewer evaluations of the model.
+
+    Pixels from `start_row` onwards are overwritten in place in the `samples` array.
+
+    Returns:
+    The samples and the number of evaluations of the model.
+
+    Refs:
+    [1] - Song, Y., Meng, C., Liao, R., & Ermon, S. (2021). Accelerating feedforward
+    computation via parallel nonlinear equation solving. In International Conference on
+    Machine Learning.
+    """
+    n_samples, height, width = samples.shape[:3]
+    n_pixels = height * width
+    if noise is None:
+        noise = gumbel_noise((n_samples, height, width, q_levels))
+
+    position = np.arange(n_pixels)
+    n_final = np.full(n_samples, start_row * width)
+    n_iterations = 0
+    while np.any(n_final < n_pixels):
+        logits = model(samples).numpy()
+        new_samples = np.argmax(logits + noise, axis=-1) / (q_levels - 1)
+        new_samples = new_samples.astype(samples.dtype).reshape(n_samples, n_pixels)
+        old_samples = samples[:, :, :, 0].reshape(n_samples, n_pixels)
+
+        pending = position >= n_final[:, None]
+        changed = pending & (new_samples != old_samples)
+        n_final = np.where(changed, position, n_pixels - 1).min(axis=1) + 1
+
+        samples[:, :, :, 0] = np.where(pending, new_samples, old_samples).reshape(n_samples, height, width)
+        n_iterations += 1
+    return samples, n_iterations
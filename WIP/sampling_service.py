@@ -0,0 +1,512 @@
+"""Local sampling service that loads a model once and batches the requests of its clients.
+
+The server keeps a queue of sampling requests. The first request of a batch waits at most
+`max_wait` seconds for others, and up to `max_batch_size` requests go through the raster
+loop together, so every evaluation of the model is shared by all the requests of the batch.
+`ContinuousBatchingService` instead keeps a raster position per batch slot and refills a
+slot with the next request as soon as its image is complete.
+
+Clients talk to the server over TCP with one JSON object per line. Every request has an
+`id` chosen by the client and a `type`:
+- "unconditional": generate an image. On a class-conditional model the class is drawn from
+    a uniform prior first, which gives a sample of the unconditional distribution when the
+    classes are balanced (as in MNIST).
+- "class": generate an image of the class `label`.
+- "inpainting": keep the rows of `image` (quantised values with shape [H, W, C]) above
+    `start_row` and generate the rest, with an optional `label`.
+A request may also give a `seed`: the random numbers of an image only depend on its seed,
+so the same request always gets the same image whatever the other requests in its batch.
+The reply has the same `id` and either the generated `image` (quantised values) or an
+`error`. A request with `"stream": true` also gets a message with its `id`, the index `row`
+and the quantised `values` of every generated row as soon as the row is final, before the
+reply with the whole image.
+"""
+import asyncio
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from sampling import sample_categorical, split_pointwise_head
+from train_gatedpixelcnn2_conditioned import build_conditioned_gated_pixelcnn
+
+
+class SamplingRequest(object):
+    """Sampling request parsed from a client message, see the module docstring.
+
+    Raises ValueError (or KeyError for missing fields, TypeError for fields of the wrong
+    type) for invalid requests.
+    """
+
+    def __init__(self, message, shape, q_levels, n_classes=None):
+        if not isinstance(message, dict):
+            raise ValueError('a request must be a JSON object')
+
+        self.id = message['id']
+        self.seed = int(message.get('seed', np.random.randint(2 ** 31)))
+        # The seeds are stored as int64 and multiplied by the number of sub-pixels
+        if not 0 <= self.seed < 2 ** 32:
+            raise ValueError('seed {:} is not in [0, 2 ** 32)'.format(self.seed))
+        self.label = None if message.get('label') is None else int(message['label'])
+        self.stream = bool(message.get('stream', False))
+        self.image = np.zeros(shape, dtype='float32')
+        self.start_row = 0
+
+        request_type = message['type']
+        if request_type not in {'unconditional', 'class', 'inpainting'}:
+            raise ValueError('unknown request type {!r}'.format(request_type))
+
+        if request_type == 'unconditional':
+            self.label = None
+        elif request_type == 'class' and self.label is None:
+            raise ValueError('class requests need a label')
+
+        if self.label is not None and n_classes is None:
+            raise ValueError('the model is not class-conditional')
+
+        if n_classes is not None:
+            if self.label is None:
+                self.label = np.random.RandomState(self.seed).randint(n_classes)
+            if not 0 <= self.label < n_classes:
+                raise ValueError('label {:} is not in [0, {:})'.format(self.label, n_classes))
+
+        if request_type == 'inpainting':
+            self.start_row = int(message['start_row'])
+            if not 0 <= self.start_row <= shape[0]:
+                raise ValueError('start_row {:} is not in [0, {:}]'.format(self.start_row, shape[0]))
+
+            self.image = np.asarray(message['image'], dtype='float32').reshape(shape) / (q_levels - 1)
+            self.image[self.start_row:] = 0
+
+        self.arrival_time = time.time()
+        self.future = None
+        self.writer = None
+
+
+class SamplingService(object):
+    """Server that merges the sampling requests of its clients into shared batches.
+
+    Arguments:
+    model: Keras model mapping a canvas [N, H, W, C] with values in [0, 1] (and for
+        class-conditional models, the labels [N]) to logits with shape [N, H, W, C * D]
+        ordered as [N, H, W, C, D], where D is the number of quantisation levels.
+    shape: tuple (height, width, n_channel) of the images.
+    n_classes: number of classes of a class-conditional model, None for an unconditional
+        model.
+    max_batch_size: maximum number of requests sampled together.
+    max_wait: maximum time in seconds the first request of a batch waits for others.
+    """
+
+    def __init__(self, model, shape, n_classes=None, max_batch_size=32, max_wait=0.01):
+        self.shape = shape
+        self.n_classes = n_classes
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.q_levels = model.output_shape[-1] // shape[2]
+
+        height, width, n_channel = shape
+        trunk, head = split_pointwise_head(model)
+
+        # Only the trunk runs on the whole canvas, the pointwise head runs at one position
+        # of each image, given by the vectors i and j
+        @tf.function(input_signature=[tf.TensorSpec([None, height, width, n_channel], tf.float32),
+                                      tf.TensorSpec([None], tf.int32),
+                                      tf.TensorSpec([None], tf.int32),
+                                      tf.TensorSpec([None], tf.int32)])
+        def logits_at(canvas, labels, i, j):
+            x = trunk(canvas if n_classes is None else [canvas, labels], training=False)
+            x = tf.gather_nd(x, tf.stack([i, j], axis=1), batch_dims=1)[:, None, None, :]
+            for layer in head:
+                x = layer(x)
+            return tf.reshape(x, [-1, n_channel, self.q_levels])
+
+        self.logits_at = logits_at
+
+        # The model runs in its own thread, so the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.server = None
+        self.batcher = None
+        self.handlers = set()
+
+    def sample_batch(self, images, labels, start_rows, seeds, on_row=None):
+        """Run the raster loop on a batch of images.
+
+        Arguments:
+        images: array with shape [B, H, W, C] holding the known pixels, in [0, 1]. The
+            pixels from the start row of each image onwards are overwritten in place.
+        labels: int32 array with shape [B], ignored by unconditional models.
+        start_rows: array with shape [B], first row to generate in each image.
+        seeds: int64 array with shape [B], seed of the random numbers of each image.
+        on_row: optional function called as on_row(i, rows) once row i of every image is
+            generated, where rows is a copy of images[:, i].
+        """
+        height, width, n_channel = self.shape
+        n_subpixels = height * width * n_channel
+        start = np.asarray(start_rows) * width * n_channel
+        rows = np.zeros(len(images), dtype='int32')
+        columns = np.zeros(len(images), dtype='int32')
+
+        for t in range(int(start.min()), n_subpixels):
+            i = t // (width * n_channel)
+            j = (t // n_channel) % width
+            k = t % n_channel
+
+            rows[:] = i
+            columns[:] = j
+            logits = self.logits_at(images, labels, rows, columns)
+            values = sample_categorical(logits[:, k, :], seeds=seeds * n_subpixels + t).numpy()
+
+            # Images that start later keep their known pixels
+            generated = t >= start
+            images[generated, i, j, k] = values[generated] / (self.q_levels - 1)
+
+            if on_row is not None and j == width - 1 and k == n_channel - 1:
+                on_row(i, images[:, i].copy())
+        return images
+
+    def _send_row(self, request, i, row):
+        """Send row i to the client of a streaming request, if the row was generated."""
+        if request.stream and i >= request.start_row:
+            message = {'id': request.id,
+                       'row': int(i),
+                       'values': np.rint(row * (self.q_levels - 1)).astype(int).tolist()}
+            request.writer.write((json.dumps(message) + '\n').encode())
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+
+            images = np.stack([request.image for request in batch])
+            labels = np.array([request.label or 0 for request in batch], dtype='int32')
+            start_rows = np.array([request.start_row for request in batch])
+            seeds = np.array([request.seed for request in batch], dtype='int64')
+
+            def on_row(i, rows, batch=batch):
+                # Runs in the sampling thread, the rows are sent from the event loop
+                for request, row in zip(batch, rows):
+                    loop.call_soon_threadsafe(self._send_row, request, i, row)
+
+            try:
+                images = await loop.run_in_executor(self.executor, self.sample_batch,
+                                                    images, labels, start_rows, seeds, on_row)
+            except Exception as error:
+                for request in batch:
+                    request.future.set_exception(error)
+                continue
+
+            for request, image in zip(batch, images):
+                request.future.set_result((image, len(batch)))
+
+    async def _reply(self, request, writer):
+        try:
+            image, batch_size = await request.future
+        except Exception as error:
+            reply = {'id': request.id, 'error': str(error)}
+        else:
+            reply = {'id': request.id,
+                     'image': np.rint(image * (self.q_levels - 1)).astype(int).tolist(),
+                     'batch_size': batch_size,
+                     'service_time': time.time() - request.arrival_time}
+        writer.write((json.dumps(reply) + '\n').encode())
+        await writer.drain()
+
+    async def _handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        replies = []
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                message = {}
+                try:
+                    message = json.loads(line)
+                    request = SamplingRequest(message, self.shape, self.q_levels, self.n_classes)
+                except (KeyError, TypeError, ValueError) as error:
+                    reply = {'id': message.get('id') if isinstance(message, dict) else None, 'error': str(error)}
+                    writer.write((json.dumps(reply) + '\n').encode())
+                    continue
+
+                request.future = loop.create_future()
+                request.writer = writer
+                await self.queue.put(request)
+                replies.append(asyncio.ensure_future(self._reply(request, writer)))
+
+            await asyncio.gather(*replies)
+
+        except asyncio.CancelledError:
+            # The service is closing, so the requests still in flight are dropped
+            for reply in replies:
+                reply.cancel()
+
+        finally:
+            self.handlers.discard(handler)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765):
+        """Start accepting requests, in the running event loop."""
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self._batch_loop())
+        self.server = await asyncio.start_server(self._handle_client, host, port)
+
+    async def close(self):
+        """Stop accepting requests, disconnect the clients and stop the batching loop."""
+        self.server.close()
+        self.batcher.cancel()
+        for handler in list(self.handlers):
+            handler.cancel()
+
+        await asyncio.gather(self.batcher, *self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """Serve requests until the task is cancelled."""
+        await self.start(host, port)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+
+class ContinuousBatchingService(SamplingService):
+    """Sampling service in which every slot of the batch moves through its own image.
+
+    Each of the `max_batch_size` slots keeps the raster position of its request, so the
+    requests of a batch do not move in lock-step. Every step evaluates the model once for
+    all the busy slots, each at its own position, and a slot whose image is complete takes
+    the next request of the queue at the next step, as in the iteration-level scheduling
+    of [1]. A short inpainting job never waits for the full generations of its batch, and
+    a new request does not wait for the current batch to finish.
+
+    Arguments as `SamplingService`, with `max_batch_size` slots. There is no `max_wait`
+    since requests join the batch at any step.
+
+    Refs:
+    [1] - Yu, G. I., Jeong, J. S., Kim, G. W., Kim, S., & Chun, B. G. (2022). Orca: A
+    distributed serving system for transformer-based generative models. In 16th USENIX
+    Symposium on Operating Systems Design and Implementation (OSDI 22).
+    """
+
+    def __init__(self, model, shape, n_classes=None, max_batch_size=32):
+        super(ContinuousBatchingService, self).__init__(model, shape, n_classes=n_classes,
+                                                        max_batch_size=max_batch_size, max_wait=0.)
+
+        self.images = np.zeros((max_batch_size,) + tuple(shape), dtype='float32')
+        self.labels = np.zeros(max_batch_size, dtype='int32')
+        self.seeds = np.zeros(max_batch_size, dtype='int64')
+        self.positions = np.zeros(max_batch_size, dtype='int64')
+        self.slots = [None] * max_batch_size
+
+    def _fill(self, slot, request):
+        height, width, n_channel = self.shape
+        self.slots[slot] = request
+        self.images[slot] = request.image
+        self.labels[slot] = request.label or 0
+        self.seeds[slot] = request.seed
+        self.positions[slot] = request.start_row * width * n_channel
+
+    def step(self, busy):
+        """Generate the next sub-pixel of each slot in `busy`, each at its own position."""
+        height, width, n_channel = self.shape
+        n_subpixels = height * width * n_channel
+
+        t = self.positions[busy]
+        i = t // (width * n_channel)
+        j = (t // n_channel) % width
+        k = t % n_channel
+
+        logits = self.logits_at(self.images[busy], self.labels[busy], i.astype('int32'), j.astype('int32'))
+        logits = tf.gather(logits, k, axis=1, batch_dims=1)
+        values = sample_categorical(logits, seeds=self.seeds[busy] * n_subpixels + t).numpy()
+
+        self.images[busy, i, j, k] = values / (self.q_levels - 1)
+        self.positions[busy] += 1
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        height, width, n_channel = self.shape
+        n_subpixels = height * width * n_channel
+
+        while True:
+            # Only wait for requests when all the slots are free
+            if all(request is None for request in self.slots):
+                self._fill(0, await self.queue.get())
+
+            for slot, request in enumerate(self.slots):
+                if request is None and not self.queue.empty():
+                    self._fill(slot, self.queue.get_nowait())
+
+            busy = np.array([slot for slot, request in enumerate(self.slots)
+                             if request is not None and self.positions[slot] < n_subpixels], dtype='int64')
+            if len(busy):
+                try:
+                    await loop.run_in_executor(self.executor, self.step, busy)
+                except Exception as error:
+                    for slot in busy:
+                        self.slots[slot].future.set_exception(error)
+                        self.slots[slot] = None
+                    continue
+
+            for slot in busy:
+                if self.positions[slot] % (width * n_channel) == 0:
+                    i = self.positions[slot] // (width * n_channel) - 1
+                    self._send_row(self.slots[slot], i, self.images[slot, i])
+
+            for slot, request in enumerate(self.slots):
+                if request is not None and self.positions[slot] >= n_subpixels:
+                    request.future.set_result((self.images[slot].copy(), len(busy)))
+                    self.slots[slot] = None
+
+
+class SamplingClient(object):
+    """Client of `SamplingService`, with any number of requests in flight on one connection."""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        self.streams = {}
+        self.ids = itertools.count()
+        self.receiver = None
+
+    async def connect(self, host='127.0.0.1', port=8765):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.receiver = asyncio.ensure_future(self._receive())
+
+    async def _receive(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                for future in self.pending.values():
+                    future.set_exception(ConnectionError('the connection to the service was closed'))
+                for rows in self.streams.values():
+                    rows.put_nowait(None)
+                self.pending.clear()
+                self.streams.clear()
+                break
+
+            reply = json.loads(line)
+            if 'row' in reply:
+                self.streams[reply['id']].put_nowait((reply['row'], np.array(reply['values'])))
+                continue
+
+            if reply['id'] in self.streams:
+                self.streams.pop(reply['id']).put_nowait(None)
+
+            future = self.pending.pop(reply['id'])
+            if 'error' in reply:
+                future.set_exception(ValueError(reply['error']))
+            else:
+                future.set_result(reply)
+
+    async def request(self, message, rows=None):
+        """Send a request message (without `id`) and return the reply of the server.
+
+        The rows of a streaming request are put in the queue `rows`, followed by None.
+        """
+        message = dict(message, id=next(self.ids))
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message['id']] = future
+        if rows is not None:
+            self.streams[message['id']] = rows
+
+        self.writer.write((json.dumps(message) + '\n').encode())
+        await self.writer.drain()
+        return await future
+
+    @staticmethod
+    def _message(label=None, seed=None, image=None, start_row=0):
+        if image is not None:
+            message = {'type': 'inpainting', 'image': np.asarray(image).astype(int).tolist(), 'start_row': start_row}
+            if label is not None:
+                message['label'] = label
+        elif label is not None:
+            message = {'type': 'class', 'label': label}
+        else:
+            message = {'type': 'unconditional'}
+
+        if seed is not None:
+            message['seed'] = seed
+        return message
+
+    async def sample(self, label=None, seed=None):
+        """Generate an image, of the class `label` if given."""
+        reply = await self.request(self._message(label, seed))
+        return np.array(reply['image'])
+
+    async def inpaint(self, image, start_row, label=None, seed=None):
+        """Generate the rows of a quantised image from `start_row` onwards."""
+        reply = await self.request(self._message(label, seed, image, start_row))
+        return np.array(reply['image'])
+
+    async def stream(self, label=None, seed=None, image=None, start_row=0):
+        """Generate an image as `sample`, or as `inpaint` if `image` is given, row by row.
+
+        Asynchronous iterator over (i, row) for every generated row i, where row holds the
+        quantised values with shape [W, C], as soon as the service has generated the row.
+        """
+        message = dict(self._message(label, seed, image, start_row), stream=True)
+        rows = asyncio.Queue()
+        reply = asyncio.ensure_future(self.request(message, rows))
+
+        while True:
+            row = await rows.get()
+            if row is None:
+                break
+            yield row
+
+        # Raises the error of a failed request
+        await reply
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.receiver.cancel()
+
+
+def main():
+    # ------------------------------------------------------------------------------------
+    # Loading the class-conditional Gated PixelCNN trained by train_gatedpixelcnn2_conditioned.py
+    height = 28
+    width = 28
+    n_channel = 1
+    q_levels = 256
+    n_classes = 10
+
+    pixelcnn = build_conditioned_gated_pixelcnn(height, width, n_channel, q_levels)
+    pixelcnn.load_weights('conditioned_gated_pixelcnn.h5')
+
+    # ------------------------------------------------------------------------------------
+    # Serving requests
+    service = SamplingService(pixelcnn, (height, width, n_channel), n_classes=n_classes,
+                              max_batch_size=32, max_wait=0.05)
+    asyncio.run(service.serve('127.0.0.1', 8765))
+
+
+if __name__ == '__main__':
+    main()
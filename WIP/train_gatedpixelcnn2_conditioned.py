@@ -10,6 +10,10 @@ import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 
+from dataset_cache import load_quantised
+from input_pipeline import DataWaitCounter, build_pipeline
+from losses import channel_logits, nll
+
 class MaskedConv2D(tf.keras.layers.Layer):
     """Convolutional layers with masks for autoregressive models
 
@@ -64,7 +68,7 @@ class MaskedConv2D(tf.keras.layers.Layer):
             mask[kernel_h // 2 + 1:, :, :] = 0.
 
         self.mask = tf.constant(mask,
-                                dtype=tf.float32,
+                                dtype=self.compute_dtype,
                                 name='mask')
 
     def call(self, input):
@@ -125,131 +129,125 @@ def quantise(images, q_levels):
     """Quantise image into q levels"""
     return (np.digitize(images, np.arange(q_levels) / q_levels) - 1).astype('float32')
 
-# def main():
-# --------------------------------------------------------------------------------------------------------------
-# Defining random seeds
-random_seed = 42
-tf.random.set_seed(random_seed)
-np.random.seed(random_seed)
-rn.seed(random_seed)
-
-# --------------------------------------------------------------------------------------------------------------
-# Loading data
-(x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
-
-height = 28
-width = 28
-n_channel = 1
-
-x_train = x_train.astype('float32') / 255.
-x_test = x_test.astype('float32') / 255.
-
-x_train = x_train.reshape(x_train.shape[0], height, width, n_channel)
-x_test = x_test.reshape(x_test.shape[0], height, width, n_channel)
-
-
-# --------------------------------------------------------------------------------------------------------------
-# Quantise the input data in q levels
-q_levels = 256
-x_train_quantised = quantise(x_train, q_levels)
-x_test_quantised = quantise(x_test, q_levels)
-
-# --------------------------------------------------------------------------------------------------------------
-# Creating input stream using tf.data API
-batch_size = 128
-train_buf = 60000
-
-train_dataset = tf.data.Dataset.from_tensor_slices((x_train_quantised / (q_levels - 1),
-                                                    x_train_quantised.astype('int32'),
-                                                    y_train))
-train_dataset = train_dataset.shuffle(buffer_size=train_buf)
-train_dataset = train_dataset.batch(batch_size)
-
-test_dataset = tf.data.Dataset.from_tensor_slices((x_test_quantised / (q_levels - 1),
-                                                   x_test_quantised.astype('int32'),
-                                                   y_test))
-test_dataset = test_dataset.batch(batch_size)
-
-# --------------------------------------------------------------------------------------------------------------
-# Create PixelCNN model
-inputs = keras.layers.Input(shape=(height, width, n_channel))
-labels = keras.layers.Input(shape=(), dtype=tf.int32)
-
-v, h = GatedBlock(mask_type='A', filters=64, kernel_size=7)([inputs, inputs, labels])
-
-for i in range(7):
-    v, h = GatedBlock(mask_type='B', filters=64, kernel_size=3)([v, h, labels])
-
-x = keras.layers.Activation(activation='relu')(h)
-x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
-
-x = keras.layers.Activation(activation='relu')(x)
-x = keras.layers.Conv2D(filters=n_channel * q_levels, kernel_size=1, strides=1)(x)  # shape [N,H,W,DC]
-
-pixelcnn = tf.keras.Model(inputs=[inputs, labels], outputs=x)
-
-# --------------------------------------------------------------------------------------------------------------
-# Prepare optimizer and loss function
-lr_decay = 0.9995
-learning_rate = 1e-3
-optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
-
-compute_loss = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
-
-# --------------------------------------------------------------------------------------------------------------
-@tf.function
-def train_step(batch_x, batch_y, batch_label):
-    with tf.GradientTape() as ae_tape:
-        logits = pixelcnn([batch_x, batch_label], training=True)
-
-        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])  # shape [N,H,W,DC] -> [N,H,W,D,C]
-        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])  # shape [N,H,W,D,C] -> [N,H,W,C,D]
-
-        loss = compute_loss(tf.one_hot(batch_y, q_levels), logits)
-
-    gradients = ae_tape.gradient(loss, pixelcnn.trainable_variables)
-    gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
-    optimizer.apply_gradients(zip(gradients, pixelcnn.trainable_variables))
-
-    return loss
-
-# --------------------------------------------------------------------------------------------------------------
-# Training loop
-n_epochs = 30
-n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
-for epoch in range(n_epochs):
-    start_epoch = time.time()
-    for i_iter, (batch_x, batch_y, batch_label) in enumerate(train_dataset):
-        start = time.time()
-        optimizer.lr = optimizer.lr * lr_decay
-        loss = train_step(batch_x, batch_y, batch_label)
-        iter_time = time.time() - start
-        if i_iter % 100 == 0:
-            print('EPOCH {:3d}: ITER {:4d}/{:4d} TIME: {:.2f} LOSS: {:.4f}'.format(epoch,
-                                                                                   i_iter, n_iter,
-                                                                                   iter_time,
-                                                                                   loss))
-    epoch_time = time.time() - start_epoch
-    print('EPOCH {:3d}: TIME: {:.2f} ETA: {:.2f}'.format(epoch,
-                                                         epoch_time,
-                                                         epoch_time * (n_epochs - epoch)))
-
-
-samples = np.zeros((100, height, width, n_channel), dtype='float32')
-samples_labels = (np.ones((100, 1)) * 7).astype('int32')
-for i in range(height):
-    for j in range(width):
-        logits = pixelcnn([samples, samples_labels])
-        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])  # shape [N,H,W,DC] -> [N,H,W,D,C]
-        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])  # shape [N,H,W,D,C] -> [N,H,W,C,D]
-        next_sample = tf.random.categorical(logits[:, i, j, 0, :], 1)
-        samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
-
-
-fig = plt.figure(figsize=(10, 10))
-for i in range(100):
-    ax = fig.add_subplot(10, 10, i + 1)
-    ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
-    plt.xticks(np.array([]))
-    plt.yticks(np.array([]))
-plt.show()
+def build_conditioned_gated_pixelcnn(height, width, n_channel, q_levels):
+    """Create the Gated PixelCNN conditioned on the MNIST class, with inputs [images, labels]."""
+    inputs = keras.layers.Input(shape=(height, width, n_channel))
+    labels = keras.layers.Input(shape=(), dtype=tf.int32)
+
+    v, h = GatedBlock(mask_type='A', filters=64, kernel_size=7)([inputs, inputs, labels])
+
+    for i in range(7):
+        v, h = GatedBlock(mask_type='B', filters=64, kernel_size=3)([v, h, labels])
+
+    x = keras.layers.Activation(activation='relu')(h)
+    x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
+
+    x = keras.layers.Activation(activation='relu')(x)
+    # Logits in float32 under any dtype policy
+    x = keras.layers.Conv2D(filters=n_channel * q_levels, kernel_size=1, strides=1,
+                            dtype='float32')(x)  # shape [N,H,W,CD]
+
+    return tf.keras.Model(inputs=[inputs, labels], outputs=x)
+
+
+def main():
+    # --------------------------------------------------------------------------------------------------------------
+    # Defining random seeds
+    random_seed = 42
+    tf.random.set_seed(random_seed)
+    np.random.seed(random_seed)
+    rn.seed(random_seed)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Computing the activations in bfloat16, with the weights, logits and loss in float32
+    mixed_precision = False
+    if mixed_precision:
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Loading data quantised in q levels (uint8, cached by dataset_cache.py)
+    height = 28
+    width = 28
+    n_channel = 1
+
+    q_levels = 256
+    (x_train_quantised, y_train), (x_test_quantised, y_test) = load_quantised('mnist', q_levels)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Creating input stream using tf.data API
+    batch_size = 128
+
+    train_dataset = build_pipeline(x_train_quantised, q_levels, batch_size, labels=y_train, seed=random_seed)
+    test_dataset = build_pipeline(x_test_quantised, q_levels, batch_size, labels=y_test, shuffle=False)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Create PixelCNN model
+    pixelcnn = build_conditioned_gated_pixelcnn(height, width, n_channel, q_levels)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Prepare optimizer and loss function
+    lr_decay = 0.9995
+    learning_rate = 1e-3
+    optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
+
+    # --------------------------------------------------------------------------------------------------------------
+    @tf.function
+    def train_step(batch_x, batch_y, batch_label):
+        with tf.GradientTape() as ae_tape:
+            logits = pixelcnn([batch_x, batch_label], training=True)  # shape [N,H,W,CD]
+            loss = nll(batch_y, logits)
+
+        gradients = ae_tape.gradient(loss, pixelcnn.trainable_variables)
+        gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
+        optimizer.apply_gradients(zip(gradients, pixelcnn.trainable_variables))
+
+        return loss
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Training loop
+    n_epochs = 30
+    n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
+    data_wait = DataWaitCounter()
+    for epoch in range(n_epochs):
+        start_epoch = time.time()
+        for i_iter, (batch_x, batch_y, batch_label) in enumerate(data_wait.epoch(train_dataset)):
+            start = time.time()
+            optimizer.lr = optimizer.lr * lr_decay
+            loss = train_step(batch_x, batch_y, batch_label)
+            iter_time = time.time() - start
+            if i_iter % 100 == 0:
+                print('EPOCH {:3d}: ITER {:4d}/{:4d} TIME: {:.2f} LOSS: {:.4f}'.format(epoch,
+                                                                                       i_iter, n_iter,
+                                                                                       iter_time,
+                                                                                       loss))
+        epoch_time = time.time() - start_epoch
+        print('EPOCH {:3d}: TIME: {:.2f} ETA: {:.2f} DATA WAIT: {:.1%}'.format(epoch,
+                                                                              epoch_time,
+                                                                              epoch_time * (n_epochs - epoch),
+                                                                              data_wait.wait_fraction))
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Saving the weights, so the model can be served by sampling_service.py
+    pixelcnn.save_weights('conditioned_gated_pixelcnn.h5')
+
+
+    samples = np.zeros((100, height, width, n_channel), dtype='float32')
+    samples_labels = (np.ones((100, 1)) * 7).astype('int32')
+    for i in range(height):
+        for j in range(width):
+            logits = channel_logits(pixelcnn([samples, samples_labels]), n_channel)  # shape [N,H,W,C,D]
+            next_sample = tf.random.categorical(logits[:, i, j, 0, :], 1)
+            samples[:, i, j, 0] = (next_sample.numpy() / (q_levels - 1))[:, 0]
+
+
+    fig = plt.figure(figsize=(10, 10))
+    for i in range(100):
+        ax = fig.add_subplot(10, 10, i + 1)
+        ax.matshow(samples[i, :, :, 0], cmap=matplotlib.cm.binary)
+        plt.xticks(np.array([]))
+        plt.yticks(np.array([]))
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib
 
+from sampling import sample_categorical
+
 class MaskedConv2D(tf.keras.layers.Layer):
 
     # Mask
@@ -103,10 +105,6 @@ def binarize(images):
     """
     return (np.random.uniform(size=images.shape) < images).astype('float32')
 
-def sample_from(distribution):
-    batch_size, bins = distribution.shape
-    return np.array([np.random.choice(bins, p=distr) for distr in distribution])
-
 def main():
     random_seed = 42
     tf.random.set_seed(random_seed)
@@ -190,10 +188,9 @@ def main():
             A = pixelcnn(samples)
             A = tf.reshape(A, [-1, 28, 28, q_levels, n_channel])  # shape [N,H,W,DC] -> [N,H,W,D,C]
             A = tf.transpose(A, perm=[0, 1, 2, 4, 3])  # shape [N,H,W,D,C] -> [N,H,W,C,D]
-            B = tf.nn.softmax(A)
-            next_sample = B[:,i,j,0,:]
-            samples[:, i, j, 0] = sample_from(next_sample.numpy()) / (q_levels - 1)
-            print("{} {}: {}".format(i, j, sample_from(next_sample.numpy())[0]))
+            next_sample = sample_categorical(A[:, i, j, 0, :]).numpy()
+            samples[:, i, j, 0] = next_sample / (q_levels - 1)
+            print("{} {}: {}".format(i, j, next_sample[0]))
 
     fig = plt.figure()
     for x in range(1,10):
@@ -228,10 +225,9 @@ def main():
             A = pixelcnn([samples, samples_labels])
             A = tf.reshape(A, [-1, 28, 28, q_levels, n_channel])  # shape [N,H,W,DC] -> [N,H,W,D,C]
             A = tf.transpose(A, perm=[0, 1, 2, 4, 3])  # shape [N,H,W,D,C] -> [N,H,W,C,D]
-            B = tf.nn.softmax(A)
-            next_sample = B[:, i, j, 0, :]
-            samples[:, i, j, 0] = sample_from(next_sample.numpy()) / (q_levels - 1)
-            print("{} {}: {}".format(i, j, sample_from(next_sample.numpy())[0]))
+            next_sample = sample_categorical(A[:, i, j, 0, :]).numpy()
+            samples[:, i, j, 0] = next_sample / (q_levels - 1)
+            print("{} {}: {}".format(i, j, next_sample[0]))
 
 
 # -------------------------------------------------------------------------------------------------------------
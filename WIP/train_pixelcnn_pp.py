@@ -10,6 +10,12 @@ import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 
+from dataset_cache import load_quantised
+from input_pipeline import build_pipeline
+from losses import nll, nll_report
+from sampling import generate
+from trainer import MultiStepTrainer, exponential_decay
+
 
 class MaskedConv2D(tf.keras.layers.Layer):
     """Convolutional layers with masks for autoregressive models
@@ -114,12 +120,6 @@ def quantise(images, q_levels):
     return (np.digitize(images, np.arange(q_levels) / q_levels) - 1).astype('float32')
 
 
-def sample_from(distribution):
-    """Sample random values from distribution"""
-    batch_size, bins = distribution.shape
-    return np.array([np.random.choice(bins, p=distr) for distr in distribution])
-
-
 # def main():
 # --------------------------------------------------------------------------------------------------------------
 # Defining random seeds
@@ -129,38 +129,20 @@ np.random.seed(random_seed)
 rn.seed(random_seed)
 
 # --------------------------------------------------------------------------------------------------------------
-# Loading data
-(x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
-
+# Loading data quantised in q levels (uint8, cached by dataset_cache.py)
 height = 28
 width = 28
 n_channel = 1
 
-x_train = x_train.astype('float32') / 255.
-x_test = x_test.astype('float32') / 255.
-
-x_train = x_train.reshape(x_train.shape[0], height, width, 1)
-x_test = x_test.reshape(x_test.shape[0], height, width, 1)
-
-# --------------------------------------------------------------------------------------------------------------
-# Quantise the input data in q levels
 q_levels = 256
-x_train_quantised = quantise(x_train, q_levels)
-x_test_quantised = quantise(x_test, q_levels)
+(x_train_quantised, y_train), (x_test_quantised, y_test) = load_quantised('mnist', q_levels)
 
 # --------------------------------------------------------------------------------------------------------------
 # Creating input stream using tf.data API
 batch_size = 128
-train_buf = 60000
-
-train_dataset = tf.data.Dataset.from_tensor_slices((x_train_quantised / (q_levels - 1),
-                                                    x_train_quantised.astype('int32')))
-train_dataset = train_dataset.shuffle(buffer_size=train_buf)
-train_dataset = train_dataset.batch(batch_size)
 
-test_dataset = tf.data.Dataset.from_tensor_slices((x_test_quantised / (q_levels - 1),
-                                                   x_test_quantised.astype('int32')))
-test_dataset = test_dataset.batch(batch_size)
+train_dataset = build_pipeline(x_train_quantised, q_levels, batch_size, seed=random_seed)
+test_dataset = build_pipeline(x_test_quantised, q_levels, batch_size, shuffle=False)
 
 # --------------------------------------------------------------------------------------------------------------
 # Create PixelCNN model
@@ -182,7 +164,7 @@ x = keras.layers.Activation(activation='relu')(h)
 x = keras.layers.Conv2D(filters=128, kernel_size=1, strides=1)(x)
 
 x = keras.layers.Activation(activation='relu')(x)
-x = keras.layers.Conv2D(filters=n_channel * q_levels, kernel_size=1, strides=1)(x)  # shape [N,H,W,DC]
+x = keras.layers.Conv2D(filters=n_channel * q_levels, kernel_size=1, strides=1)(x)  # shape [N,H,W,CD]
 
 pixelcnn = tf.keras.Model(inputs=inputs, outputs=x)
 
@@ -190,27 +172,16 @@ pixelcnn = tf.keras.Model(inputs=inputs, outputs=x)
 # Prepare optimizer and loss function
 lr_decay = 0.9995
 learning_rate = 1e-3
-optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
-
-compute_loss = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
+optimizer = tf.keras.optimizers.Adam(learning_rate=exponential_decay(learning_rate, lr_decay))
 
 
 # --------------------------------------------------------------------------------------------------------------
-@tf.function
-def train_step(batch_x, batch_y):
-    with tf.GradientTape() as ae_tape:
-        logits = pixelcnn(batch_x, training=True)
+def batch_loss(batch_x, batch_y):
+    logits = pixelcnn(batch_x, training=True)  # shape [N,H,W,CD]
+    return nll(batch_y, logits)
 
-        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])  # shape [N,H,W,DC] -> [N,H,W,D,C]
-        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])  # shape [N,H,W,D,C] -> [N,H,W,C,D]
 
-        loss = compute_loss(tf.one_hot(batch_y, q_levels), logits)
-
-    gradients = ae_tape.gradient(loss, pixelcnn.trainable_variables)
-    gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
-    optimizer.apply_gradients(zip(gradients, pixelcnn.trainable_variables))
-
-    return loss
+trainer = MultiStepTrainer(pixelcnn, optimizer, batch_loss, steps_per_call=100, clip_norm=1.0, measure_wait=True)
 
 
 # --------------------------------------------------------------------------------------------------------------
@@ -219,47 +190,36 @@ n_epochs = 30
 n_iter = int(np.ceil(x_train_quantised.shape[0] / batch_size))
 for epoch in range(n_epochs):
     start_epoch = time.time()
-    for i_iter, (batch_x, batch_y) in enumerate(train_dataset):
+    start = time.time()
+    previous_iter = 0
+    for i_iter, loss in trainer.epoch(train_dataset):
+        # Mean time of the steps of the last call
+        iter_time = (time.time() - start) / (i_iter - previous_iter)
+        print('EPOCH {:3d}: ITER {:4d}/{:4d} TIME: {:.2f} LOSS: {:.4f}'.format(epoch,
+                                                                               i_iter, n_iter,
+                                                                               iter_time,
+                                                                               loss))
         start = time.time()
-        optimizer.lr = optimizer.lr * lr_decay
-        loss = train_step(batch_x, batch_y)
-        iter_time = time.time() - start
-        if i_iter % 100 == 0:
-            print('EPOCH {:3d}: ITER {:4d}/{:4d} TIME: {:.2f} LOSS: {:.4f}'.format(epoch,
-                                                                                   i_iter, n_iter,
-                                                                                   iter_time,
-                                                                                   loss))
+        previous_iter = i_iter
     epoch_time = time.time() - start_epoch
-    print('EPOCH {:3d}: TIME: {:.2f} ETA: {:.2f}'.format(epoch,
-                                                         epoch_time,
-                                                         epoch_time * (n_epochs - epoch)))
+    print('EPOCH {:3d}: TIME: {:.2f} ETA: {:.2f} DATA WAIT: {:.1%}'.format(epoch,
+                                                                          epoch_time,
+                                                                          epoch_time * (n_epochs - epoch),
+                                                                          trainer.wait_fraction))
 
 # --------------------------------------------------------------------------------------------------------------
 # Test
 test_loss = []
 for batch_x, batch_y in test_dataset:
     logits = pixelcnn(batch_x, training=False)
-    logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
-    logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
 
     # Calculate cross-entropy (= negative log-likelihood)
-    loss = compute_loss(tf.one_hot(batch_y, q_levels), logits)
-
-    test_loss.append(loss)
-print('nll : {:} nats'.format(np.array(test_loss).mean()))
-print('bits/dim : {:}'.format(np.array(test_loss).mean() / (height * width)))
+    test_loss.append(nll(batch_y, logits))
+print(nll_report(np.mean(test_loss)))
 
 # --------------------------------------------------------------------------------------------------------------
 # Generating new images
-samples = (np.random.rand(100, height, width, n_channel) * 0.01).astype('float32')
-for i in range(28):
-    for j in range(28):
-        logits = pixelcnn(samples)
-        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
-        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
-        probs = tf.nn.softmax(logits)
-        next_sample = probs[:, i, j, 0, :]
-        samples[:, i, j, 0] = sample_from(next_sample.numpy()) / (q_levels - 1)
+samples = generate(pixelcnn, (height, width, n_channel), 100, random_seed)
 
 fig = plt.figure(figsize=(10, 10))
 for x in range(1, 10):
@@ -274,18 +234,12 @@ plt.show()
 # Filling occluded images
 occlude_start_row = 14
 num_generated_images = 100
-samples = np.copy(x_test_quantised[0:num_generated_images, :, :, :])
+samples = x_test_quantised[0:num_generated_images, :, :, :].astype('float32')
 samples = samples / (q_levels - 1)
 samples[:, occlude_start_row:, :, :] = 0
 
-for i in range(occlude_start_row, height):
-    for j in range(width):
-        logits = pixelcnn(samples)
-        logits = tf.reshape(logits, [-1, height, width, q_levels, n_channel])
-        logits = tf.transpose(logits, perm=[0, 1, 2, 4, 3])
-        probs = tf.nn.softmax(logits)
-        next_sample = probs[:, i, j, 0, :]
-        samples[:, i, j, 0] = sample_from(next_sample.numpy()) / (q_levels - 1)
+samples = generate(pixelcnn, (height, width, n_channel), num_generated_images, random_seed,
+                   samples=samples, start_row=occlude_start_row)
 
 fig = plt.figure(figsize=(10, 10))
 for x in range(1, 10):
@@ -0,0 +1,129 @@
+"""Training loop that runs several training steps per call of a `tf.function`.
+
+The training loops of the scripts are Python loops: every iteration multiplies the learning
+rate by `lr_decay` from Python, calls `train_step` once and hands the loss to the progress
+bar, which waits for the step to finish. `MultiStepTrainer` moves the loop into the graph.
+The decay of the learning rate is an `ExponentialDecay` schedule evaluated by the
+optimizer, one call of the `tf.function` runs `steps_per_call` steps in a `tf.range` loop
+over the dataset iterator, and the loss (and optionally the data wait) is accumulated in
+variables that Python only reads back after every call. With `jit_compile=True` the
+training step is also compiled with XLA.
+"""
+import time
+
+import tensorflow as tf
+from tensorflow import keras
+
+
+def exponential_decay(learning_rate, lr_decay):
+    """Learning rate multiplied by `lr_decay` after every step.
+
+    Same learning rates as `optimizer.lr = optimizer.lr * lr_decay` before every step of
+    the scripts, shifted by one step: the first step uses `learning_rate`.
+    """
+    return keras.optimizers.schedules.ExponentialDecay(learning_rate, decay_steps=1, decay_rate=lr_decay)
+
+
+class MultiStepTrainer(object):
+    """Train a model `steps_per_call` steps at a time inside one `tf.function`.
+
+    Every epoch is a loop over `trainer.epoch(dataset)`, which yields after every call the
+    number of steps done in the epoch and the mean loss of these steps. With
+    `measure_wait=True`, `wait_fraction` is after the epoch the fraction of the epoch spent
+    waiting for batches, as for `input_pipeline.DataWaitCounter`, measured in the graph
+    around `get_next`.
+
+    Arguments:
+    model: Keras model to train.
+    optimizer: Keras optimizer, with the learning rate schedule, e.g. `exponential_decay`.
+    batch_loss: function of the elements of a batch of the dataset returning the scalar
+        loss of the batch, e.g. batch_loss(batch_x, batch_y). It is traced inside the
+        gradient tape.
+    steps_per_call: number of training steps per call of the `tf.function`.
+    clip_norm: if not None, the gradients are clipped to this global norm.
+    jit_compile: if True, every training step (forward pass, gradients and update) is
+        compiled with XLA, which can fuse the element-wise operations of the layers. The
+        loop over the dataset stays outside the compiled step.
+    measure_wait: if True, every step also reads the clock before and after getting its
+        batch to measure the data wait, which costs two timestamps and a variable update
+        per step. Otherwise `wait_fraction` stays 0.
+    """
+
+    def __init__(self, model, optimizer, batch_loss, steps_per_call=50, clip_norm=1.0, jit_compile=False,
+                 measure_wait=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.batch_loss = batch_loss
+        self.steps_per_call = steps_per_call
+        self.clip_norm = clip_norm
+        self.measure_wait = measure_wait
+
+        self._step = self._train_step
+        if jit_compile:
+            # The variables of the optimizer cannot be created inside the compiled step
+            optimizer.build(model.trainable_variables)
+            self._step = tf.function(self._train_step, jit_compile=True)
+
+        self.loss_sum = tf.Variable(0., trainable=False)
+        self.n_steps = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.wait_time = tf.Variable(0., dtype=tf.float64, trainable=False)
+        self.epoch_time = 0.
+
+    def _train_step(self, batch):
+        with tf.GradientTape() as tape:
+            loss = self.batch_loss(*batch)
+
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        if self.clip_norm is not None:
+            gradients, _ = tf.clip_by_global_norm(gradients, self.clip_norm)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        return loss
+
+    @tf.function
+    def _train_steps(self, iterator, n_steps):
+        # The timestamps, the iterator and the variable updates are stateful operations,
+        # which run in program order, so the wait only covers getting the batch
+        for _ in tf.range(n_steps):
+            if self.measure_wait:
+                start = tf.timestamp()
+                batch = iterator.get_next_as_optional()
+                self.wait_time.assign_add(tf.timestamp() - start)
+            else:
+                batch = iterator.get_next_as_optional()
+            if not batch.has_value():
+                break
+
+            loss = self._step(batch.get_value())
+            self.loss_sum.assign_add(loss)
+            self.n_steps.assign_add(1)
+
+    def step_hlo(self, batch, stage='optimized_hlo'):
+        """HLO of the training step compiled for `batch`, with `jit_compile=True`.
+
+        With stage='optimized_hlo', the element-wise operations merged by XLA are in the
+        fused computations of the module.
+        """
+        return self._step.experimental_get_compiler_ir(batch)(stage=stage)
+
+    def epoch(self, dataset):
+        """Train on every batch of `dataset` once, yielding (steps done, mean loss) after every call."""
+        self.loss_sum.assign(0.)
+        self.n_steps.assign(0)
+        self.wait_time.assign(0.)
+        start_epoch = time.time()
+
+        iterator = iter(dataset)
+        n_steps = 0
+        while True:
+            self._train_steps(iterator, tf.constant(self.steps_per_call))
+            previous_steps, n_steps = n_steps, int(self.n_steps.numpy())
+            if n_steps > previous_steps:
+                yield n_steps, float(self.loss_sum.numpy()) / n_steps
+            if n_steps - previous_steps < self.steps_per_call:
+                break
+
+        self.epoch_time = time.time() - start_epoch
+
+    @property
+    def wait_fraction(self):
+        return float(self.wait_time.numpy()) / self.epoch_time if self.epoch_time > 0 else 0.